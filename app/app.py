@@ -2,30 +2,57 @@ import asyncio
 import os
 import logging
 import math
-import csv
-import io
+import html
 from datetime import datetime, timedelta
+import time
 import uuid
+from contextlib import aclosing
 
 import asyncpg
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import BufferedInputFile
+from aiogram.types import BufferedInputFile, FSInputFile
 from dotenv import load_dotenv
 
 from aiohttp import web
 from aiocryptopay import AioCryptoPay, Networks
-from yookassa import Configuration, Payment
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 
 from keyboards.inline import *
 from utils.crypto import *
 from utils.ssh import *
+from utils.tg_output import LiveOutput
+from utils.payments import PAYMENT_CANCELED, PAYMENT_PAID, CryptoPayProvider, PaymentError, YooKassaProvider
+from utils.broadcast import BroadcastRunner
+from utils.migrations import apply_migrations, check_query_plans
+from utils.metrics import (HandlerMetricsMiddleware, LoopLagMonitor, TelegramMetricsMiddleware, http_metrics_middleware,
+                           metrics_handler, track_db_pool, track_ssh_pool)
+from utils.audit import audit
+from utils.cache import TTLCache
+from utils.cache_bus import CACHE_MAX_IDS, CacheBus
+from utils.export import EXPORT_TABLES, ExportError, export_table, record_export
+from utils.fanout import FANOUT_CONCURRENCY, FANOUT_TIMEOUT, fan_out, format_report, summarize
+from utils.keyset import KeysetListing, parse_page_callback
+from utils.fsm_storage import PostgresStorage, create_fsm_storage
+from utils.monitoring import (HISTORY_PERIODS, METRICS_INTERVAL, MetricsCollector, get_history, get_latest_sample,
+                              render_history_chart, sample_record, store_samples)
+from utils.notifications import NotificationSender
+from utils.path_tokens import PathRegistry
+from utils.payment_events import PaymentEventProcessor, confirm_payment, record_payment_event
+from utils.probe import cached_statuses, probe_servers
+from utils.cron import CronError
+from utils.scheduler import (JobScheduler, create_job, delete_job, get_job, get_job_runs, get_server_jobs, parse_schedule,
+                             run_job_now, run_output, set_job_enabled)
+from utils.transfers import TELEGRAM_DOWNLOAD_LIMIT, TELEGRAM_UPLOAD_LIMIT, TransferError, transfers
+from utils.vip import VipSweeper
 
 # --- Конфигурация ---
 load_dotenv('../.env')
@@ -36,26 +63,63 @@ DB_USER, DB_PASS, DB_NAME, DB_HOST, DB_PORT = os.getenv('POSTGRES_USER'), os.get
 CRYPTO_PAY_TOKEN, YK_SHOP_ID, YK_SECRET_KEY = os.getenv('CRYPTO_PAY_TOKEN'), os.getenv('YK_SHOP_ID'), os.getenv('YK_SECRET_KEY')
 BOT_VERSION, VIP_PRICE = "2.1.0-stable", "49₽/месяц" # Версия обновлена
 WEB_SERVER_HOST, WEB_SERVER_PORT = "0.0.0.0", 8080
+WEBHOOK_BASE_DOMAIN = os.getenv('WEBHOOK_BASE_DOMAIN', "https://pay.kododrive.ru")
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # свой сервер Bot API (или подставной в bench/); по умолчанию api.telegram.org
+# False — ответ на вебхук Telegram отправляется после обработки апдейта (так bench/ измеряет время хендлеров)
+WEBHOOK_HANDLE_IN_BACKGROUND = os.getenv('WEBHOOK_HANDLE_IN_BACKGROUND', '1') != '0'
+TERMINAL_TIMEOUT = int(os.getenv('TERMINAL_TIMEOUT', 600))  # макс. время выполнения команды в терминале, сек.
+UPLOAD_TIMEOUT = int(os.getenv('UPLOAD_TIMEOUT', 600))      # макс. время загрузки файла на сервер, сек.
+LISTING_CACHE_TTL = int(os.getenv('LISTING_CACHE_TTL', 30))  # сек. жизни закешированного листинга каталога
+ROW_CACHE_TTL = int(os.getenv('ROW_CACHE_TTL', 30))  # сек. жизни строк users/servers в кеше процесса
+UPLOAD_PROGRESS_INTERVAL = 3.0                               # сек. между обновлениями прогресса загрузки
+COMMAND_BLACKLIST = ["reboot", "shutdown", "rm ", "mkfs", "dd ", "fdisk", "mv "]
+FANOUT_INLINE_REPORT_LIMIT = 3500                            # символов отчета, которые показываем сообщением, а не файлом
 
 # --- ПУТИ ВЕБХУКОВ ---
 WEBHOOK_BASE_URL = "/webhook"
 WEBHOOK_TELEGRAM_PATH = f"{WEBHOOK_BASE_URL}/telegram"
 WEBHOOK_CRYPTO_PAY_PATH = f"{WEBHOOK_BASE_URL}/cryptopay"
 WEBHOOK_YOOKASSA_PATH = f"{WEBHOOK_BASE_URL}/yookassa"
+WEBHOOK_URL = f"{WEBHOOK_BASE_DOMAIN}{WEBHOOK_TELEGRAM_PATH}"
+METRICS_PATH = "/metrics"
 
 
 # --- Инициализация ---
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+bot_session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=bot_session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+fsm_storage = create_fsm_storage()
+dp = Dispatcher(storage=fsm_storage)
+dp.message.middleware(HandlerMetricsMiddleware('message'))
+dp.callback_query.middleware(HandlerMetricsMiddleware('callback_query'))
+bot.session.middleware(TelegramMetricsMiddleware())
+loop_lag_monitor = LoopLagMonitor()
 db_pool = None
+broadcaster = None
+metrics_collector = None
+job_scheduler = None
+payment_processor = None
+notification_sender = None
+vip_sweeper = None
+# Кеши строк БД, нужных почти каждому хендлеру. Живут в памяти процесса: изменения рассылаются
+# остальным процессам через cache_bus (LISTEN/NOTIFY), а короткий TTL страхует на время обрыва подписки
+users_cache = TTLCache(maxsize=10000, ttl=ROW_CACHE_TTL)    # telegram_id -> строка users
+servers_cache = TTLCache(maxsize=10000, ttl=ROW_CACHE_TTL)  # (user_id, server_id) -> строка servers + расшифрованный пароль
+last_callbacks = TTLCache(maxsize=10000, ttl=600)  # (chat_id, message_id) -> id последнего колбэка
+listing_cache = TTLCache(maxsize=200, ttl=LISTING_CACHE_TTL)  # (server_id, путь) -> листинг каталога
+# run_id -> (telegram_id, задача вывода команды) для кнопки "Прервать". Только этого процесса:
+# колбэк, попавший в другой процесс бота, команду не найдет (см. cq_terminal_cancel)
+running_commands = {}
 cryptopay = AioCryptoPay(token=CRYPTO_PAY_TOKEN, network=Networks.MAIN_NET)
+payment_providers = {'cryptopay': CryptoPayProvider(cryptopay)}
 if YK_SHOP_ID and YK_SECRET_KEY:
-    Configuration.configure(YK_SHOP_ID, YK_SECRET_KEY)
+    payment_providers['yookassa'] = YooKassaProvider(YK_SHOP_ID, YK_SECRET_KEY)
 
 # --- FSM Состояния ---
 class AddServer(StatesGroup): name,ip,port,login,password = State(),State(),State(),State(),State()
 class TerminalSession(StatesGroup): active = State()
-class FileManagerSession(StatesGroup): browsing=State(); uploading=State()
+class FanOut(StatesGroup): selecting = State(); command = State()
+class AddJob(StatesGroup): schedule = State(); command = State()
+class FileManagerSession(StatesGroup): browsing=State(); uploading=State(); filtering=State()
 class RenameServer(StatesGroup): new_name = State()
 class ChangePassword(StatesGroup): waiting_for_password = State()
 class Broadcast(StatesGroup): message = State(); confirmation = State()
@@ -66,6 +130,71 @@ class AdminEditContent(StatesGroup): waiting_for_text = State()
 
 
 # --- Функции БД ---
+# Сбросы кешей применяются сразу в этом процессе и, если broadcast, рассылаются остальным через cache_bus
+def invalidate_server_cache(server_id: int, broadcast: bool = True) -> None:
+    servers_cache.invalidate_where(lambda key, _: key[1] == server_id)
+    if broadcast:
+        cache_bus.publish('server', server_id=server_id)
+
+def invalidate_user_cache(user_id: int = None, telegram_id: int = None, broadcast: bool = True) -> None:
+    if telegram_id is not None:
+        users_cache.pop(telegram_id)
+    if user_id is not None:
+        users_cache.invalidate_where(lambda _, user: user['id'] == user_id)
+    if broadcast:
+        cache_bus.publish('user', user_id=user_id, telegram_id=telegram_id)
+
+def invalidate_users_cache(user_ids: list, broadcast: bool = True) -> None:
+    ids = set(user_ids)
+    users_cache.invalidate_where(lambda _, user: user['id'] in ids)
+    if broadcast:
+        if len(ids) > CACHE_MAX_IDS:
+            cache_bus.publish('reset')
+        else:
+            cache_bus.publish('users', user_ids=list(ids))
+
+def invalidate_listing_cache(server_id: int, path: str, broadcast: bool = True) -> None:
+    listing_cache.pop((server_id, path))
+    if broadcast:
+        cache_bus.publish('listing', server_id=server_id, path=path)
+
+async def forget_server(server_id: int, broadcast: bool = True) -> None:
+    """Сбрасывает все, что закешировано по серверу: строку из кеша, SSH-соединения и открытые shell-сессии."""
+    invalidate_server_cache(server_id, broadcast=False)
+    listing_cache.invalidate_where(lambda key, _: key[0] == server_id)
+    ssh_pool.invalidate_server(server_id)
+    await shell_sessions.close_server(server_id)
+    if broadcast:
+        cache_bus.publish('forget', server_id=server_id)
+
+def reset_caches() -> None:
+    users_cache.clear()
+    servers_cache.clear()
+    listing_cache.clear()
+
+async def apply_cache_message(kind: str, data: dict) -> None:
+    """Сброс, присланный другим процессом через cache_bus."""
+    if kind == 'server':
+        invalidate_server_cache(data['server_id'], broadcast=False)
+    elif kind == 'forget':
+        await forget_server(data['server_id'], broadcast=False)
+    elif kind == 'user':
+        invalidate_user_cache(data.get('user_id'), data.get('telegram_id'), broadcast=False)
+    elif kind == 'users':
+        invalidate_users_cache(data['user_ids'], broadcast=False)
+    elif kind == 'listing':
+        invalidate_listing_cache(data['server_id'], data['path'], broadcast=False)
+    elif kind == 'reset':
+        reset_caches()
+
+cache_bus = CacheBus(apply_cache_message, reset_caches)
+
+def server_password(server: dict) -> str:
+    """Расшифрованный пароль из строки get_server_details; бросает ValueError, если расшифровать не удалось."""
+    if server['password'] is None:
+        raise ValueError("Не удалось расшифровать пароль сервера.")
+    return server['password']
+
 async def create_db_pool():
     global db_pool
     for i in range(5):
@@ -81,39 +210,61 @@ async def get_or_create_user(telegram_id: int, username: str, first_name: str) -
     async with db_pool.acquire() as conn:
         user = await conn.fetchrow("SELECT * FROM users WHERE telegram_id = $1", telegram_id)
         if user:
-            return user
-        is_admin = (telegram_id == ADMIN_ID)
-        vip_expires = (datetime.now() + timedelta(days=365*100)) if is_admin else None
-        return await conn.fetchrow("INSERT INTO users (telegram_id, username, first_name, is_admin, is_vip, vip_expires) VALUES ($1, $2, $3, $4, $5, $6) RETURNING *", telegram_id, username, first_name, is_admin, is_admin, vip_expires)
+            if user['is_blocked']:
+                # Пользователь снова пишет боту — возвращаем его в рассылки
+                user = await conn.fetchrow("UPDATE users SET is_blocked = FALSE WHERE id = $1 RETURNING *", user['id'])
+        else:
+            is_admin = (telegram_id == ADMIN_ID)
+            vip_expires = (datetime.now() + timedelta(days=365*100)) if is_admin else None
+            user = await conn.fetchrow("INSERT INTO users (telegram_id, username, first_name, is_admin, is_vip, vip_expires) VALUES ($1, $2, $3, $4, $5, $6) RETURNING *", telegram_id, username, first_name, is_admin, is_admin, vip_expires)
+    users_cache.set(telegram_id, user)
+    return user
 
 async def get_db_user_id(telegram_id: int) -> int or None:
-    async with db_pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT id FROM users WHERE telegram_id = $1", telegram_id)
-        return user['id'] if user else None
+    user = await get_user_by_telegram_id(telegram_id)
+    return user['id'] if user else None
 
 async def add_server_to_db(user_id: int, data: dict) -> None:
     async with db_pool.acquire() as conn:
-        await conn.execute("INSERT INTO servers (user_id, name, ip, port, login_user, password_encrypted) VALUES ($1, $2, $3, $4, $5, $6)", user_id, data['name'], data['ip'], data['port'], data['login'], encrypt_password(data['password']))
+        server_id = await conn.fetchval("INSERT INTO servers (user_id, name, ip, port, login_user, password_encrypted) VALUES ($1, $2, $3, $4, $5, $6) RETURNING id", user_id, data['name'], data['ip'], data['port'], data['login'], encrypt_password(data['password']))
+    invalidate_server_cache(server_id)
 
 async def get_user_servers(user_id: int) -> list:
     async with db_pool.acquire() as conn:
-        return await conn.fetch("SELECT id, name FROM servers WHERE user_id = $1 ORDER BY name", user_id)
+        return await conn.fetch("SELECT id, name, ip, port FROM servers WHERE user_id = $1 ORDER BY name", user_id)
 
-async def get_server_details(server_id: int, user_id: int) -> asyncpg.Record or None:
+async def get_server_details(server_id: int, user_id: int) -> dict or None:
+    """Строка сервера с уже расшифрованным паролем в ключе 'password' (None, если расшифровать не удалось)."""
+    server = servers_cache.get((user_id, server_id))
+    if server is not None:
+        return server
     async with db_pool.acquire() as conn:
-        return await conn.fetchrow("SELECT * FROM servers WHERE id = $1 AND user_id = $2", server_id, user_id)
+        record = await conn.fetchrow("SELECT * FROM servers WHERE id = $1 AND user_id = $2", server_id, user_id)
+    if not record:
+        return None
+    server = dict(record)
+    try:
+        server['password'] = decrypt_password(server['password_encrypted'])
+    except Exception as e:
+        logging.error(f"Не удалось расшифровать пароль сервера {server_id}: {e}")
+        server['password'] = None
+    servers_cache.set((user_id, server_id), server)
+    return server
 
 async def delete_server_from_db(server_id: int, user_id: int) -> None:
     async with db_pool.acquire() as conn:
         await conn.execute("DELETE FROM servers WHERE id = $1 AND user_id = $2", server_id, user_id)
+    await forget_server(server_id)
 
 async def update_server_name(server_id: int, user_id: int, new_name: str) -> None:
     async with db_pool.acquire() as conn:
         await conn.execute("UPDATE servers SET name = $1 WHERE id = $2 AND user_id = $3", new_name, server_id, user_id)
+    invalidate_server_cache(server_id)
 
 async def update_server_password(server_id: int, user_id: int, new_password_encrypted: str) -> None:
-     async with db_pool.acquire() as conn:
+    async with db_pool.acquire() as conn:
         await conn.execute("UPDATE servers SET password_encrypted = $1 WHERE id = $2 AND user_id = $3", new_password_encrypted, server_id, user_id)
+    await forget_server(server_id)
 
 async def get_total_users_count() -> int:
     async with db_pool.acquire() as conn:
@@ -127,36 +278,39 @@ async def create_subscription_record(user_id: int, amount: float, provider: str,
     async with db_pool.acquire() as conn:
         await conn.execute("INSERT INTO subscriptions (user_id, amount, provider, payment_id, status, duration_days) VALUES ($1, $2, $3, $4, 'pending', $5)", user_id, amount, provider, invoice_id, days)
 
-async def get_all_users_ids() -> list:
-    async with db_pool.acquire() as conn:
-        return await conn.fetch("SELECT telegram_id FROM users")
-
-async def get_subscription_by_payment_id(payment_id: str) -> asyncpg.Record or None:
+async def confirm_paid_invoice(provider: str, payment_id: str) -> asyncpg.Record or None:
+    """Ручная проверка оплаты: тот же атомарный переход pending -> paid, что и у вебхука.
+    Уведомление не ставится в очередь — пользователь видит ответ сразу."""
     async with db_pool.acquire() as conn:
-        return await conn.fetchrow("SELECT * FROM subscriptions WHERE payment_id = $1", payment_id)
+        async with conn.transaction():
+            user = await confirm_payment(conn, provider, payment_id, notify=False)
+    if user:
+        invalidate_user_cache(user_id=user['id'])
+    return user
 
-async def mark_subscription_paid(payment_id: str) -> None:
-    async with db_pool.acquire() as conn:
-        await conn.execute("UPDATE subscriptions SET status = 'paid' WHERE payment_id = $1", payment_id)
+async def on_payment_confirmed(user: asyncpg.Record) -> None:
+    invalidate_user_cache(user_id=user['id'])
+    notification_sender.wake()
 
-async def activate_vip_for_user(user_id: int, days_to_add: int) -> None:
-    async with db_pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT is_vip, vip_expires FROM users WHERE id = $1", user_id)
-        if not user:
-            return
-        start_date = datetime.now()
-        if user['is_vip'] and user['vip_expires'] and user['vip_expires'] > start_date:
-            start_date = user['vip_expires']
-        new_expires_date = start_date + timedelta(days=days_to_add)
-        await conn.execute("UPDATE users SET is_vip = TRUE, vip_expires = $1 WHERE id = $2", new_expires_date, user_id)
+async def on_vip_sweep(expired_ids: list, reminders: int) -> None:
+    if expired_ids:
+        invalidate_users_cache(expired_ids)
+    notification_sender.wake()
 
 async def get_user_by_telegram_id(telegram_id: int) -> asyncpg.Record or None:
+    user = users_cache.get(telegram_id)
+    if user is not None:
+        return user
     async with db_pool.acquire() as conn:
-        return await conn.fetchrow("SELECT * FROM users WHERE telegram_id = $1", telegram_id)
+        user = await conn.fetchrow("SELECT * FROM users WHERE telegram_id = $1", telegram_id)
+    if user:
+        users_cache.set(telegram_id, user)
+    return user
 
 async def admin_delete_server(server_id: int):
     async with db_pool.acquire() as conn:
         await conn.execute("DELETE FROM servers WHERE id = $1", server_id)
+    await forget_server(server_id)
 
 async def admin_set_vip_status(user_tg_id: int, status: bool, duration_days: int = 0):
     async with db_pool.acquire() as conn:
@@ -171,10 +325,12 @@ async def admin_set_vip_status(user_tg_id: int, status: bool, duration_days: int
                     start_date = user['vip_expires']
                 new_expires_date = start_date + timedelta(days=duration_days)
                 await conn.execute("UPDATE users SET is_vip = TRUE, vip_expires = $1 WHERE id = $2", new_expires_date, db_user_id)
+                invalidate_user_cache(telegram_id=user_tg_id)
                 return True
             return False
         else:
             await conn.execute("UPDATE users SET is_vip = FALSE, vip_expires = NULL WHERE telegram_id = $1", user_tg_id)
+            invalidate_user_cache(telegram_id=user_tg_id)
             return True
 
 async def admin_get_server_by_id(server_id: int) -> asyncpg.Record or None:
@@ -189,35 +345,17 @@ async def admin_get_server_by_id(server_id: int) -> asyncpg.Record or None:
             server_id
         )
 
-async def admin_get_all_vips_paginated(page: int, per_page: int = 5):
-    offset = page * per_page
-    async with db_pool.acquire() as conn:
-        query = """
-            SELECT telegram_id, username, vip_expires
-            FROM users
-            WHERE is_vip = TRUE AND vip_expires > NOW()
-            ORDER BY vip_expires ASC
-            LIMIT $1 OFFSET $2
-        """
-        vip_users = await conn.fetch(query, per_page, offset)
-
-        total_vips_query = "SELECT COUNT(*) FROM users WHERE is_vip = TRUE AND vip_expires > NOW()"
-        total_count = await conn.fetchval(total_vips_query)
-
-        return vip_users, total_count
-
-async def admin_get_all_users_for_export() -> list:
-    async with db_pool.acquire() as conn:
-        return await conn.fetch("SELECT * FROM users ORDER BY id ASC")
-
-async def admin_get_all_servers_for_export() -> list:
-    async with db_pool.acquire() as conn:
-        return await conn.fetch("""
-            SELECT s.*, u.telegram_id as owner_telegram_id
-            FROM servers s
-            LEFT JOIN users u ON s.user_id = u.id
-            ORDER BY s.id ASC
-        """)
+# Постраничные списки админ-панели (см. utils/keyset.py)
+ADMIN_VIPS = KeysetListing(
+    'vips', "SELECT id, telegram_id, username, vip_expires FROM users WHERE is_vip AND vip_expires > NOW()",
+    ('vip_expires', 'id'), "SELECT COUNT(*) FROM users WHERE is_vip AND vip_expires > NOW()", per_page=5)
+ADMIN_USERS = KeysetListing(
+    'users', "SELECT id, telegram_id, username, first_name, is_vip, is_blocked FROM users WHERE TRUE",
+    ('id',), "SELECT COUNT(*) FROM users", descending=True)
+ADMIN_SERVERS = KeysetListing(
+    'servers', "SELECT s.id, s.name, s.ip, s.port, u.telegram_id AS owner_tg_id "
+               "FROM servers s LEFT JOIN users u ON u.id = s.user_id WHERE TRUE",
+    ('s.id',), "SELECT COUNT(*) FROM servers", descending=True)
 
 async def get_setting(key: str, default: str = None) -> str:
     async with db_pool.acquire() as conn:
@@ -334,18 +472,14 @@ async def show_admin_found_server_info(message_or_callback, server_id: int):
 
 
 # --- Вебхуки ---
+# Вебхук только сохраняет событие и отвечает 200; VIP активирует payment_processor в фоне.
+# 500 возвращается, только если событие не удалось сохранить, — тогда провайдер пришлет его снова.
 async def yookassa_webhook_handler(request: web.Request) -> web.Response:
     try:
         event_json = await request.json()
         if event_json.get('event') == 'payment.succeeded':
-            payment_object = event_json['object']
-            sub = await get_subscription_by_payment_id(payment_object['id'])
-            if sub and sub['status'] != 'paid':
-                user_record = await get_user_by_telegram_id(int(payment_object['metadata']['telegram_id']))
-                if user_record:
-                    await activate_vip_for_user(sub['user_id'], sub['duration_days'])
-                    await mark_subscription_paid(payment_object['id'])
-                    await bot.send_message(user_record['telegram_id'], "✅ Оплата через ЮKassa прошла успешно! VIP активирован.")
+            await record_payment_event(db_pool, 'yookassa', event_json['object']['id'], event_json['event'], event_json)
+            payment_processor.wake()
         return web.Response(status=200)
     except Exception as e:
         logging.error(f"Ошибка в вебхуке ЮKassa: {e}")
@@ -356,13 +490,8 @@ async def cryptopay_webhook_handler(request: web.Request) -> web.Response:
         update = await request.json()
         if update.get('update_type') == 'invoice_paid':
             invoice_id = str(update['payload']['invoice_id'])
-            sub = await get_subscription_by_payment_id(invoice_id)
-            if sub and sub['status'] != 'paid':
-                user_telegram_id = await db_pool.fetchval("SELECT telegram_id FROM users WHERE id=$1", sub['user_id'])
-                if user_telegram_id:
-                    await activate_vip_for_user(sub['user_id'], sub['duration_days'])
-                    await mark_subscription_paid(invoice_id)
-                    await bot.send_message(user_telegram_id, "✅ Оплата через CryptoPay прошла успешно! VIP активирован.")
+            await record_payment_event(db_pool, 'cryptopay', invoice_id, update['update_type'], update)
+            payment_processor.wake()
         return web.Response(status=200)
     except Exception as e:
         logging.error(f"Ошибка в вебхуке CryptoPay: {e}")
@@ -370,6 +499,14 @@ async def cryptopay_webhook_handler(request: web.Request) -> web.Response:
 
 
 # --- Основные обработчики команд и кнопок ---
+@dp.callback_query.outer_middleware()
+async def remember_last_callback(handler, event: types.CallbackQuery, data: dict):
+    """Запоминает последний нажатый колбэк для каждого сообщения: фоновые правки (например,
+    статусы в списке серверов) не должны перезаписать экран, на который пользователь уже ушел."""
+    if event.message:
+        last_callbacks.set((event.message.chat.id, event.message.message_id), event.id)
+    return await handler(event, data)
+
 @dp.message(CommandStart())
 async def handle_start(message: types.Message, state: FSMContext):
     await state.clear()
@@ -409,8 +546,22 @@ async def cq_list_servers(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     db_user_id = await get_db_user_id(callback.from_user.id)
     servers = await get_user_servers(db_user_id)
-    await callback.message.edit_text("У вас нет серверов." if not servers else "🖥️ <b>Выберите сервер:</b>", reply_markup=servers_list_keyboard(servers))
+    if not servers:
+        await callback.message.edit_text("У вас нет серверов.", reply_markup=servers_list_keyboard(servers))
+        await callback.answer()
+        return
+    # Сразу показываем список (со статусами из кеша), а после проверки всех серверов правим его один раз
+    statuses = cached_statuses(servers)
+    await callback.message.edit_text("🖥️ <b>Выберите сервер:</b>", reply_markup=servers_list_keyboard(servers, statuses))
     await callback.answer()
+    if len(statuses) < len(servers):
+        statuses = await probe_servers(servers)
+        if last_callbacks.get((callback.message.chat.id, callback.message.message_id)) != callback.id:
+            return  # пока шла проверка, пользователь нажал другую кнопку
+        try:
+            await callback.message.edit_reply_markup(reply_markup=servers_list_keyboard(servers, statuses))
+        except TelegramBadRequest:
+            pass
 
 @dp.callback_query(F.data == "vip_subscription")
 async def cq_vip_subscription(callback: types.CallbackQuery):
@@ -447,17 +598,16 @@ async def cq_pay_yookassa(callback: types.CallbackQuery):
     price_rub = prices_rub.get(days, 49)
     await callback.message.edit_text("⏳ Создаю счет в ЮKassa...")
     try:
+        if 'yookassa' not in payment_providers:
+            raise PaymentError("ЮKassa не настроена.")
         db_user_id = await get_db_user_id(callback.from_user.id)
-        bot_info = await bot.get_me()
-        payment = Payment.create({
-            "amount": {"value": f"{price_rub}.00", "currency": "RUB"},
-            "confirmation": {"type": "redirect", "return_url": f"https://t.me/{bot_info.username}"},
-            "capture": True,
-            "description": f"VIP подписка на {days} дней",
-            "metadata": {'telegram_id': callback.from_user.id, 'user_id': db_user_id}
-        }, str(uuid.uuid4()))
-        await create_subscription_record(db_user_id, price_rub, 'yookassa', payment.id, days)
-        await callback.message.edit_text(f"🥝 <b>Счет в ЮKassa создан</b>\n\n<b>Сумма:</b> {price_rub} RUB", reply_markup=payment_keyboard(payment.confirmation.confirmation_url, "yookassa", payment.id))
+        bot_info = await bot.me()
+        invoice = await payment_providers['yookassa'].create_invoice(
+            price_rub, f"VIP подписка на {days} дней",
+            metadata={'telegram_id': callback.from_user.id, 'user_id': db_user_id},
+            return_url=f"https://t.me/{bot_info.username}")
+        await create_subscription_record(db_user_id, price_rub, 'yookassa', invoice.invoice_id, days)
+        await callback.message.edit_text(f"🥝 <b>Счет в ЮKassa создан</b>\n\n<b>Сумма:</b> {price_rub} RUB", reply_markup=payment_keyboard(invoice.pay_url, "yookassa", invoice.invoice_id))
     except Exception as e:
         logging.error(f"Ошибка создания счета ЮKassa: {e}")
         await callback.message.edit_text("❌ Не удалось создать счет.", reply_markup=vip_menu_keyboard())
@@ -468,10 +618,10 @@ async def cq_pay_cryptobot(callback: types.CallbackQuery):
     days, amount = int(days_str), float(amount_str)
     await callback.message.edit_text("⏳ Создаю счет в CryptoPay...")
     try:
-        invoice = await cryptopay.create_invoice(asset='USDT', amount=amount, description=f"VIP на {days} дней", expires_in=900)
+        invoice = await payment_providers['cryptopay'].create_invoice(amount, f"VIP на {days} дней")
         db_user_id = await get_db_user_id(callback.from_user.id)
-        await create_subscription_record(db_user_id, amount, 'cryptopay', str(invoice.invoice_id), days)
-        await callback.message.edit_text(f"🤖 <b>Счет в CryptoPay создан</b>\n\n<b>Сумма:</b> {amount} USDT", reply_markup=payment_keyboard(invoice.bot_invoice_url, "cryptopay", str(invoice.invoice_id)))
+        await create_subscription_record(db_user_id, amount, 'cryptopay', invoice.invoice_id, days)
+        await callback.message.edit_text(f"🤖 <b>Счет в CryptoPay создан</b>\n\n<b>Сумма:</b> {amount} USDT", reply_markup=payment_keyboard(invoice.pay_url, "cryptopay", invoice.invoice_id))
     except Exception as e:
         logging.error(f"Ошибка создания счета CryptoPay: {e}")
         await callback.message.edit_text("❌ Не удалось создать счет.", reply_markup=vip_menu_keyboard())
@@ -480,12 +630,18 @@ async def cq_pay_cryptobot(callback: types.CallbackQuery):
 async def cq_check_yookassa_payment(callback: types.CallbackQuery):
     payment_id = callback.data.split(":")[2]
     try:
-        payment_info = Payment.find_one(payment_id)
-        if payment_info.status == 'succeeded':
-            await callback.answer("✅ Оплата прошла успешно! VIP уже должен быть активирован через вебхук.", show_alert=True)
+        if 'yookassa' not in payment_providers:
+            raise PaymentError("ЮKassa не настроена.")
+        status = await payment_providers['yookassa'].get_status(payment_id)
+        if status == PAYMENT_PAID:
+            # Если вебхук еще не обработан, засчитываем оплату здесь; повторно она не засчитается
+            await confirm_paid_invoice('yookassa', payment_id)
+            await callback.answer("✅ Оплата прошла успешно! VIP-статус активирован.", show_alert=True)
             await cq_vip_subscription(callback)
+        elif status == PAYMENT_CANCELED:
+            await callback.answer("❌ Платеж отменен.", show_alert=True)
         else:
-            await callback.answer(f"Статус платежа: {payment_info.status}", show_alert=True)
+            await callback.answer("Платеж еще не получен.", show_alert=True)
     except Exception as e:
         logging.error(f"Ошибка проверки платежа ЮKassa: {e}")
         await callback.answer("Не удалось проверить платеж.", show_alert=True)
@@ -494,20 +650,18 @@ async def cq_check_yookassa_payment(callback: types.CallbackQuery):
 async def cq_check_cryptopay_payment(callback: types.CallbackQuery):
     invoice_id_str = callback.data.split(":")[2]
     try:
-        invoice_id_int = int(invoice_id_str)
-    except ValueError:
-        await callback.answer("Неверный формат ID счета.", show_alert=True)
-        return
-    invoices = await cryptopay.get_invoices(invoice_ids=[invoice_id_int])
-    if invoices and invoices[0].status == 'paid':
-        sub = await get_subscription_by_payment_id(invoice_id_str)
-        if sub and sub['status'] != 'paid':
-            await activate_vip_for_user(sub['user_id'], sub['duration_days'])
-            await mark_subscription_paid(invoice_id_str)
-            user = await get_user_by_telegram_id(callback.from_user.id)
-            if user:
-                await bot.send_message(user['telegram_id'], "✅ Оплата прошла успешно! Ваш VIP-статус активирован.")
-                await cq_vip_subscription(callback)
+        status = await payment_providers['cryptopay'].get_status(invoice_id_str)
+    except PaymentError as e:
+        await callback.answer(str(e), show_alert=True)
+        return
+    except Exception as e:
+        logging.error(f"Ошибка проверки платежа CryptoPay: {e}")
+        await callback.answer("Не удалось проверить платеж.", show_alert=True)
+        return
+    if status == PAYMENT_PAID:
+        if await confirm_paid_invoice('cryptopay', invoice_id_str):
+            await callback.answer("✅ Оплата прошла успешно! Ваш VIP-статус активирован.", show_alert=True)
+            await cq_vip_subscription(callback)
         else:
             await callback.answer("✅ Оплата уже была обработана.", show_alert=True)
     else:
@@ -547,7 +701,8 @@ async def process_login(message: types.Message, state: FSMContext):
 
 @dp.message(AddServer.password)
 async def process_password(message: types.Message, state: FSMContext):
-    data = await state.update_data(password=message.text)
+    # Пароль не кладем в данные FSM (они хранятся в БД/Redis) — он нужен только в этом шаге
+    data = {**await state.get_data(), 'password': message.text}
     await message.delete()
     msg = await message.answer("⏳ Проверяю SSH-подключение...")
     is_conn, status = await check_ssh_connection(data['ip'], data['port'], data['login'], data['password'])
@@ -559,6 +714,7 @@ async def process_password(message: types.Message, state: FSMContext):
         user_id = await get_db_user_id(message.from_user.id)
         if user_id:
             await add_server_to_db(user_id, data)
+            audit.log(user_id, 'server_add', name=data['name'], ip=data['ip'], port=data['port'])
             servers = await get_user_servers(user_id)
             await msg.edit_text(f"✅ Сервер <b>'{data['name']}'</b> успешно добавлен!", reply_markup=servers_list_keyboard(servers))
     except Exception as e:
@@ -580,8 +736,8 @@ async def cq_manage_server(callback: types.CallbackQuery, state: FSMContext):
         return
     await callback.message.edit_text(f"⏳ Получаю информацию о сервере <b>{server['name']}</b>...")
     try:
-        password = decrypt_password(server['password_encrypted'])
-        success, info = await get_system_info(server['ip'], server['port'], server['login_user'], password)
+        password = server_password(server)
+        success, info = await get_system_info(server['ip'], server['port'], server['login_user'], password, server_id=server_id)
     except Exception as e:
         logging.error(f"Ошибка проверки статуса сервера {server_id}: {e}")
         success, info = False, {'status': '🔴 Ошибка', 'uptime': 'н/д'}
@@ -597,16 +753,27 @@ async def cq_terminal(callback: types.CallbackQuery, state: FSMContext):
     await state.update_data(server_id=server_id)
     await callback.message.edit_text("🖥️ <b>Терминал.</b> Введите команду. Для выхода введите /exit")
     await callback.answer()
+    # Прогреваем shell-сессию, пока пользователь набирает первую команду
+    uid = await get_db_user_id(callback.from_user.id)
+    srv = await get_server_details(server_id, uid) if uid else None
+    if srv:
+        try:
+            password = server_password(srv)
+        except Exception:
+            return
+        shell_sessions.prewarm(callback.from_user.id, srv['ip'], srv['port'], srv['login_user'], password, server_id)
 
 @dp.message(TerminalSession.active, Command("exit"))
 async def terminal_exit(message: types.Message, state: FSMContext):
+    data = await state.get_data()
     await state.clear()
+    if data.get("server_id"):
+        await shell_sessions.close(message.from_user.id, data["server_id"])
     await message.answer("Выход из терминала.", reply_markup=main_menu_keyboard(message.from_user.id == ADMIN_ID))
 
 @dp.message(TerminalSession.active)
 async def terminal_command_handler(message: types.Message, state: FSMContext):
     cmd = message.text
-    COMMAND_BLACKLIST = ["reboot", "shutdown", "rm ", "mkfs", "dd ", "fdisk", "mv "]
     if any(b in cmd.lower() for b in COMMAND_BLACKLIST):
         await message.answer(f"❌ <b>Опасная команда!</b> Используйте кнопки в настройках сервера для перезагрузки/выключения.")
         return
@@ -621,37 +788,263 @@ async def terminal_command_handler(message: types.Message, state: FSMContext):
         await message.answer("Сервер не найден.")
         await state.clear()
         return
-    msg = await message.answer(f"⏳ Выполняю: <code>{cmd}</code>")
+    msg = await message.answer(f"⏳ Выполняю: <code>{html.escape(cmd)}</code>")
+    audit.log(uid, 'terminal_command', server_id=sid, command=cmd)
     try:
-        password = decrypt_password(srv['password_encrypted'])
+        password = server_password(srv)
     except Exception:
         await msg.edit_text("❌ Ошибка расшифровки пароля.")
         await state.clear()
         return
-    success, output = await execute_command(srv['ip'], srv['port'], srv['login_user'], password, cmd)
-    if len(output) > 4000:
-        output = output[:4000] + "\n..."
-    await msg.edit_text(f"<b>Результат:</b>\n<pre>{output}</pre>")
+    try:
+        session = await shell_sessions.get(message.from_user.id, srv['ip'], srv['port'], srv['login_user'], password, sid)
+    except Exception as e:
+        await msg.edit_text(f"❌ Ошибка подключения: <code>{html.escape(str(e))}</code>")
+        return
+    run_id = uuid.uuid4().hex[:12]
+    output = LiveOutput(bot, msg, f"<b>$</b> <code>{html.escape(cmd)}</code>", reply_markup=terminal_cancel_keyboard(run_id))
+    task = asyncio.create_task(stream_command_output(session, cmd, output))
+    running_commands[run_id] = (message.from_user.id, task)
+    try:
+        footer = await task
+    except asyncio.CancelledError:
+        footer = "\n⛔ <b>Команда прервана.</b>"
+    finally:
+        running_commands.pop(run_id, None)
+    await output.finish(footer)
+
+async def stream_command_output(session: ShellSession, cmd: str, output: LiveOutput) -> str:
+    """Переносит вывод команды из shell-сессии в Telegram по мере поступления. Возвращает подпись-итог."""
+    async def ticker():
+        while True:
+            await asyncio.sleep(1)
+            await output.tick()
+
+    ticker_task = asyncio.create_task(ticker())
+    try:
+        async with aclosing(session.stream(cmd, TERMINAL_TIMEOUT)) as chunks:
+            async for chunk in chunks:
+                await output.feed(chunk)
+    except asyncio.TimeoutError:
+        return f"\n❌ <b>Таймаут выполнения ({TERMINAL_TIMEOUT} секунд).</b>"
+    except ShellSessionError as e:
+        return f"\n❌ <b>{html.escape(str(e))}</b>"
+    except Exception as e:
+        logging.error(f"Ошибка выполнения команды в терминале: {e}")
+        return f"\n❌ <b>Ошибка выполнения:</b> {html.escape(str(e))}"
+    finally:
+        ticker_task.cancel()
+    return f"\n<b>Код выхода:</b> {session.last_exit_status}" if session.last_exit_status else ""
+
+@dp.callback_query(F.data.startswith("term_cancel:"))
+async def cq_terminal_cancel(callback: types.CallbackQuery):
+    run_id = callback.data.split(":")[1]
+    running = running_commands.get(run_id)
+    if not running or running[0] != callback.from_user.id:
+        # Задача команды есть только в процессе, который ее запустил
+        await callback.answer("Команда не найдена в этом процессе бота: она уже завершилась или выполняется "
+                              "другим процессом и прервать ее отсюда нельзя.", show_alert=True)
+        return
+    running[1].cancel()
+    await callback.answer("⛔ Прерываю команду...")
+
+async def show_fanout_selection(callback: types.CallbackQuery, state: FSMContext, selected: set):
+    servers = await get_user_servers(await get_db_user_id(callback.from_user.id))
+    selected &= {s['id'] for s in servers}
+    await state.set_state(FanOut.selecting)
+    await state.update_data(fanout_ids=sorted(selected))
+    await callback.message.edit_text("📡 <b>Команда на несколько серверов.</b>\nОтметьте серверы, на которых ее выполнить:",
+                                     reply_markup=fanout_select_keyboard(servers, selected))
+    await callback.answer()
+
+@dp.callback_query(F.data == "fanout_select")
+async def cq_fanout_select(callback: types.CallbackQuery, state: FSMContext):
+    await show_fanout_selection(callback, state, set((await state.get_data()).get('fanout_ids', [])))
+
+@dp.callback_query(F.data.startswith("fanout_toggle:"))
+async def cq_fanout_toggle(callback: types.CallbackQuery, state: FSMContext):
+    server_id = int(callback.data.split(":")[1])
+    selected = set((await state.get_data()).get('fanout_ids', []))
+    selected ^= {server_id}
+    await show_fanout_selection(callback, state, selected)
+
+@dp.callback_query(F.data == "fanout_all")
+async def cq_fanout_all(callback: types.CallbackQuery, state: FSMContext):
+    servers = await get_user_servers(await get_db_user_id(callback.from_user.id))
+    selected = set((await state.get_data()).get('fanout_ids', []))
+    await show_fanout_selection(callback, state, set() if len(selected) == len(servers) else {s['id'] for s in servers})
+
+@dp.callback_query(F.data == "fanout_next")
+async def cq_fanout_next(callback: types.CallbackQuery, state: FSMContext):
+    selected = (await state.get_data()).get('fanout_ids', [])
+    if not selected:
+        await callback.answer("Отметьте хотя бы один сервер.", show_alert=True)
+        return
+    await state.set_state(FanOut.command)
+    await callback.message.edit_text(
+        f"📡 Выбрано серверов: <b>{len(selected)}</b>.\nВведите команду — она выполнится на всех сразу "
+        f"(до {FANOUT_CONCURRENCY} одновременно, таймаут {FANOUT_TIMEOUT:g} с на сервер). Для выхода введите /cancel",
+        reply_markup=fanout_command_keyboard())
+    await callback.answer()
+
+@dp.message(FanOut.command, F.text)
+async def process_fanout_command(message: types.Message, state: FSMContext):
+    cmd = message.text
+    if any(b in cmd.lower() for b in COMMAND_BLACKLIST):
+        await message.answer("❌ <b>Опасная команда!</b> Используйте кнопки в настройках сервера для перезагрузки/выключения.")
+        return
+    uid = await get_db_user_id(message.from_user.id)
+    if not uid:
+        await message.answer("Ошибка: не удалось определить пользователя.")
+        return
+    servers = [await get_server_details(sid, uid) for sid in (await state.get_data()).get('fanout_ids', [])]
+    servers = [s for s in servers if s]
+    if not servers:
+        await message.answer("Выбранные серверы не найдены.")
+        await state.clear()
+        return
+    msg = await message.answer(f"⏳ Выполняю на {len(servers)} серверах: <code>{html.escape(cmd)}</code>")
+    audit.log(uid, 'fanout_command', server_ids=[s['id'] for s in servers], command=cmd)
+    run_id = uuid.uuid4().hex[:12]
+    output = LiveOutput(bot, msg, f"📡 <b>$</b> <code>{html.escape(cmd)}</code> · серверов: {len(servers)}",
+                        reply_markup=terminal_cancel_keyboard(run_id), filename="fanout_progress.txt")
+    results = []
+    task = asyncio.create_task(stream_fanout_results(servers, cmd, output, results))
+    running_commands[run_id] = (message.from_user.id, task)
+    try:
+        await task
+        footer = f"\n<b>{summarize(results, len(servers))}</b>"
+    except asyncio.CancelledError:
+        footer = f"\n⛔ <b>Запуск прерван.</b> {summarize(results, len(servers))}"
+    finally:
+        running_commands.pop(run_id, None)
+    await output.finish(footer)
+    report = format_report(cmd, results, len(servers))
+    if len(report) <= FANOUT_INLINE_REPORT_LIMIT:
+        await message.answer(f"<pre>{html.escape(report)}</pre>")
+    else:
+        await message.answer_document(BufferedInputFile(report.encode(), filename="fanout_report.txt"),
+                                      caption="📎 Отчет: одинаковые выводы сгруппированы, у каждого сервера — код выхода и время.")
+    await message.answer("Введите следующую команду для тех же серверов или /cancel для выхода.")
+
+async def stream_fanout_results(servers: list, cmd: str, output: LiveOutput, results: list) -> None:
+    """Дописывает в сообщение строку по каждому серверу по мере завершения; результаты копит в results."""
+    async def ticker():
+        while True:
+            await asyncio.sleep(1)
+            await output.tick()
+
+    ticker_task = asyncio.create_task(ticker())
+    try:
+        async with aclosing(fan_out(servers, cmd)) as finished:
+            async for result in finished:
+                results.append(result)
+                await output.feed(f"{'🟢' if result.ok else '🔴'} {result.name} · {result.describe()}\n")
+    finally:
+        ticker_task.cancel()
+
+async def resolve_fm_token(callback: types.CallbackQuery, state: FSMContext):
+    """(server_id, path) по токену из кнопки файл-менеджера или None (с ответом пользователю)."""
+    target = await PathRegistry(state).resolve(callback.data.split(":", 1)[1])
+    if not target:
+        await callback.answer("Кнопка устарела. Откройте файл-менеджер заново.", show_alert=True)
+    return target
 
 @dp.callback_query(F.data.startswith("fm_enter:"))
 async def cq_fm_enter(callback: types.CallbackQuery, state: FSMContext):
     _, sid, path = callback.data.split(":", 2)
+    uid = await get_db_user_id(callback.from_user.id)
+    if not uid or not await get_server_details(int(sid), uid):
+        await callback.answer("Сервер не найден или у вас нет к нему доступа.", show_alert=True)
+        return
     await state.set_state(FileManagerSession.browsing)
-    await state.update_data(server_id=int(sid), current_path=path)
-    await show_files(callback, int(sid), path)
+    await state.update_data(server_id=int(sid), current_path=path, fm_page=0, fm_filter='')
+    await show_files(callback, state)
 
 @dp.callback_query(F.data.startswith("fm_nav:"))
 async def cq_fm_nav(callback: types.CallbackQuery, state: FSMContext):
-    _, sid, path = callback.data.split(":", 2)
-    await state.update_data(current_path=path)
-    await show_files(callback, int(sid), path)
+    target = await resolve_fm_token(callback, state)
+    if not target:
+        return
+    sid, path = target
+    await state.set_state(FileManagerSession.browsing)
+    await state.update_data(server_id=sid, current_path=path, fm_page=0, fm_filter='')
+    await show_files(callback, state)
+
+@dp.callback_query(F.data.startswith("fm_page:"))
+async def cq_fm_page(callback: types.CallbackQuery, state: FSMContext):
+    await state.update_data(fm_page=int(callback.data.split(":")[1]))
+    await show_files(callback, state)
+
+@dp.callback_query(F.data == "fm_sort")
+async def cq_fm_sort(callback: types.CallbackQuery, state: FSMContext):
+    modes = list(FM_SORT_LABELS)
+    current = (await state.get_data()).get('fm_sort', 'name')
+    await state.update_data(fm_sort=modes[(modes.index(current) + 1) % len(modes)], fm_page=0)
+    await show_files(callback, state)
+
+@dp.callback_query(F.data == "fm_psize")
+async def cq_fm_psize(callback: types.CallbackQuery, state: FSMContext):
+    current = (await state.get_data()).get('fm_page_size', FM_PAGE_SIZES[1])
+    next_size = FM_PAGE_SIZES[(FM_PAGE_SIZES.index(current) + 1) % len(FM_PAGE_SIZES)] if current in FM_PAGE_SIZES else FM_PAGE_SIZES[0]
+    await state.update_data(fm_page_size=next_size, fm_page=0)
+    await show_files(callback, state)
+
+@dp.callback_query(F.data == "fm_filter")
+async def cq_fm_filter(callback: types.CallbackQuery, state: FSMContext):
+    await state.set_state(FileManagerSession.filtering)
+    await callback.message.answer("🔎 Введите часть имени файла или каталога.\nДля отмены введите /cancel")
+    await callback.answer()
+
+@dp.message(FileManagerSession.filtering, F.text)
+async def process_fm_filter(message: types.Message, state: FSMContext):
+    await state.set_state(FileManagerSession.browsing)
+    await state.update_data(fm_filter=message.text.strip(), fm_page=0)
+    await show_files(message, state)
+
+@dp.callback_query(F.data == "fm_filter_clear")
+async def cq_fm_filter_clear(callback: types.CallbackQuery, state: FSMContext):
+    await state.update_data(fm_filter='', fm_page=0)
+    await show_files(callback, state)
 
-async def show_files(cb_or_msg: types.CallbackQuery | types.Message, server_id: int, path: str):
+@dp.callback_query(F.data == "fm_refresh")
+async def cq_fm_refresh(callback: types.CallbackQuery, state: FSMContext):
+    await show_files(callback, state, refresh=True)
+
+@dp.callback_query(F.data.in_({"fm_noop", "admin_noop"}))
+async def cq_fm_noop(callback: types.CallbackQuery):
+    await callback.answer()
+
+def paginate_listing(items: list, view: dict) -> tuple:
+    """Фильтр, сортировка и страница листинга по настройкам из FSM. Возвращает (элементы страницы, страница, страниц, найдено)."""
+    name_filter = (view.get('fm_filter') or '').lower()
+    if name_filter:
+        items = [item for item in items if name_filter in item.name.lower()]
+    sort = view.get('fm_sort', 'name')
+    if sort == 'size':
+        key = lambda item: (not item.is_dir, -item.size, item.name.lower())
+    elif sort == 'mtime':
+        key = lambda item: (not item.is_dir, -item.mtime, item.name.lower())
+    else:
+        key = lambda item: (not item.is_dir, item.name.lower())
+    items = sorted(items, key=key)
+    page_size = view.get('fm_page_size', FM_PAGE_SIZES[1])
+    pages = max(1, math.ceil(len(items) / page_size))
+    page = min(max(view.get('fm_page', 0), 0), pages - 1)
+    return items[page * page_size:(page + 1) * page_size], page, pages, len(items)
+
+async def show_files(cb_or_msg: types.CallbackQuery | types.Message, state: FSMContext, refresh: bool = False):
+    """Показывает текущую страницу каталога из FSM (server_id, current_path, fm_*).
+    Листинг кешируется на LISTING_CACHE_TTL, поэтому листание, сортировка и фильтр не ходят на сервер."""
     is_msg = isinstance(cb_or_msg, types.Message)
     uid = cb_or_msg.from_user.id
     edit_func = cb_or_msg.answer if is_msg else cb_or_msg.message.edit_text
-    if not is_msg:
-        await cb_or_msg.message.edit_text(f"⏳ Загружаю содержимое: <code>{path}</code>")
+    data = await state.get_data()
+    server_id, path = data.get('server_id'), data.get('current_path')
+    if not server_id or not path:
+        await edit_func("Ошибка сессии. Откройте файл-менеджер заново.")
+        return
+    # Владелец проверяется и при попадании в кеш: server_id приходит из callback_data
     db_uid = await get_db_user_id(uid)
     if not db_uid:
         await edit_func("Ошибка: не удалось определить пользователя.")
@@ -660,21 +1053,44 @@ async def show_files(cb_or_msg: types.CallbackQuery | types.Message, server_id:
     if not srv:
         await edit_func("Ошибка: сервер не найден.")
         return
+    result = None if refresh else listing_cache.get((server_id, path))
+    if result is None:
+        if not is_msg:
+            await cb_or_msg.message.edit_text(f"⏳ Загружаю содержимое: <code>{html.escape(path)}</code>")
+        try:
+            password = server_password(srv)
+        except Exception:
+            await edit_func("❌ Ошибка расшифровки пароля.")
+            return
+        success, result = await list_directory(srv['ip'], srv['port'], srv['login_user'], password, path, server_id=server_id)
+        if not success:
+            await edit_func(f"❌ Ошибка получения списка файлов: <code>{result}</code>", reply_markup=server_management_keyboard(server_id))
+            return
+        listing_cache.set((server_id, path), result)
+    items, page, pages, found = paginate_listing(result, data)
+    parent_path = os.path.dirname(path)
+    paths = [path] + [os.path.join(path, item.name) for item in items] + ([parent_path] if parent_path != path else [])
+    tokens = await PathRegistry(state).issue_many(server_id, paths)
+    parent_token = tokens[-1] if parent_path != path else None
+    text = f"<b>Содержимое каталога:</b> <code>{html.escape(path)}</code>\nЭлементов: {found}"
+    if data.get('fm_filter'):
+        text += f" (фильтр: <code>{html.escape(data['fm_filter'])}</code>, всего {len(result)})"
+    view = {'sort': data.get('fm_sort', 'name'), 'page_size': data.get('fm_page_size', FM_PAGE_SIZES[1]), 'filter': data.get('fm_filter')}
     try:
-        password = decrypt_password(srv['password_encrypted'])
-    except Exception:
-        await edit_func("❌ Ошибка расшифровки пароля.")
-        return
-    success, result = await list_directory(srv['ip'], srv['port'], srv['login_user'], password, path)
-    if not success:
-        await edit_func(f"❌ Ошибка получения списка файлов: <code>{result}</code>", reply_markup=server_management_keyboard(server_id))
-        return
-    await edit_func(f"<b>Содержимое каталога:</b> <code>{path}</code>", reply_markup=file_manager_keyboard(server_id, path, result))
+        await edit_func(text, reply_markup=file_manager_keyboard(server_id, items, tokens[1:len(items) + 1], tokens[0], parent_token, page, pages, view))
+    except TelegramBadRequest as e:
+        if 'message is not modified' not in str(e):
+            raise
+    if not is_msg:
+        await cb_or_msg.answer()
 
 @dp.callback_query(F.data.startswith("fm_info:"))
 async def cq_fm_info(callback: types.CallbackQuery, state: FSMContext):
-    _, sid, path = callback.data.split(":", 2)
-    msg = await callback.message.answer(f"⏳ Скачиваю файл <code>{os.path.basename(path)}</code>...")
+    target = await resolve_fm_token(callback, state)
+    if not target:
+        return
+    sid, path = target
+    msg = await callback.message.answer(f"⏳ Скачиваю файл <code>{html.escape(os.path.basename(path))}</code>...")
     await callback.answer()
     uid = await get_db_user_id(callback.from_user.id)
     if not uid:
@@ -685,29 +1101,41 @@ async def cq_fm_info(callback: types.CallbackQuery, state: FSMContext):
         await msg.edit_text("Ошибка: сервер не найден.")
         return
     try:
-        password = decrypt_password(srv['password_encrypted'])
+        password = server_password(srv)
     except Exception:
         await msg.edit_text("❌ Ошибка расшифровки пароля.")
         return
-    success, result = await download_file(srv['ip'], srv['port'], srv['login_user'], password, path)
-    if not success:
-        await msg.edit_text(f"❌ Не удалось скачать файл.\n<b>Причина:</b> {result}")
+    try:
+        # Файл идет с сервера во временный файл и оттуда кусками в Telegram — в памяти он целиком не лежит
+        async with transfers.slot(callback.from_user.id) as transfer:
+            success, result = await download_file(srv['ip'], srv['port'], srv['login_user'], password, path,
+                                                  transfer.path, max_size=TELEGRAM_UPLOAD_LIMIT,
+                                                  reserve=transfer.reserve, server_id=srv['id'])
+            if not success:
+                await msg.edit_text(f"❌ Не удалось скачать файл.\n<b>Причина:</b> {result}")
+                return
+            audit.log(uid, 'file_download', server_id=srv['id'], path=path, size=result)
+            file_to_send = FSInputFile(transfer.path, filename=os.path.basename(path))
+            await bot.send_document(callback.from_user.id, file_to_send, caption=f"✅ Файл <code>{os.path.basename(path)}</code> успешно скачан.")
+    except TransferError as e:
+        await msg.edit_text(f"❌ {e}")
         return
-    file_to_send = BufferedInputFile(result, filename=os.path.basename(path))
-    await bot.send_document(callback.from_user.id, file_to_send, caption=f"✅ Файл <code>{os.path.basename(path)}</code> успешно скачан.")
     await msg.delete()
 
 @dp.callback_query(F.data.startswith("fm_upload_here:"))
 async def cq_fm_upload_here(callback: types.CallbackQuery, state: FSMContext):
-    _, sid, path = callback.data.split(":", 2)
+    target = await resolve_fm_token(callback, state)
+    if not target:
+        return
+    sid, path = target
     await state.set_state(FileManagerSession.uploading)
-    await state.update_data(server_id=int(sid), current_path=path)
-    await callback.message.edit_text(f"📤 <b>Загрузка в каталог</b>\n<code>{path}</code>\n\nПросто отправьте документ в этот чат.")
+    await state.update_data(server_id=sid, current_path=path)
+    await callback.message.edit_text(f"📤 <b>Загрузка в каталог</b>\n<code>{html.escape(path)}</code>\n\nПросто отправьте документ в этот чат.")
     await callback.answer()
 
 @dp.message(FileManagerSession.uploading, F.document)
 async def handle_document_upload(message: types.Message, state: FSMContext):
-    if message.document.file_size > 20*1024*1024:
+    if message.document.file_size > TELEGRAM_DOWNLOAD_LIMIT:
         await message.answer("❌ Размер файла не должен превышать 20 МБ!")
         return
     data = await state.get_data()
@@ -716,35 +1144,60 @@ async def handle_document_upload(message: types.Message, state: FSMContext):
         await message.answer("Ошибка сессии. Попробуйте снова.")
         await state.clear()
         return
-    msg = await message.answer(f"⏳ Скачиваю <code>{message.document.file_name}</code> с серверов Telegram...")
-    f_io = await bot.download(message.document)
-    f_content = f_io.read()
-    await msg.edit_text(f"⏳ Загружаю файл на ваш сервер...")
     uid = await get_db_user_id(message.from_user.id)
     if not uid:
-        await msg.edit_text("Ошибка: не удалось определить пользователя.")
+        await message.answer("Ошибка: не удалось определить пользователя.")
         return
     srv = await get_server_details(sid, uid)
     if not srv:
-        await msg.edit_text("Ошибка: не удалось найти сервер.")
+        await message.answer("Ошибка: не удалось найти сервер.")
         await state.clear()
         return
     try:
-        pswd = decrypt_password(srv['password_encrypted'])
+        pswd = server_password(srv)
     except Exception:
-        await msg.edit_text("❌ Ошибка расшифровки пароля.")
+        await message.answer("❌ Ошибка расшифровки пароля.")
         await state.clear()
         return
-    rpath = os.path.join(cpath, message.document.file_name)
-    success, res = await upload_file(srv['ip'], srv['port'], srv['login_user'], pswd, f_content, rpath)
+    file_name, total = message.document.file_name, message.document.file_size
+    msg = await message.answer(f"⏳ Загружаю <code>{html.escape(file_name)}</code> на ваш сервер...")
+    next_progress_at = time.monotonic() + UPLOAD_PROGRESS_INTERVAL
+
+    async def report_progress(done: int) -> None:
+        nonlocal next_progress_at
+        if time.monotonic() < next_progress_at:
+            return
+        next_progress_at = time.monotonic() + UPLOAD_PROGRESS_INTERVAL
+        try:
+            await msg.edit_text(f"⏳ Загружаю <code>{html.escape(file_name)}</code> на ваш сервер...\n"
+                                f"{done // 1024} / {total // 1024} КБ ({done * 100 // max(total, 1)}%)")
+        except (TelegramBadRequest, TelegramRetryAfter):
+            pass
+
+    rpath = os.path.join(cpath, file_name)
+    try:
+        # Куски из Telegram сразу уходят в SFTP: скачивание и запись идут параллельно, файл не буферизуется
+        async with transfers.slot(message.from_user.id, spool=False):
+            tg_file = await bot.get_file(message.document.file_id)
+            chunks = bot.session.stream_content(bot.session.api.file_url(bot.token, tg_file.file_path),
+                                                timeout=UPLOAD_TIMEOUT, chunk_size=SFTP_BLOCK_SIZE)
+            async with aclosing(chunks):
+                success, res = await upload_file(srv['ip'], srv['port'], srv['login_user'], pswd, chunks, rpath,
+                                                 size=total, progress=report_progress, server_id=sid)
+    except TransferError as e:
+        success, res = False, str(e)
+    except Exception as e:
+        success, res = False, f"Не удалось получить файл из Telegram: {e}"
     if not success:
         await msg.edit_text(f"❌ Не удалось загрузить файл.\n<b>Причина:</b> {res}")
         await state.clear()
         return
+    invalidate_listing_cache(sid, cpath)
+    audit.log(uid, 'file_upload', server_id=sid, path=rpath, size=total)
     await msg.delete()
-    await message.answer(f"✅ Файл успешно загружен в <code>{cpath}</code>")
+    await message.answer(f"✅ Файл успешно загружен в <code>{html.escape(cpath)}</code>")
     await state.set_state(FileManagerSession.browsing)
-    await show_files(message, sid, cpath)
+    await show_files(message, state)
 
 @dp.callback_query(F.data.startswith("delete_server_confirm:"))
 async def cq_delete_server_confirm(callback: types.CallbackQuery):
@@ -768,6 +1221,7 @@ async def cq_delete_server_run(callback: types.CallbackQuery, state: FSMContext)
         await callback.answer("Ошибка: не удалось определить пользователя.", show_alert=True)
         return
     await delete_server_from_db(sid, uid)
+    audit.log(uid, 'server_delete', server_id=sid)
     await callback.answer("✅ Сервер удален!", show_alert=True)
     await cq_list_servers(callback, state)
 
@@ -794,6 +1248,7 @@ async def process_rename_server(message: types.Message, state: FSMContext):
         await state.clear()
         return
     await update_server_name(sid, uid, message.text)
+    audit.log(uid, 'server_rename', server_id=sid, name=message.text)
     await message.answer(f"✅ Имя сервера успешно изменено на: <b>{message.text}</b>")
     await state.clear()
     cb_imitation = types.CallbackQuery(id=str(uuid.uuid4()), from_user=message.from_user, chat_instance="", data=f"manage_server:{sid}", message=message)
@@ -811,11 +1266,12 @@ async def handle_power_command(callback: types.CallbackQuery, f, a: str):
         return
     await callback.message.edit_text(f"⏳ Отправляю команду на {a}...")
     try:
-        pswd = decrypt_password(srv['password_encrypted'])
+        pswd = server_password(srv)
     except Exception:
         await callback.message.edit_text(f"❌ Ошибка расшифровки пароля.", reply_markup=server_settings_keyboard(sid))
         return
-    success, msg = await f(srv['ip'], srv['port'], srv['login_user'], pswd)
+    success, msg = await f(srv['ip'], srv['port'], srv['login_user'], pswd, server_id=sid)
+    audit.log(uid, 'server_reboot' if f is reboot_server else 'server_shutdown', server_id=sid, success=success)
     await callback.message.edit_text(f"✅ {msg}" if success else f"❌ {msg}", reply_markup=server_settings_keyboard(sid))
 
 @dp.callback_query(F.data.startswith("reboot_server_confirm:"))
@@ -878,6 +1334,7 @@ async def process_change_password(message: types.Message, state: FSMContext):
     try:
         new_encrypted_password = encrypt_password(new_password)
         await update_server_password(server_id, uid, new_encrypted_password)
+        audit.log(uid, 'server_password_change', server_id=server_id)
         await msg.edit_text("✅ Пароль успешно изменен!", reply_markup=get_back_to_manage_keyboard(server_id))
     except Exception as e:
         logging.error(f"Ошибка обновления пароля в БД для сервера {server_id}: {e}")
@@ -898,8 +1355,8 @@ async def cq_server_info(callback: types.CallbackQuery):
         return
     await callback.message.edit_text(f"⏳ Получаю подробную информацию о <b>{srv['name']}</b>...")
     try:
-        pswd = decrypt_password(srv['password_encrypted'])
-        success, info = await get_system_info(srv['ip'], srv['port'], srv['login_user'], pswd)
+        pswd = server_password(srv)
+        success, info = await get_system_info(srv['ip'], srv['port'], srv['login_user'], pswd, server_id=sid)
     except Exception as e:
         logging.error(f"Ошибка получения инфо о сервере: {e}")
         success, info = False, {}
@@ -921,20 +1378,229 @@ async def cq_server_load(callback: types.CallbackQuery):
     if not srv:
         await callback.answer("Сервер не найден.", show_alert=True)
         return
-    await callback.message.edit_text(f"⏳ Получаю данные о нагрузке на <b>{srv['name']}</b>...")
-    try:
-        pswd = decrypt_password(srv['password_encrypted'])
-        success, info = await get_system_load(srv['ip'], srv['port'], srv['login_user'], pswd)
-    except Exception as e:
-        logging.error(f"Ошибка получения нагрузки: {e}")
-        success, info = False, "Критическая ошибка"
+    # Обычно отвечаем из последнего замера фонового сборщика, без SSH; живой замер — если замера нет
+    info = await get_latest_sample(db_pool, sid, max_age=METRICS_INTERVAL * 3) if METRICS_INTERVAL else None
+    if info is not None:
+        success = info['online']
+        if not success:
+            info = "Сервер не ответил при последней проверке"
+    else:
+        await callback.message.edit_text(f"⏳ Получаю данные о нагрузке на <b>{srv['name']}</b>...")
+        try:
+            pswd = server_password(srv)
+            success, info = await get_system_load(srv['ip'], srv['port'], srv['login_user'], pswd, server_id=sid)
+            await store_samples(db_pool, [sample_record(sid, success, info)])
+            if success:
+                info['ts'] = datetime.now()
+        except Exception as e:
+            logging.error(f"Ошибка получения нагрузки: {e}")
+            success, info = False, "Критическая ошибка"
     if not success:
         text = f"❌ Не удалось получить данные о нагрузке.\n<b>Причина:</b> <code>{info}</code>"
     else:
-        text = f"<b>📊 Нагрузка на систему</b>\n\n<b>CPU:</b> {info['cpu']}\n<b>RAM:</b> {info['ram']}\n<b>Диск (/):</b> {info['disk']}"
-    await callback.message.edit_text(text, reply_markup=get_load_keyboard(sid))
+        text = (f"<b>📊 Нагрузка на систему</b>\n\n<b>CPU:</b> {info['cpu']}\n<b>RAM:</b> {info['ram']}\n<b>Диск (/):</b> {info['disk']}"
+                f"\n\n🕒 Замер: {info['ts'].strftime('%H:%M:%S')}")
+    try:
+        await callback.message.edit_text(text, reply_markup=get_load_keyboard(sid))
+    except TelegramBadRequest as e:
+        if 'message is not modified' not in str(e):
+            raise
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("load_chart:"))
+async def cq_load_chart(callback: types.CallbackQuery):
+    _, sid, period = callback.data.split(":")
+    sid = int(sid)
+    uid = await get_db_user_id(callback.from_user.id)
+    srv = await get_server_details(sid, uid) if uid else None
+    if not srv or period not in HISTORY_PERIODS:
+        await callback.answer("Сервер не найден.", show_alert=True)
+        return
+    points = await get_history(db_pool, sid, period)
+    if len(points) < 2:
+        await callback.answer("История нагрузки еще не накопилась, загляните позже.", show_alert=True)
+        return
+    await callback.answer("⏳ Строю график...")
+    title = f"{srv['name']}: нагрузка {HISTORY_PERIODS[period][0]}"
+    success, result = await render_history_chart(points, title)
+    if not success:
+        await callback.message.answer(f"❌ {result}")
+        return
+    await callback.message.answer_photo(BufferedInputFile(result, filename=f"load_{sid}_{period}.png"), caption=f"📈 {html.escape(title)}")
+
+# --- Задачи по расписанию ---
+def format_job_run(run) -> str:
+    when = run['started_at'].strftime('%d.%m %H:%M')
+    if run['error']:
+        return f"❌ {when} · {html.escape(run['error'])}"
+    icon = "✅" if run['exit_status'] == 0 else "❌"
+    code = '?' if run['exit_status'] is None else run['exit_status']
+    return f"{icon} {when} · код {code} · {run['duration_ms'] / 1000:.1f} с"
+
+async def notify_job_owner(job, text: str, output: str) -> None:
+    body = (f"{text}\n\n<b>Сервер:</b> {html.escape(job['name'])}\n"
+            f"<b>Расписание:</b> <code>{html.escape(job['schedule'])}</code>\n<b>Команда:</b> <code>{html.escape(job['command'])}</code>")
+    if output:
+        body += f"\n<pre>{html.escape(output[-1500:])}</pre>"
+    await bot.send_message(job['telegram_id'], body, reply_markup=job_details_keyboard(job))
+
+async def show_jobs(callback: types.CallbackQuery, server_id: int):
+    uid = await get_db_user_id(callback.from_user.id)
+    srv = await get_server_details(server_id, uid) if uid else None
+    if not srv:
+        await callback.answer("Сервер не найден.", show_alert=True)
+        return
+    jobs = await get_server_jobs(db_pool, server_id, uid)
+    lines = [f"⏰ <b>Задачи по расписанию</b> · {html.escape(srv['name'])}",
+             f"Время — по часам бота (сейчас {datetime.now():%H:%M})."]
+    for job in jobs:
+        state_text = f"следующий запуск {job['next_run_at']:%d.%m %H:%M}" if job['enabled'] else "приостановлена"
+        lines.append(f"• <code>{html.escape(job['schedule'])}</code> — {state_text}")
+    if not jobs:
+        lines.append("\nЗадач пока нет.")
+    await callback.message.edit_text("\n".join(lines), reply_markup=jobs_list_keyboard(server_id, jobs))
+    await callback.answer()
+
+async def show_job(callback: types.CallbackQuery, job_id: int):
+    uid = await get_db_user_id(callback.from_user.id)
+    job = await get_job(db_pool, job_id, uid) if uid else None
+    if not job:
+        await callback.answer("Задача не найдена.", show_alert=True)
+        return
+    runs = await get_job_runs(db_pool, job_id)
+    text = (f"⏰ <b>Задача #{job['id']}</b>\n\n<b>Расписание:</b> <code>{html.escape(job['schedule'])}</code>\n"
+            f"<b>Команда:</b> <code>{html.escape(job['command'])}</code>\n"
+            f"<b>Статус:</b> {'включена' if job['enabled'] else 'приостановлена'}")
+    if job['enabled']:
+        text += f"\n<b>Следующий запуск:</b> {job['next_run_at']:%d.%m.%Y %H:%M}"
+    if job['failures']:
+        text += f"\n<b>Неудачных запусков подряд:</b> {job['failures']}"
+    text += "\n\n<b>Последние запуски:</b>\n" + ("\n".join(format_job_run(r) for r in runs) if runs else "еще не запускалась")
+    await callback.message.edit_text(text, reply_markup=job_details_keyboard(job))
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("jobs:"))
+async def cq_jobs(callback: types.CallbackQuery, state: FSMContext):
+    await state.clear()
+    await show_jobs(callback, int(callback.data.split(":")[1]))
+
+@dp.callback_query(F.data.startswith("job:"))
+async def cq_job(callback: types.CallbackQuery):
+    await show_job(callback, int(callback.data.split(":")[1]))
+
+@dp.callback_query(F.data.startswith("job_add:"))
+async def cq_job_add(callback: types.CallbackQuery, state: FSMContext):
+    server_id = int(callback.data.split(":")[1])
+    uid = await get_db_user_id(callback.from_user.id)
+    if not uid or not await get_server_details(server_id, uid):
+        await callback.answer("Сервер не найден.", show_alert=True)
+        return
+    await state.set_state(AddJob.schedule)
+    await state.update_data(job_server_id=server_id)
+    await callback.message.edit_text(
+        "⏰ <b>Новая задача.</b> Введите расписание в формате cron: минута час день месяц день_недели.\n\n"
+        "Примеры:\n<code>30 3 * * *</code> — каждый день в 03:30\n<code>0 */6 * * *</code> — каждые 6 часов\n"
+        "<code>0 9 * * 1-5</code> — по будням в 09:00\n<code>@weekly</code> — раз в неделю",
+        reply_markup=job_cancel_keyboard(server_id))
+    await callback.answer()
+
+@dp.message(AddJob.schedule, F.text)
+async def process_job_schedule(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    try:
+        schedule = parse_schedule(message.text)
+    except CronError as e:
+        await message.answer(f"❌ {html.escape(str(e))}\nПопробуйте еще раз.", reply_markup=job_cancel_keyboard(data['job_server_id']))
+        return
+    runs, moment = [], datetime.now()
+    for _ in range(3):
+        moment = schedule.next_after(moment)
+        runs.append(f"{moment:%d.%m.%Y %H:%M}")
+    await state.update_data(job_schedule=str(schedule))
+    await state.set_state(AddJob.command)
+    await message.answer(f"Ближайшие запуски: {', '.join(runs)}.\n\nТеперь введите команду.",
+                         reply_markup=job_cancel_keyboard(data['job_server_id']))
+
+@dp.message(AddJob.command, F.text)
+async def process_job_command(message: types.Message, state: FSMContext):
+    cmd = message.text
+    data = await state.get_data()
+    if any(b in cmd.lower() for b in COMMAND_BLACKLIST):
+        await message.answer("❌ <b>Опасная команда!</b> Введите другую команду.", reply_markup=job_cancel_keyboard(data['job_server_id']))
+        return
+    uid = await get_db_user_id(message.from_user.id)
+    success, result = await create_job(db_pool, uid, data['job_server_id'], parse_schedule(data['job_schedule']), cmd)
+    await state.clear()
+    if not success:
+        await message.answer(f"❌ {result}", reply_markup=get_back_to_manage_keyboard(data['job_server_id']))
+        return
+    audit.log(uid, 'job_create', job_id=result, server_id=data['job_server_id'], schedule=data['job_schedule'], command=cmd)
+    job = await get_job(db_pool, result, uid)
+    await message.answer(f"✅ Задача создана. Следующий запуск: {job['next_run_at']:%d.%m.%Y %H:%M}.",
+                         reply_markup=job_details_keyboard(job))
+
+@dp.callback_query(F.data.startswith("job_toggle:"))
+async def cq_job_toggle(callback: types.CallbackQuery):
+    job_id = int(callback.data.split(":")[1])
+    job = await get_job(db_pool, job_id, await get_db_user_id(callback.from_user.id))
+    if not job:
+        await callback.answer("Задача не найдена.", show_alert=True)
+        return
+    await set_job_enabled(db_pool, job, not job['enabled'])
+    await show_job(callback, job_id)
+
+@dp.callback_query(F.data.startswith("job_run_now:"))
+async def cq_job_run_now(callback: types.CallbackQuery):
+    job_id = int(callback.data.split(":")[1])
+    job = await get_job(db_pool, job_id, await get_db_user_id(callback.from_user.id))
+    if not job:
+        await callback.answer("Задача не найдена.", show_alert=True)
+        return
+    if not job['enabled']:
+        await callback.answer("Сначала включите задачу.", show_alert=True)
+        return
+    await run_job_now(db_pool, job_id)
+    job_scheduler.wake()
+    await callback.answer("🚀 Задача запущена. Результат появится в истории через несколько секунд.", show_alert=True)
+
+@dp.callback_query(F.data.startswith("job_output:"))
+async def cq_job_output(callback: types.CallbackQuery):
+    job_id = int(callback.data.split(":")[1])
+    job = await get_job(db_pool, job_id, await get_db_user_id(callback.from_user.id))
+    runs = await get_job_runs(db_pool, job_id, limit=1) if job else []
+    if not runs:
+        await callback.answer("Запусков еще не было.", show_alert=True)
+        return
+    run = runs[0]
+    output = run_output(run) or "Нет вывода."
+    if run['output_truncated']:
+        output += "\n... [вывод обрезан]"
+    header = f"📄 <b>Задача #{job_id}</b>: {format_job_run(run)}"
+    if len(output) <= 3500:
+        await callback.message.answer(f"{header}\n<pre>{html.escape(output)}</pre>")
+    else:
+        await callback.message.answer_document(BufferedInputFile(output.encode(), filename=f"job_{job_id}_output.txt"), caption=header)
     await callback.answer()
 
+@dp.callback_query(F.data.startswith("job_delete_confirm:"))
+async def cq_job_delete_confirm(callback: types.CallbackQuery):
+    job_id = int(callback.data.split(":")[1])
+    await callback.message.edit_text(f"❓ Удалить задачу #{job_id} вместе с историей запусков?",
+                                     reply_markup=job_confirm_delete_keyboard(job_id))
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("job_delete_run:"))
+async def cq_job_delete_run(callback: types.CallbackQuery):
+    job_id = int(callback.data.split(":")[1])
+    uid = await get_db_user_id(callback.from_user.id)
+    job = await get_job(db_pool, job_id, uid)
+    if not job:
+        await callback.answer("Задача не найдена.", show_alert=True)
+        return
+    await delete_job(db_pool, job_id, uid)
+    audit.log(uid, 'job_delete', job_id=job_id, server_id=job['server_id'], command=job['command'])
+    await show_jobs(callback, job['server_id'])
+
 @dp.callback_query(F.data == "support")
 async def cq_support(callback: types.CallbackQuery):
     support_text = await get_setting('support_info', default=f"🆘 Для связи с поддержкой пишите: {SUPPORT_USERNAME}")
@@ -982,6 +1648,7 @@ async def cq_admin_find_user_return(callback: types.CallbackQuery, state: FSMCon
 async def cq_admin_give_vip(callback: types.CallbackQuery):
     user_tg_id = int(callback.data.split(":")[1])
     success = await admin_set_vip_status(user_tg_id, status=True, duration_days=30)
+    audit.log(await get_db_user_id(callback.from_user.id), 'admin_give_vip', telegram_id=user_tg_id, days=30, success=success)
     if success:
         await callback.answer("✅ VIP-статус на 30 дней успешно выдан!", show_alert=True)
         try:
@@ -996,6 +1663,7 @@ async def cq_admin_give_vip(callback: types.CallbackQuery):
 async def cq_admin_revoke_vip(callback: types.CallbackQuery):
     user_tg_id = int(callback.data.split(":")[1])
     await admin_set_vip_status(user_tg_id, status=False)
+    audit.log(await get_db_user_id(callback.from_user.id), 'admin_revoke_vip', telegram_id=user_tg_id)
     await callback.answer("🗑 VIP-статус у пользователя отозван.", show_alert=True)
     try:
         await bot.send_message(user_tg_id, "ℹ️ Ваш VIP-статус был отозван администратором.")
@@ -1032,6 +1700,7 @@ async def process_admin_message_to_user(message: types.Message, state: FSMContex
             from_chat_id=message.chat.id,
             message_id=message.message_id
         )
+        audit.log(await get_db_user_id(message.from_user.id), 'admin_message_user', telegram_id=target_user_id)
         await message.answer("✅ Сообщение успешно отправлено пользователю.")
         if message.text:
              await bot.send_message(target_user_id, "<i>👆 Это сообщение было отправлено вам от администратора.</i>")
@@ -1054,6 +1723,7 @@ async def cq_admin_delete_server_confirm(callback: types.CallbackQuery):
 async def cq_admin_delete_server_run(callback: types.CallbackQuery):
     _, server_id_str, user_tg_id_str = callback.data.split(":")
     await admin_delete_server(int(server_id_str))
+    audit.log(await get_db_user_id(callback.from_user.id), 'admin_server_delete', server_id=int(server_id_str))
     await callback.answer("✅ Сервер удален!", show_alert=True)
     await show_found_user_info(callback, int(user_tg_id_str))
 
@@ -1087,6 +1757,7 @@ async def cq_admin_server_delete_confirm(callback: types.CallbackQuery):
 async def cq_admin_server_delete_run(callback: types.CallbackQuery):
     server_id = int(callback.data.split(":")[1])
     await admin_delete_server(server_id)
+    audit.log(await get_db_user_id(callback.from_user.id), 'admin_server_delete', server_id=server_id)
     await callback.answer("✅ Сервер успешно удален!", show_alert=True)
     await callback.message.edit_text("Меню управления серверами.", reply_markup=admin_servers_menu_keyboard())
 
@@ -1098,66 +1769,80 @@ async def cq_admin_vip_menu(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data.startswith("admin_list_vips:"))
 async def cq_admin_list_vips(callback: types.CallbackQuery):
-    page = int(callback.data.split(":")[1])
-    per_page = 5
-
-    vips, total_count = await admin_get_all_vips_paginated(page=page, per_page=per_page)
+    page, cursor, backwards = parse_page_callback(callback.data)
+    result = await ADMIN_VIPS.fetch(db_pool, cursor, backwards, page)
 
-    if total_count == 0:
+    if not result.rows:
         await callback.message.edit_text("Активных VIP-пользователей нет.", reply_markup=admin_vip_menu_keyboard())
         return
 
-    total_pages = math.ceil(total_count / per_page)
-
-    text = "<b>📋 Список активных VIP-пользователей:</b>\n\n"
-    for vip in vips:
+    text = f"<b>📋 Список активных VIP-пользователей</b> (всего: {result.total}):\n\n"
+    for vip in result.rows:
         username = f"@{vip['username']}" if vip['username'] else "N/A"
         expires_date = vip['vip_expires'].strftime('%d.%m.%Y')
         text += f"▪️ <a href=\"tg://user?id={vip['telegram_id']}\">{vip['telegram_id']}</a> ({username}) - до {expires_date}\n"
 
     await callback.message.edit_text(
         text,
-        reply_markup=admin_vips_list_keyboard(current_page=page, total_pages=total_pages)
+        reply_markup=admin_page_keyboard("admin_list_vips", result, back=("⬅️ В меню VIP-управления", "admin_vip_menu"))
     )
 
+@dp.callback_query(F.data.startswith("admin_list_users:"))
+async def cq_admin_list_users(callback: types.CallbackQuery):
+    page, cursor, backwards = parse_page_callback(callback.data)
+    result = await ADMIN_USERS.fetch(db_pool, cursor, backwards, page)
+    items = []
+    for user in result.rows:
+        name = f"@{user['username']}" if user['username'] else (user['first_name'] or "N/A")
+        marks = ("👑" if user['is_vip'] else "") + ("🚫" if user['is_blocked'] else "")
+        items.append((f"{marks}{user['telegram_id']} · {name}", f"admin_find_user_return:{user['telegram_id']}"))
+    await callback.message.edit_text(
+        f"<b>👥 Все пользователи</b> (всего: {result.total}), сначала новые.\n👑 — VIP, 🚫 — заблокировал бота.",
+        reply_markup=admin_page_keyboard("admin_list_users", result, items, back=("⬅️ Назад", "admin_users_menu")))
+
+@dp.callback_query(F.data.startswith("admin_list_servers:"))
+async def cq_admin_list_servers(callback: types.CallbackQuery):
+    page, cursor, backwards = parse_page_callback(callback.data)
+    result = await ADMIN_SERVERS.fetch(db_pool, cursor, backwards, page)
+    items = [(f"#{server['id']} {server['name']} · {server['ip']}:{server['port']}", f"admin_view_server:{server['id']}")
+             for server in result.rows]
+    await callback.message.edit_text(
+        f"<b>🖥️ Все серверы</b> (всего: {result.total}), сначала новые.",
+        reply_markup=admin_page_keyboard("admin_list_servers", result, items, back=("⬅️ Назад", "admin_servers_menu")))
+
+@dp.callback_query(F.data.startswith("admin_view_server:"))
+async def cq_admin_view_server(callback: types.CallbackQuery):
+    await show_admin_found_server_info(callback, int(callback.data.split(":")[1]))
+
 # --- Экспорт данных ---
 @dp.callback_query(F.data == "admin_export_data")
 async def cq_admin_export_data(callback: types.CallbackQuery):
+    await callback.message.edit_text(
+        "📤 <b>Экспорт данных</b>\n\nТаблицы users и servers выгружаются в CSV, сжатый gzip. "
+        "Пароли серверов в выгрузку не попадают.\n\n"
+        "<b>Только новые</b> — строки, добавленные после прошлого экспорта.",
+        reply_markup=admin_export_keyboard())
+
+@dp.callback_query(F.data.startswith("admin_export_run:"))
+async def cq_admin_export_run(callback: types.CallbackQuery):
+    incremental = callback.data.split(":")[1] == "incremental"
     await callback.answer("⏳ Начинаю экспорт. Это может занять некоторое время...")
-
-    try:
-        users_data = await admin_get_all_users_for_export()
-        if users_data:
-            users_output = io.StringIO()
-            users_writer = csv.writer(users_output)
-            users_headers = users_data[0].keys()
-            users_writer.writerow(users_headers)
-            for user in users_data:
-                users_writer.writerow(user.values())
-            users_output.seek(0)
-            users_file = BufferedInputFile(users_output.read().encode('utf-8'), filename=f"users_{datetime.now().strftime('%Y%m%d')}.csv")
-            await bot.send_document(ADMIN_ID, users_file, caption="Backup таблицы `users`")
-    except Exception as e:
-        logging.error(f"Ошибка экспорта пользователей: {e}")
-        await callback.message.answer(f"❌ Произошла ошибка при экспорте пользователей: {e}")
-
-    try:
-        servers_data = await admin_get_all_servers_for_export()
-        if servers_data:
-            servers_output = io.StringIO()
-            servers_writer = csv.writer(servers_output)
-            servers_headers = servers_data[0].keys()
-            servers_writer.writerow(servers_headers)
-            for server in servers_data:
-                server_values = dict(server)
-                server_values['password_encrypted'] = '***ENCRYPTED***'
-                servers_writer.writerow(server_values.values())
-            servers_output.seek(0)
-            servers_file = BufferedInputFile(servers_output.read().encode('utf-8'), filename=f"servers_{datetime.now().strftime('%Y%m%d')}.csv")
-            await bot.send_document(ADMIN_ID, servers_file, caption="Backup таблицы `servers`")
-    except Exception as e:
-        logging.error(f"Ошибка экспорта серверов: {e}")
-        await callback.message.answer(f"❌ Произошла ошибка при экспорте серверов: {e}")
+    audit.log(await get_db_user_id(callback.from_user.id), 'admin_export', incremental=incremental)
+    for table in EXPORT_TABLES:
+        try:
+            async with transfers.slot(callback.from_user.id, suffix='.csv.gz') as transfer:
+                result = await export_table(db_pool, table, transfer.path, incremental, transfer.reserve)
+                if not result.rows:
+                    await callback.message.answer(f"ℹ️ <code>{table}</code>: новых строк с прошлого экспорта нет.")
+                    continue
+                await bot.send_document(ADMIN_ID, FSInputFile(transfer.path, filename=result.filename),
+                                        caption=f"Backup таблицы <code>{table}</code>: {result.rows} строк")
+                await record_export(db_pool, result)
+        except (ExportError, TransferError) as e:
+            await callback.message.answer(f"❌ Экспорт <code>{table}</code>: {e}")
+        except Exception as e:
+            logging.error(f"Ошибка экспорта {table}: {e}")
+            await callback.message.answer(f"❌ Произошла ошибка при экспорте <code>{table}</code>: {e}")
 
 # --- Управление контентом ---
 @dp.callback_query(F.data == "admin_content_menu")
@@ -1216,12 +1901,13 @@ async def process_new_content(message: types.Message, state: FSMContext):
         return
 
     await update_setting(content_key, message.html_text)
+    audit.log(await get_db_user_id(message.from_user.id), 'admin_content_edit', key=content_key)
     await state.clear()
     await message.answer(f"✅ Текст для <b>{content_title}</b> успешно обновлен!", reply_markup=admin_content_menu_keyboard())
 
 
 # --- Заглушки для других разделов админки ---
-@dp.callback_query(F.data.in_({"dev_placeholder", "admin_view_server"}))
+@dp.callback_query(F.data == "dev_placeholder")
 async def cq_admin_dev_placeholder(callback: types.CallbackQuery):
     await callback.answer("Этот раздел находится в разработке.", show_alert=True)
 
@@ -1245,42 +1931,92 @@ async def broadcast_start(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     message_id, chat_id = data.get("broadcast_message_id"), data.get("broadcast_chat_id")
     await state.clear()
-    await callback.message.edit_text("✅ Рассылка начата...")
-    users = await get_all_users_ids()
-    success, error = 0, 0
-    for user in users:
-        try:
-            await bot.copy_message(chat_id=user['telegram_id'], from_chat_id=chat_id, message_id=message_id)
-            success += 1
-        except Exception:
-            error += 1
-        await asyncio.sleep(0.1)
-    await callback.message.answer(f"🏁 Рассылка завершена!\n\n✅ Успешно отправлено: {success}\n❌ Ошибок: {error}", reply_markup=admin_main_keyboard())
+    await callback.message.edit_text("✅ Рассылка начата. Прогресс — в следующем сообщении.")
+    await broadcaster.create(callback.message.chat.id, chat_id, message_id)
+    audit.log(await get_db_user_id(callback.from_user.id), 'admin_broadcast', message_id=message_id)
 
 
 # --- Основная функция ---
-async def main():
+async def build_app() -> web.Application or None:
+    """Подключается к БД, запускает фоновые задачи и собирает aiohttp-приложение (вебхуки, метрики).
+    Возвращает None, если БД недоступна. Останавливать — shutdown_app(). Используется main() и bench/."""
+    global broadcaster, metrics_collector, job_scheduler, payment_processor, notification_sender, vip_sweeper
     await create_db_pool()
     if not db_pool:
         logging.critical("Не удалось подключиться к базе данных. Запуск отменен.")
-        return
-
-    WEBHOOK_BASE_DOMAIN = "https://pay.kododrive.ru"
-    WEBHOOK_URL = f"{WEBHOOK_BASE_DOMAIN}{WEBHOOK_TELEGRAM_PATH}"
-
-    app = web.Application()
+        return None
+    await apply_migrations(db_pool)
+    if isinstance(fsm_storage, PostgresStorage):
+        fsm_storage.bind(db_pool)
+        fsm_storage.start()
+    for query_name, (uses_index, _) in (await check_query_plans(db_pool)).items():
+        if not uses_index:
+            logging.warning(f"Запрос {query_name} не может использовать индекс — проверьте миграции.")
+    broadcaster = BroadcastRunner(bot, db_pool, progress_markup=admin_main_keyboard())
+    metrics_collector = MetricsCollector(db_pool)
+    job_scheduler = JobScheduler(db_pool, notify_job_owner)
+    payment_processor = PaymentEventProcessor(db_pool, on_payment_confirmed)
+    notification_sender = NotificationSender(bot, db_pool)
+    vip_sweeper = VipSweeper(db_pool, on_vip_sweep)
+    audit.bind(db_pool)
+    cache_bus.bind(db_pool, lambda: asyncpg.connect(user=DB_USER, password=DB_PASS, database=DB_NAME,
+                                                    host=DB_HOST, port=DB_PORT, timeout=10))
+
+    app = web.Application(middlewares=[http_metrics_middleware])
 
     app.router.add_post(WEBHOOK_CRYPTO_PAY_PATH, cryptopay_webhook_handler)
     app.router.add_post(WEBHOOK_YOOKASSA_PATH, yookassa_webhook_handler)
+    app.router.add_get(METRICS_PATH, metrics_handler)
+    track_db_pool(db_pool)
+    track_ssh_pool(ssh_pool)
 
     webhook_request_handler = SimpleRequestHandler(
         dispatcher=dp,
         bot=bot,
+        handle_in_background=WEBHOOK_HANDLE_IN_BACKGROUND,
     )
     webhook_request_handler.register(app, path=WEBHOOK_TELEGRAM_PATH)
     setup_application(app, dp, bot=bot)
 
     await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True)
+    ssh_pool.start()
+    cache_bus.start()
+    await broadcaster.resume_unfinished()
+    shell_sessions.start()
+    metrics_collector.start()
+    job_scheduler.start()
+    payment_processor.start()
+    notification_sender.start()
+    vip_sweeper.start()
+    loop_lag_monitor.start()
+    audit.start()
+    return app
+
+async def shutdown_app() -> None:
+    """Останавливает фоновые задачи и закрывает соединения. Веб-сервер должен быть уже остановлен."""
+    await broadcaster.stop()
+    await metrics_collector.stop()
+    await job_scheduler.stop()
+    await payment_processor.stop()
+    await vip_sweeper.stop()
+    await notification_sender.stop()
+    await loop_lag_monitor.stop()
+    await shell_sessions.close_all()
+    await cache_bus.stop()
+    await audit.stop()  # после остановки хендлеров и фоновых задач: они тоже пишут в журнал
+    await fsm_storage.close()
+    for provider in payment_providers.values():
+        await provider.close()
+    await ssh_pool.close()
+    if db_pool:
+        await db_pool.close()
+    await bot.delete_webhook()
+    await bot.session.close()
+
+async def main():
+    app = await build_app()
+    if app is None:
+        return
 
     runner = web.AppRunner(app)
     await runner.setup()
@@ -1300,9 +2036,7 @@ async def main():
 
     finally:
         await runner.cleanup()
-        if db_pool:
-            await db_pool.close()
-        await bot.delete_webhook()
+        await shutdown_app()
         logging.info("Бот и веб-сервер остановлены.")
 
 
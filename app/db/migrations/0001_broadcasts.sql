@@ -0,0 +1,9 @@
+-- Рассылки: прогресс сохраняется, чтобы продолжить после перезапуска
+ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN DEFAULT FALSE; -- пользователь заблокировал бота
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id SERIAL PRIMARY KEY, admin_chat_id BIGINT NOT NULL, from_chat_id BIGINT NOT NULL,
+    message_id BIGINT NOT NULL, progress_message_id BIGINT, status VARCHAR(20) DEFAULT 'running',
+    last_user_id INTEGER DEFAULT 0, total INTEGER DEFAULT 0, sent INTEGER DEFAULT 0,
+    failed INTEGER DEFAULT 0, blocked INTEGER DEFAULT 0, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    heartbeat_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, finished_at TIMESTAMP
+);
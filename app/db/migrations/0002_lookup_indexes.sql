@@ -0,0 +1,10 @@
+-- Индексы для запросов, которые выполняются на каждый клик
+-- get_user_servers: WHERE user_id = $1 ORDER BY name
+CREATE INDEX IF NOT EXISTS idx_servers_user_id_name ON servers (user_id, name);
+-- get_subscription_by_payment_id / mark_subscription_paid: WHERE payment_id = $1
+CREATE INDEX IF NOT EXISTS idx_subscriptions_payment_id ON subscriptions (payment_id);
+-- admin_get_all_vips_paginated: WHERE is_vip AND vip_expires > NOW() ORDER BY vip_expires
+CREATE INDEX IF NOT EXISTS idx_users_vip_expires ON users (vip_expires) WHERE is_vip;
+-- Журнал действий: выборки по пользователю и по времени
+CREATE INDEX IF NOT EXISTS idx_activity_logs_user_time ON activity_logs (user_id, timestamp DESC);
+CREATE INDEX IF NOT EXISTS idx_activity_logs_time ON activity_logs (timestamp);
@@ -0,0 +1,10 @@
+-- Состояния FSM aiogram (utils/fsm_storage.py): общие для всех процессов бота и переживают перезапуск
+CREATE TABLE IF NOT EXISTS fsm_states (
+    key TEXT PRIMARY KEY,
+    state VARCHAR(255),
+    data JSONB NOT NULL DEFAULT '{}'::jsonb,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Для периодической очистки просроченных состояний
+CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states (updated_at);
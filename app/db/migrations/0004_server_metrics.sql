@@ -0,0 +1,24 @@
+-- История нагрузки серверов (utils/monitoring.py).
+-- Сырые замеры хранятся METRICS_RAW_RETENTION, затем остаются только почасовые агрегаты.
+CREATE TABLE IF NOT EXISTS server_metrics (
+    server_id INTEGER NOT NULL REFERENCES servers(id) ON DELETE CASCADE,
+    ts TIMESTAMP NOT NULL,
+    online BOOLEAN NOT NULL,
+    cpu_pct REAL,
+    mem_used BIGINT, mem_total BIGINT,
+    disk_used BIGINT, disk_total BIGINT,
+    PRIMARY KEY (server_id, ts)
+);
+-- Удаление по сроку хранения
+CREATE INDEX IF NOT EXISTS idx_server_metrics_ts ON server_metrics (ts);
+
+CREATE TABLE IF NOT EXISTS server_metrics_hourly (
+    server_id INTEGER NOT NULL REFERENCES servers(id) ON DELETE CASCADE,
+    hour TIMESTAMP NOT NULL,
+    samples INTEGER NOT NULL,
+    online_samples INTEGER NOT NULL,
+    cpu_avg REAL, cpu_max REAL,
+    mem_pct_avg REAL, mem_pct_max REAL,
+    disk_pct_max REAL,
+    PRIMARY KEY (server_id, hour)
+);
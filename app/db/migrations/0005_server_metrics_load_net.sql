@@ -0,0 +1,4 @@
+-- Поля /proc-сэмплера: load average и счетчики сетевого трафика (байт с загрузки, без lo)
+ALTER TABLE server_metrics ADD COLUMN IF NOT EXISTS load1 REAL;
+ALTER TABLE server_metrics ADD COLUMN IF NOT EXISTS net_rx BIGINT;
+ALTER TABLE server_metrics ADD COLUMN IF NOT EXISTS net_tx BIGINT;
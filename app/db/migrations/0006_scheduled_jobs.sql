@@ -0,0 +1,33 @@
+-- Команды по расписанию (utils/scheduler.py).
+-- Задачу забирает на выполнение один процесс бота: SELECT ... FOR UPDATE SKIP LOCKED и аренда до locked_until.
+-- Если процесс упал посреди выполнения, после окончания аренды задачу заберет другой.
+CREATE TABLE IF NOT EXISTS scheduled_jobs (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    server_id INTEGER NOT NULL REFERENCES servers(id) ON DELETE CASCADE,
+    command TEXT NOT NULL,
+    schedule VARCHAR(100) NOT NULL,
+    enabled BOOLEAN NOT NULL DEFAULT TRUE,
+    next_run_at TIMESTAMP NOT NULL,
+    locked_until TIMESTAMP,
+    last_run_at TIMESTAMP,
+    last_ok BOOLEAN,
+    failures INTEGER NOT NULL DEFAULT 0,  -- неудачных запусков подряд
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+-- Выборка задач, которым пора выполняться
+CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_due ON scheduled_jobs (next_run_at) WHERE enabled;
+CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_server ON scheduled_jobs (server_id);
+
+-- История запусков: последние JOBS_RUNS_KEEP на задачу, вывод сжат zlib
+CREATE TABLE IF NOT EXISTS job_runs (
+    id BIGSERIAL PRIMARY KEY,
+    job_id INTEGER NOT NULL REFERENCES scheduled_jobs(id) ON DELETE CASCADE,
+    started_at TIMESTAMP NOT NULL,
+    duration_ms INTEGER NOT NULL,
+    exit_status INTEGER,
+    error TEXT,
+    output_z BYTEA,
+    output_truncated BOOLEAN NOT NULL DEFAULT FALSE
+);
+CREATE INDEX IF NOT EXISTS idx_job_runs_job ON job_runs (job_id, id DESC);
@@ -0,0 +1,32 @@
+-- Вебхуки платежей (utils/payment_events.py): обработчик только сохраняет событие и сразу отвечает 200,
+-- а активацию VIP выполняет фоновая очередь. Повторная доставка того же события не создает новую строку.
+CREATE TABLE IF NOT EXISTS payment_events (
+    id BIGSERIAL PRIMARY KEY,
+    provider VARCHAR(50) NOT NULL,
+    payment_id VARCHAR(255) NOT NULL,
+    event_type VARCHAR(100) NOT NULL,
+    payload JSONB,
+    received_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    processed_at TIMESTAMP,
+    result VARCHAR(20),  -- activated / duplicate / unknown
+    UNIQUE (provider, payment_id, event_type)
+);
+CREATE INDEX IF NOT EXISTS idx_payment_events_pending ON payment_events (next_attempt_at) WHERE processed_at IS NULL;
+
+-- Исходящие сообщения пользователям (utils/notifications.py). Запись добавляется в той же транзакции,
+-- что и изменение, о котором она сообщает, а отправляется пачками отдельной фоновой задачей.
+CREATE TABLE IF NOT EXISTS notifications (
+    id BIGSERIAL PRIMARY KEY,
+    telegram_id BIGINT NOT NULL,
+    text TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',  -- pending / sent / failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    locked_until TIMESTAMP,
+    error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    sent_at TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_notifications_pending ON notifications (next_attempt_at) WHERE status = 'pending';
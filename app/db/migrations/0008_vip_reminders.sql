@@ -0,0 +1,9 @@
+-- Отправленные напоминания об окончании VIP (utils/vip.py). Ключ включает срок окончания:
+-- после продления VIP напоминание о новом сроке придет снова, а перезапуск бота не отправит его дважды.
+CREATE TABLE IF NOT EXISTS vip_reminders (
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    vip_expires TIMESTAMP NOT NULL,
+    kind VARCHAR(20) NOT NULL,  -- expires_soon / expired
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (user_id, vip_expires, kind)
+);
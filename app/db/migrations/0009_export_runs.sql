@@ -0,0 +1,13 @@
+-- Экспорт данных администратором (utils/export.py). last_id — наибольший id, попавший в выгрузку:
+-- инкрементальный экспорт берет строки с id больше last_id последнего завершенного экспорта этой таблицы.
+CREATE TABLE IF NOT EXISTS export_runs (
+    id SERIAL PRIMARY KEY,
+    table_name VARCHAR(50) NOT NULL,
+    incremental BOOLEAN NOT NULL,
+    from_id INTEGER NOT NULL,
+    last_id INTEGER NOT NULL,
+    row_count INTEGER NOT NULL,
+    size_bytes BIGINT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_export_runs_table ON export_runs (table_name, id DESC);
@@ -0,0 +1,4 @@
+-- Список VIP листается по ключу (vip_expires, id) (utils/keyset.py): индекс должен покрывать весь ключ.
+-- Запросы только по vip_expires (снятие истекших VIP) используют тот же индекс.
+CREATE INDEX IF NOT EXISTS idx_users_vip_expires_id ON users (vip_expires, id) WHERE is_vip;
+DROP INDEX IF EXISTS idx_users_vip_expires;
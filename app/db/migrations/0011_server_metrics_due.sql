@@ -0,0 +1,5 @@
+-- Очередь замеров нагрузки (utils/monitoring.py). Процесс бота забирает серверы, у которых подошел
+-- metrics_due_at, и в том же запросе сдвигает срок на интервал вперед (FOR UPDATE SKIP LOCKED):
+-- при нескольких процессах каждый сервер замеряется один раз за интервал.
+ALTER TABLE servers ADD COLUMN IF NOT EXISTS metrics_due_at TIMESTAMP NOT NULL DEFAULT '-infinity';
+CREATE INDEX IF NOT EXISTS idx_servers_metrics_due ON servers (metrics_due_at);
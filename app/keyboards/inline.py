@@ -1,5 +1,6 @@
 import os
 from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardButton
+from utils.keyset import page_callback
 
 def main_menu_keyboard(is_admin: bool = False):
     b = InlineKeyboardBuilder()
@@ -25,6 +26,14 @@ def admin_main_keyboard():
     b.row(InlineKeyboardButton(text="⬅️ Назад в главное меню", callback_data="back_to_main_menu"))
     return b.as_markup()
 
+def admin_export_keyboard():
+    b = InlineKeyboardBuilder()
+    b.button(text="📦 Полный экспорт", callback_data="admin_export_run:full")
+    b.button(text="🆕 Только новые", callback_data="admin_export_run:incremental")
+    b.adjust(2)
+    b.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_panel"))
+    return b.as_markup()
+
 def confirm_broadcast_keyboard():
     b = InlineKeyboardBuilder()
     b.button(text="✅ Начать рассылку", callback_data="start_broadcast")
@@ -35,7 +44,7 @@ def confirm_broadcast_keyboard():
 def admin_users_keyboard():
     b = InlineKeyboardBuilder()
     b.button(text="🔍 Найти пользователя по ID", callback_data="admin_find_user")
-    b.button(text="📊 Статистика (в разработке)", callback_data="dev_placeholder")
+    b.button(text="📋 Все пользователи", callback_data="admin_list_users:0")
     b.adjust(1)
     b.row(InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data="admin_panel"))
     return b.as_markup()
@@ -68,7 +77,7 @@ def admin_cancel_message_keyboard(user_tg_id: int):
 def admin_servers_menu_keyboard():
     b = InlineKeyboardBuilder()
     b.button(text="🔍 Найти сервер по ID", callback_data="admin_find_server_by_id")
-    b.button(text="📊 Статистика (в разработке)", callback_data="dev_placeholder")
+    b.button(text="📋 Все серверы", callback_data="admin_list_servers:0")
     b.adjust(1)
     b.row(InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data="admin_panel"))
     return b.as_markup()
@@ -97,18 +106,21 @@ def admin_vip_menu_keyboard():
     b.row(InlineKeyboardButton(text="⬅️ Назад в админ-панель", callback_data="admin_panel"))
     return b.as_markup()
 
-def admin_vips_list_keyboard(current_page: int, total_pages: int):
+def admin_page_keyboard(prefix: str, result, items: list = (), back: tuple = ("⬅️ Назад в админ-панель", "admin_panel")):
+    """Страница списка из utils/keyset.py: строки-кнопки items [(текст, callback_data)] и листание курсорами."""
     b = InlineKeyboardBuilder()
+    for text, callback_data in items:
+        b.row(InlineKeyboardButton(text=text, callback_data=callback_data))
     buttons = []
-    if current_page > 0:
-        buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"admin_list_vips:{current_page - 1}"))
-    if total_pages > 1:
-        buttons.append(InlineKeyboardButton(text=f"{current_page + 1}/{total_pages}", callback_data="dev_placeholder"))
-    if current_page < total_pages - 1:
-        buttons.append(InlineKeyboardButton(text="Вперед ▶️", callback_data=f"admin_list_vips:{current_page + 1}"))
+    if result.prev_cursor:
+        buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data=page_callback(prefix, result.page - 1, result.prev_cursor, backwards=True)))
+    if result.pages > 1:
+        buttons.append(InlineKeyboardButton(text=f"{result.page + 1}/{result.pages}", callback_data="admin_noop"))
+    if result.next_cursor:
+        buttons.append(InlineKeyboardButton(text="Вперед ▶️", callback_data=page_callback(prefix, result.page + 1, result.next_cursor)))
     if buttons:
         b.row(*buttons)
-    b.row(InlineKeyboardButton(text="⬅️ В меню VIP-управления", callback_data="admin_vip_menu"))
+    b.row(InlineKeyboardButton(text=back[0], callback_data=back[1]))
     return b.as_markup()
 
 # --- Раздел "Управление контентом" ---
@@ -127,10 +139,20 @@ def admin_cancel_content_edit_keyboard():
     return b.as_markup()
 
 # --- Основные клавиатуры пользователя ---
-def servers_list_keyboard(servers: list):
+def server_status_label(name: str, status=None) -> str:
+    """status — (bool, задержка в мс или ошибка) из utils.probe; None — еще не проверен."""
+    if status is None:
+        return f"⚪ {name}"
+    online, result = status
+    return f"🟢 {name} · {result} мс" if online else f"🔴 {name} · {result}"
+
+def servers_list_keyboard(servers: list, statuses: dict = None):
     b = InlineKeyboardBuilder()
     for s in servers:
-        b.row(InlineKeyboardButton(text=f"🖥️ {s['name']}", callback_data=f"manage_server:{s['id']}"))
+        text = server_status_label(s['name'], statuses.get(s['id'])) if statuses is not None else f"🖥️ {s['name']}"
+        b.row(InlineKeyboardButton(text=text, callback_data=f"manage_server:{s['id']}"))
+    if len(servers) > 1:
+        b.row(InlineKeyboardButton(text="📡 Команда на несколько серверов", callback_data="fanout_select"))
     b.row(InlineKeyboardButton(text="➕ Добавить сервер", callback_data="add_server"))
     b.row(InlineKeyboardButton(text="⬅️ Назад в главное меню", callback_data="back_to_main_menu"))
     return b.as_markup()
@@ -143,6 +165,8 @@ def server_management_keyboard(server_id: int):
     b.adjust(2)
     b.button(text="⚙️ Настройки", callback_data=f"server_settings:{server_id}"); b.button(text="🗑️ Удалить", callback_data=f"delete_server_confirm:{server_id}")
     b.adjust(2)
+    # Ряды через row() добавляются после последнего adjust(), иначе он перераскладывает и их
+    b.row(InlineKeyboardButton(text="⏰ Задачи по расписанию", callback_data=f"jobs:{server_id}"))
     b.row(InlineKeyboardButton(text="⬅️ Назад к списку", callback_data="list_servers"))
     return b.as_markup()
 
@@ -153,8 +177,12 @@ def get_back_to_manage_keyboard(server_id: int):
 
 def get_load_keyboard(server_id: int):
     b = InlineKeyboardBuilder()
+    b.button(text="📈 1 час", callback_data=f"load_chart:{server_id}:1h")
+    b.button(text="📈 24 часа", callback_data=f"load_chart:{server_id}:24h")
+    b.button(text="📈 7 дней", callback_data=f"load_chart:{server_id}:7d")
     b.button(text="🔄 Обновить", callback_data=f"server_load:{server_id}")
     b.button(text="⬅️ Назад", callback_data=f"manage_server:{server_id}")
+    b.adjust(3, 2)
     return b.as_markup()
 
 def server_settings_keyboard(server_id: int):
@@ -180,17 +208,99 @@ def confirm_delete_keyboard(server_id: int):
     b.adjust(2)
     return b.as_markup()
 
-def file_manager_keyboard(server_id: int, current_path: str, items: list):
+def terminal_cancel_keyboard(run_id: str):
+    b = InlineKeyboardBuilder()
+    b.button(text="⛔ Прервать", callback_data=f"term_cancel:{run_id}")
+    return b.as_markup()
+
+def fanout_select_keyboard(servers: list, selected: set):
+    b = InlineKeyboardBuilder()
+    for s in servers:
+        mark = "✅" if s['id'] in selected else "⬜"
+        b.row(InlineKeyboardButton(text=f"{mark} {s['name']}", callback_data=f"fanout_toggle:{s['id']}"))
+    all_selected = len(selected) == len(servers)
+    b.row(InlineKeyboardButton(text="⬜ Снять все" if all_selected else "✅ Выбрать все", callback_data="fanout_all"),
+          InlineKeyboardButton(text=f"▶️ Далее ({len(selected)})", callback_data="fanout_next"))
+    b.row(InlineKeyboardButton(text="⬅️ Назад к списку", callback_data="list_servers"))
+    return b.as_markup()
+
+def fanout_command_keyboard():
+    b = InlineKeyboardBuilder()
+    b.button(text="✏️ Изменить выбор", callback_data="fanout_select")
+    b.button(text="⬅️ Назад к списку", callback_data="list_servers")
+    b.adjust(2)
+    return b.as_markup()
+
+def jobs_list_keyboard(server_id: int, jobs: list):
+    b = InlineKeyboardBuilder()
+    for job in jobs:
+        mark = "▶️" if job['enabled'] else "⏸"
+        status = "" if job['last_ok'] is None else (" ✅" if job['last_ok'] else " ❌")
+        command = job['command'] if len(job['command']) <= 30 else job['command'][:29] + "…"
+        b.row(InlineKeyboardButton(text=f"{mark} {job['schedule']} · {command}{status}", callback_data=f"job:{job['id']}"))
+    b.row(InlineKeyboardButton(text="➕ Новая задача", callback_data=f"job_add:{server_id}"))
+    b.row(InlineKeyboardButton(text="⬅️ Назад к управлению", callback_data=f"manage_server:{server_id}"))
+    return b.as_markup()
+
+def job_details_keyboard(job: dict):
+    b = InlineKeyboardBuilder()
+    b.button(text="⏸ Приостановить" if job['enabled'] else "▶️ Включить", callback_data=f"job_toggle:{job['id']}")
+    b.button(text="🚀 Запустить сейчас", callback_data=f"job_run_now:{job['id']}")
+    b.button(text="📄 Вывод последнего запуска", callback_data=f"job_output:{job['id']}")
+    b.button(text="🗑️ Удалить", callback_data=f"job_delete_confirm:{job['id']}")
+    b.adjust(2)
+    b.row(InlineKeyboardButton(text="🔄 Обновить", callback_data=f"job:{job['id']}"))
+    b.row(InlineKeyboardButton(text="⬅️ Назад к задачам", callback_data=f"jobs:{job['server_id']}"))
+    return b.as_markup()
+
+def job_confirm_delete_keyboard(job_id: int):
+    b = InlineKeyboardBuilder()
+    b.button(text="✅ Да, удалить", callback_data=f"job_delete_run:{job_id}")
+    b.button(text="❌ Нет, отмена", callback_data=f"job:{job_id}")
+    b.adjust(2)
+    return b.as_markup()
+
+def job_cancel_keyboard(server_id: int):
+    b = InlineKeyboardBuilder()
+    b.button(text="❌ Отмена", callback_data=f"jobs:{server_id}")
+    return b.as_markup()
+
+FM_SORT_LABELS = {'name': "🔤 Имя", 'size': "📦 Размер", 'mtime': "🕒 Дата"}
+FM_PAGE_SIZES = (10, 20, 50)
+
+def human_size(size: int) -> str:
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if size < 1024 or unit == "ГБ":
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+
+def file_manager_keyboard(server_id: int, entries: list, tokens: list, upload_token: str, parent_token: str = None,
+                          page: int = 0, pages: int = 1, view: dict = None):
+    """entries — FileEntry текущей страницы, tokens — их токены (utils.path_tokens.PathRegistry).
+    view — настройки просмотра из FSM: sort, page_size, filter."""
+    view = view or {}
     b = InlineKeyboardBuilder()
-    b.row(InlineKeyboardButton(text="📤 Загрузить сюда", callback_data=f"fm_upload_here:{server_id}:{current_path}"))
-    parent_path = os.path.dirname(current_path)
-    if current_path != parent_path:
-        b.row(InlineKeyboardButton(text="⬆️ На уровень выше", callback_data=f"fm_nav:{server_id}:{parent_path}"))
-    for item in items:
-        icon = "📁" if item['type'] == 'dir' else "📄"
-        action = "fm_nav" if item['type'] == 'dir' else "fm_info"
-        full_path = os.path.join(current_path, item['name'])
-        b.row(InlineKeyboardButton(text=f"{icon} {item['name']}", callback_data=f"{action}:{server_id}:{full_path}"))
+    b.row(InlineKeyboardButton(text="📤 Загрузить сюда", callback_data=f"fm_upload_here:{upload_token}"))
+    if parent_token:
+        b.row(InlineKeyboardButton(text="⬆️ На уровень выше", callback_data=f"fm_nav:{parent_token}"))
+    for entry, token in zip(entries, tokens):
+        if entry.is_dir:
+            icon = "🔗📁" if entry.type == 'link' else "📁"
+            b.row(InlineKeyboardButton(text=f"{icon} {entry.name}", callback_data=f"fm_nav:{token}"))
+        else:
+            icon = "🔗" if entry.type == 'link' else "📄"
+            b.row(InlineKeyboardButton(text=f"{icon} {entry.name} · {human_size(entry.size)}", callback_data=f"fm_info:{token}"))
+    if pages > 1:
+        b.row(InlineKeyboardButton(text="◀️", callback_data=f"fm_page:{(page - 1) % pages}"),
+              InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="fm_noop"),
+              InlineKeyboardButton(text="▶️", callback_data=f"fm_page:{(page + 1) % pages}"))
+    sort = view.get('sort', 'name')
+    page_size = view.get('page_size', FM_PAGE_SIZES[1])
+    b.row(InlineKeyboardButton(text=FM_SORT_LABELS[sort], callback_data="fm_sort"),
+          InlineKeyboardButton(text=f"📄 по {page_size}", callback_data="fm_psize"),
+          InlineKeyboardButton(text="✖️ Фильтр" if view.get('filter') else "🔎 Фильтр",
+                               callback_data="fm_filter_clear" if view.get('filter') else "fm_filter"),
+          InlineKeyboardButton(text="🔄", callback_data="fm_refresh"))
     b.row(InlineKeyboardButton(text="⬅️ Выход из Файл-менеджера", callback_data=f"manage_server:{server_id}"))
     return b.as_markup()
 
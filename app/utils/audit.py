@@ -0,0 +1,123 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+from datetime import datetime
+
+import asyncpg
+
+from utils.metrics import Counter, Gauge
+
+# Журнал действий пользователей в activity_logs. Хендлер не ждет БД: audit.log() только кладет
+# запись в очередь в памяти, а фоновая задача пишет очередь пачками (COPY) — когда набралось
+# AUDIT_BATCH_SIZE записей или прошло AUDIT_FLUSH_INTERVAL секунд. Если БД недоступна, записи
+# остаются в очереди до следующей попытки; при переполнении очереди самые новые записи
+# отбрасываются (со счетчиком в метриках), чтобы журнал не съел память процесса.
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', 2.0))  # сек. между записями пачки
+AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', 500))            # записей в одном COPY
+AUDIT_QUEUE_LIMIT = int(os.getenv('AUDIT_QUEUE_LIMIT', 20000))        # записей в очереди, дальше — отбрасываются
+AUDIT_DETAILS_LIMIT = 2000                                            # символов в поле details
+AUDIT_VALUE_LIMIT = 500                                               # символов строки (элементов списка) в урезанных details
+AUDIT_DRAIN_TIMEOUT = 10.0                                            # сек. на запись остатка при остановке
+
+_COLUMNS = ('user_id', 'action', 'details', 'timestamp')
+_INSERT_SQL = """
+    INSERT INTO activity_logs (user_id, action, details, timestamp)
+    SELECT $1, $2, $3, $4 WHERE $1::int IS NULL OR EXISTS (SELECT 1 FROM users WHERE id = $1)"""
+
+AUDIT_EVENTS = Counter('audit_events_total', "Записи журнала действий: written, dropped (переполнение очереди).", ('result',))
+
+def _details_json(details: dict) -> str:
+    """details в JSON не длиннее AUDIT_DETAILS_LIMIT. Урезаются сами значения (длинная команда,
+    список серверов), а не готовый текст — иначе в activity_logs попадет невалидный JSON."""
+    text = json.dumps(details, ensure_ascii=False, default=str)
+    if len(text) <= AUDIT_DETAILS_LIMIT:
+        return text
+    short = {}
+    for key, value in details.items():
+        if isinstance(value, str) and len(value) > AUDIT_VALUE_LIMIT:
+            value = value[:AUDIT_VALUE_LIMIT] + '…'
+        elif isinstance(value, (list, tuple)) and len(value) > AUDIT_VALUE_LIMIT // 10:
+            value = list(value[:AUDIT_VALUE_LIMIT // 10])
+        short[key] = value
+    short['truncated'] = True
+    text = json.dumps(short, ensure_ascii=False, default=str)
+    if len(text) <= AUDIT_DETAILS_LIMIT:
+        return text
+    return json.dumps({'truncated': True, 'keys': sorted(details)[:20]}, ensure_ascii=False)
+
+class AuditLog:
+    def __init__(self, pool: asyncpg.Pool = None, batch_size: int = AUDIT_BATCH_SIZE,
+                 flush_interval: float = AUDIT_FLUSH_INTERVAL, queue_limit: int = AUDIT_QUEUE_LIMIT):
+        self.pool, self.batch_size, self.flush_interval = pool, batch_size, flush_interval
+        self.queue = collections.deque()
+        self.queue_limit = queue_limit
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def bind(self, pool: asyncpg.Pool) -> None:
+        self.pool = pool
+
+    def log(self, user_id: int, action: str, **details) -> None:
+        """Ставит запись в очередь и сразу возвращается. details сохраняются как JSON."""
+        if len(self.queue) >= self.queue_limit:
+            AUDIT_EVENTS.inc('dropped')
+            return
+        text = _details_json(details) if details else None
+        self.queue.append((user_id, action, text, datetime.now()))
+        if len(self.queue) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> int:
+        """Пишет одну пачку. При ошибке БД пачка возвращается в начало очереди. Возвращает число записанных."""
+        batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+        if not batch:
+            return 0
+        try:
+            async with self.pool.acquire() as conn:
+                try:
+                    await conn.copy_records_to_table('activity_logs', records=batch, columns=_COLUMNS)
+                except asyncpg.ForeignKeyViolationError:
+                    # Пользователя успели удалить: пишем построчно, пропуская его записи
+                    await conn.executemany(_INSERT_SQL, batch)
+        except BaseException:  # в том числе отмена при остановке: пачка не должна потеряться
+            self.queue.extendleft(reversed(batch))
+            raise
+        AUDIT_EVENTS.inc('written', amount=len(batch))
+        return len(batch)
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                while await self.flush() == self.batch_size:
+                    pass
+            except Exception as e:
+                logging.warning(f"Журнал действий: не удалось записать {len(self.queue)} записей, повтор позже: {e}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        """Останавливает фоновую запись и дописывает остаток очереди (не дольше AUDIT_DRAIN_TIMEOUT)."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await asyncio.wait_for(self._drain(), AUDIT_DRAIN_TIMEOUT)
+        except Exception as e:
+            logging.error(f"Журнал действий: при остановке потеряно записей: {len(self.queue)} ({e})")
+
+    async def _drain(self) -> None:
+        while self.queue:
+            await self.flush()
+
+audit = AuditLog()
+AUDIT_QUEUE = Gauge('audit_queue_size', "Записей журнала в очереди на запись.", collect=lambda: {(): len(audit.queue)})
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import os
+import time
+
+import asyncpg
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+# Telegram пропускает около 30 сообщений в секунду на бота (разным чатам) и около
+# одного сообщения в секунду в один чат. В рассылке каждый чат получает одно сообщение,
+# поэтому ограничиваем общий поток, а правки сообщения с прогрессом — отдельно.
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))            # сообщений в секунду
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 10))  # одновременных запросов к API
+BROADCAST_BATCH_SIZE = 100           # пользователей за одну выборку; после пачки прогресс сохраняется в БД
+BROADCAST_PROGRESS_INTERVAL = 3.0    # сек. между правками сообщения с прогрессом
+BROADCAST_STALE_AFTER = 300          # сек. без heartbeat, после которых рассылку может подхватить другой процесс
+
+class TokenBucket:
+    """Token bucket: в среднем `rate` операций в секунду, всплеск до `capacity`."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        """Останавливает выдачу токенов (Telegram ответил RetryAfter — ждать должны все)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class BroadcastRunner:
+    """Фоновые рассылки с сохранением прогресса в таблице `broadcasts`.
+
+    Пользователи перебираются пачками по `users.id`; после каждой пачки в БД пишутся
+    счетчики и курсор `last_user_id`, поэтому после перезапуска рассылка продолжается
+    с места остановки (повторно могут получить сообщение только пользователи из
+    незавершенной пачки). Заблокировавшие бота помечаются `users.is_blocked` и
+    в следующих рассылках пропускаются.
+    """
+
+    def __init__(self, bot: Bot, pool: asyncpg.Pool, rate: float = BROADCAST_RATE,
+                 concurrency: int = BROADCAST_CONCURRENCY, progress_markup=None):
+        self.bot, self.pool = bot, pool
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.progress_markup = progress_markup
+        self._tasks = {}
+
+    async def create(self, admin_chat_id: int, from_chat_id: int, message_id: int) -> int:
+        """Создает рассылку, отправляет сообщение с прогрессом и запускает ее в фоне."""
+        async with self.pool.acquire() as conn:
+            total = await conn.fetchval("SELECT COUNT(*) FROM users WHERE NOT is_blocked")
+            job_id = await conn.fetchval(
+                "INSERT INTO broadcasts (admin_chat_id, from_chat_id, message_id, total) VALUES ($1, $2, $3, $4) RETURNING id",
+                admin_chat_id, from_chat_id, message_id, total)
+        progress = await self.bot.send_message(admin_chat_id, f"📨 Рассылка #{job_id} запущена. Получателей: {total}")
+        async with self.pool.acquire() as conn:
+            await conn.execute("UPDATE broadcasts SET progress_message_id = $1 WHERE id = $2", progress.message_id, job_id)
+        self._launch(job_id)
+        return job_id
+
+    async def resume_unfinished(self) -> None:
+        """Подхватывает рассылки, прерванные перезапуском (heartbeat давно не обновлялся)."""
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                f"""UPDATE broadcasts SET heartbeat_at = NOW()
+                    WHERE status = 'running' AND heartbeat_at < NOW() - INTERVAL '{BROADCAST_STALE_AFTER} seconds'
+                    RETURNING id""")
+        for row in rows:
+            logging.info(f"Возобновляю рассылку #{row['id']}")
+            self._launch(row['id'])
+
+    def _launch(self, job_id: int) -> None:
+        if job_id not in self._tasks:
+            task = asyncio.create_task(self._run(job_id))
+            self._tasks[job_id] = task
+            task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _send(self, telegram_id: int, from_chat_id: int, message_id: int) -> str:
+        for _ in range(5):
+            await self.bucket.acquire()
+            try:
+                await self.bot.copy_message(chat_id=telegram_id, from_chat_id=from_chat_id, message_id=message_id)
+                return 'sent'
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except TelegramForbiddenError:
+                return 'blocked'
+            except TelegramBadRequest as e:
+                return 'blocked' if 'chat not found' in str(e).lower() else 'failed'
+            except Exception as e:
+                logging.warning(f"Рассылка: не удалось отправить сообщение {telegram_id}: {e}")
+                return 'failed'
+        return 'failed'
+
+    @staticmethod
+    def _progress_text(job: dict, done: bool = False) -> str:
+        processed = job['sent'] + job['failed'] + job['blocked']
+        head = f"🏁 Рассылка #{job['id']} завершена!" if done else f"📨 Рассылка #{job['id']}: {processed}/{job['total']}"
+        return (f"{head}\n\n✅ Успешно отправлено: {job['sent']}\n"
+                f"❌ Ошибок: {job['failed']}\n🚫 Заблокировали бота: {job['blocked']}")
+
+    async def _update_progress(self, job: dict, done: bool = False) -> None:
+        if not job['progress_message_id']:
+            return
+        try:
+            await self.bot.edit_message_text(self._progress_text(job, done), chat_id=job['admin_chat_id'],
+                                             message_id=job['progress_message_id'],
+                                             reply_markup=self.progress_markup if done else None)
+        except TelegramRetryAfter:
+            pass
+        except TelegramBadRequest as e:
+            if 'message is not modified' not in str(e):
+                logging.warning(f"Рассылка #{job['id']}: не удалось обновить прогресс: {e}")
+
+    async def _run(self, job_id: int) -> None:
+        try:
+            async with self.pool.acquire() as conn:
+                job = dict(await conn.fetchrow("SELECT * FROM broadcasts WHERE id = $1", job_id))
+            semaphore = asyncio.Semaphore(self.concurrency)
+            next_progress_at = 0.0
+
+            async def send_limited(row):
+                async with semaphore:
+                    return await self._send(row['telegram_id'], job['from_chat_id'], job['message_id'])
+
+            while True:
+                async with self.pool.acquire() as conn:
+                    rows = await conn.fetch(
+                        "SELECT id, telegram_id FROM users WHERE id > $1 AND NOT is_blocked ORDER BY id LIMIT $2",
+                        job['last_user_id'], BROADCAST_BATCH_SIZE)
+                if not rows:
+                    break
+                results = await asyncio.gather(*[send_limited(row) for row in rows])
+                blocked_ids = [row['id'] for row, res in zip(rows, results) if res == 'blocked']
+                job['last_user_id'] = rows[-1]['id']
+                for key in ('sent', 'failed', 'blocked'):
+                    job[key] += results.count(key)
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        if blocked_ids:
+                            await conn.execute("UPDATE users SET is_blocked = TRUE WHERE id = ANY($1::int[])", blocked_ids)
+                        await conn.execute(
+                            """UPDATE broadcasts SET last_user_id = $1, sent = $2, failed = $3, blocked = $4,
+                               heartbeat_at = NOW() WHERE id = $5""",
+                            job['last_user_id'], job['sent'], job['failed'], job['blocked'], job_id)
+                if time.monotonic() >= next_progress_at:
+                    await self._update_progress(job)
+                    next_progress_at = time.monotonic() + BROADCAST_PROGRESS_INTERVAL
+
+            async with self.pool.acquire() as conn:
+                await conn.execute("UPDATE broadcasts SET status = 'done', finished_at = NOW() WHERE id = $1", job_id)
+            await self._update_progress(job, done=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Рассылка #{job_id} прервана ошибкой: {e}")
+
+    async def stop(self) -> None:
+        """Останавливает фоновые рассылки; в БД они остаются 'running' и продолжатся после запуска."""
+        job_ids, tasks = list(self._tasks), list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if job_ids:
+            # Сбрасываем heartbeat, чтобы следующий запуск сразу подхватил рассылки
+            async with self.pool.acquire() as conn:
+                await conn.execute("UPDATE broadcasts SET heartbeat_at = NOW() - INTERVAL '1 day' WHERE id = ANY($1::int[])", job_ids)
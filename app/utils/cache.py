@@ -0,0 +1,48 @@
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+class TTLCache:
+    """Небольшой in-process кеш: LRU с ограничением размера и временем жизни записей.
+
+    Не потокобезопасен — рассчитан на использование из одного event loop.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None) -> None:
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, _MISSING)
+        return default if item is _MISSING else item[1]
+
+    def invalidate_where(self, predicate) -> int:
+        """Удаляет записи, для которых predicate(key, value) истинно. Возвращает их число."""
+        keys = [k for k, (_, v) in self._data.items() if predicate(k, v)]
+        for key in keys:
+            del self._data[key]
+        return len(keys)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
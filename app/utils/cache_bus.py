@@ -0,0 +1,101 @@
+import asyncio
+import json
+import logging
+import uuid
+
+import asyncpg
+
+# Межпроцессный сброс кешей. Строки users/servers (с расшифрованным паролем) и листинги
+# каталогов кешируются в памяти каждого процесса бота, а FSM общий, поэтому апдейты одного
+# пользователя обрабатывают разные процессы. Процесс, изменивший данные, сбрасывает свой кеш
+# сразу и публикует сообщение через PostgreSQL NOTIFY; остальные получают его по LISTEN на
+# отдельном соединении и сбрасывают то же у себя. Пока подписка не работает (обрыв соединения),
+# устаревание ограничено TTL кешей; после переподключения кеши сбрасываются целиком —
+# сообщения за время обрыва потеряны.
+CACHE_CHANNEL = 'kds_cache_invalidate'
+CACHE_RECONNECT_DELAY = 5  # сек. до повторного подключения слушателя
+CACHE_PING_INTERVAL = 30   # сек. между проверками соединения слушателя
+CACHE_MAX_IDS = 200        # id в одном сообщении (NOTIFY ограничен ~8000 байт); больше — сброс целиком
+
+class CacheBus:
+    """on_message(kind, data) — корутина, применяющая сброс в этом процессе;
+    on_reset() — сброс всех кешей, когда сообщения могли потеряться."""
+
+    def __init__(self, on_message, on_reset):
+        self.on_message, self.on_reset = on_message, on_reset
+        self.origin = uuid.uuid4().hex  # свои сообщения процесс пропускает: он уже сбросил кеш
+        self.pool, self.connect = None, None
+        self._queue = asyncio.Queue()
+        self._tasks = []
+        self._handlers = set()
+
+    def bind(self, pool: asyncpg.Pool, connect) -> None:
+        """connect() — корутина, открывающая отдельное соединение для LISTEN (не из пула)."""
+        self.pool, self.connect = pool, connect
+
+    def publish(self, kind: str, **data) -> None:
+        """Сообщает остальным процессам о сбросе. Не ждет БД; без запущенной шины ничего не делает."""
+        if self._tasks:
+            self._queue.put_nowait(json.dumps({'origin': self.origin, 'kind': kind, **data}))
+
+    def _on_notify(self, conn, pid, channel, payload) -> None:
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+        if message.pop('origin', None) == self.origin:
+            return
+        task = asyncio.create_task(self._apply(message.pop('kind', None), message))
+        self._handlers.add(task)
+        task.add_done_callback(self._handlers.discard)
+
+    async def _apply(self, kind: str, data: dict) -> None:
+        try:
+            await self.on_message(kind, data)
+        except Exception as e:
+            logging.error(f"Кеш: не удалось применить сброс {kind}: {e}")
+
+    async def _send_loop(self) -> None:
+        while True:
+            payloads = [await self._queue.get()]
+            while not self._queue.empty():
+                payloads.append(self._queue.get_nowait())
+            try:
+                async with self.pool.acquire() as conn:
+                    await conn.executemany("SELECT pg_notify($1, $2)", [(CACHE_CHANNEL, p) for p in payloads])
+            except Exception as e:
+                logging.error(f"Кеш: не удалось разослать сброс ({len(payloads)} сообщ.), действует TTL: {e}")
+
+    async def _listen_loop(self) -> None:
+        while True:
+            conn = None
+            try:
+                conn = await self.connect()
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda _: lost.set())
+                await conn.add_listener(CACHE_CHANNEL, self._on_notify)
+                self.on_reset()
+                while not lost.is_set():
+                    try:
+                        await asyncio.wait_for(lost.wait(), CACHE_PING_INTERVAL)
+                    except asyncio.TimeoutError:
+                        await asyncio.wait_for(conn.fetchval("SELECT 1"), CACHE_PING_INTERVAL)
+                logging.warning("Кеш: соединение слушателя закрыто, переподключаюсь")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Кеш: слушатель сбросов недоступен: {e}")
+            finally:
+                if conn is not None and not conn.is_closed():
+                    conn.terminate()
+            await asyncio.sleep(CACHE_RECONNECT_DELAY)
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._send_loop()), asyncio.create_task(self._listen_loop())]
+
+    async def stop(self) -> None:
+        for task in self._tasks + list(self._handlers):
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._handlers, return_exceptions=True)
+        self._tasks = []
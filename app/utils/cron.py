@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+
+# Разбор cron-выражений из пяти полей: минута, час, день месяца, месяц, день недели.
+# Поддерживаются *, числа, диапазоны a-b, шаг */n и a-b/n, списки через запятую
+# и сокращения @hourly, @daily, @weekly, @monthly. Как в cron, если ограничены и день месяца,
+# и день недели, срабатывает любое из условий. Время — локальное время процесса бота.
+ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+}
+_FIELDS = (('минута', 0, 59), ('час', 0, 23), ('день месяца', 1, 31), ('месяц', 1, 12), ('день недели', 0, 7))
+_SEARCH_LIMIT_DAYS = 366 * 9  # 29 февраля может не встретиться до 8 лет (2096 -> 2104)
+
+class CronError(ValueError):
+    """Некорректное выражение. Текст ошибки можно показывать пользователю."""
+
+def _parse_field(text: str, title: str, low: int, high: int) -> frozenset:
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            if not step_text.isdigit() or int(step_text) == 0:
+                raise CronError(f"{title}: неверный шаг '{step_text}'")
+            step = int(step_text)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start_text, end_text = part.split('-', 1)
+            if not (start_text.isdigit() and end_text.isdigit()):
+                raise CronError(f"{title}: неверный диапазон '{part}'")
+            start, end = int(start_text), int(end_text)
+        elif part.isdigit():
+            start = end = int(part)
+            if step > 1:
+                end = high  # "5/15" — с 5-й каждые 15
+        else:
+            raise CronError(f"{title}: неверное значение '{part}'")
+        if not (low <= start <= high and low <= end <= high):
+            raise CronError(f"{title}: значение вне диапазона {low}-{high}")
+        if start > end:
+            raise CronError(f"{title}: начало диапазона больше конца '{part}'")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+class CronSchedule:
+    def __init__(self, expression: str):
+        self.expression = ' '.join(expression.split())
+        fields = ALIASES.get(self.expression.lower(), self.expression).split()
+        if len(fields) != 5:
+            raise CronError("Нужно 5 полей: минута час день месяц день_недели (например, 30 3 * * *).")
+        parsed = [_parse_field(text, *spec) for text, spec in zip(fields, _FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        self.weekdays = frozenset(d % 7 for d in weekdays)  # 7 — тоже воскресенье
+        self.any_day, self.any_weekday = fields[2] == '*', fields[4] == '*'
+
+    def _day_matches(self, dt: datetime) -> bool:
+        day_ok = dt.day in self.days
+        weekday_ok = (dt.weekday() + 1) % 7 in self.weekdays  # в cron 0 — воскресенье
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, dt: datetime) -> datetime:
+        """Ближайшее время срабатывания строго после dt (с точностью до минуты)."""
+        current = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=_SEARCH_LIMIT_DAYS)
+        while current <= limit:
+            if current.month not in self.months:
+                current = (current.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(current):
+                current = current.replace(hour=0, minute=0) + timedelta(days=1)
+            elif current.hour not in self.hours:
+                current = current.replace(minute=0) + timedelta(hours=1)
+            elif current.minute not in self.minutes:
+                current += timedelta(minutes=1)
+            else:
+                return current
+        raise CronError("Выражение никогда не срабатывает.")
+
+    def min_interval(self, start: datetime, runs: int = 20) -> float:
+        """Наименьший интервал (сек.) между ближайшими runs срабатываниями — для ограничения частоты."""
+        times = [self.next_after(start)]
+        for _ in range(runs - 1):
+            times.append(self.next_after(times[-1]))
+        return min((b - a).total_seconds() for a, b in zip(times, times[1:]))
+
+    def __str__(self) -> str:
+        return self.expression
@@ -0,0 +1,90 @@
+import gzip
+from datetime import datetime
+from typing import NamedTuple
+
+import asyncpg
+
+from utils.transfers import TELEGRAM_UPLOAD_LIMIT
+
+# Экспорт таблиц администратором. Строки идут из PostgreSQL через COPY (...) TO STDOUT прямо
+# в gzip во временном файле: в памяти бота одновременно лежит только очередной кусок потока.
+# Колонки, которые нельзя выгружать, заменяются в самом запросе. Инкрементальный экспорт берет
+# строки с id больше, чем в прошлом экспорте этой таблицы (таблицы без updated_at, поэтому
+# в инкремент попадают только новые строки, а не изменения старых).
+EXPORT_MAX_SIZE = TELEGRAM_UPLOAD_LIMIT  # байт сжатого файла — больше Telegram не примет
+EXPORT_GZIP_LEVEL = 6
+
+# $1 < id <= $2
+EXPORT_TABLES = {
+    'users': "SELECT * FROM users WHERE id > $1 AND id <= $2 ORDER BY id",
+    'servers': """
+        SELECT s.id, s.user_id, s.name, s.ip, s.port, s.login_user, '***ENCRYPTED***' AS password_encrypted,
+               s.created_at, s.is_active, u.telegram_id AS owner_telegram_id
+        FROM servers s LEFT JOIN users u ON s.user_id = u.id
+        WHERE s.id > $1 AND s.id <= $2 ORDER BY s.id""",
+}
+
+class ExportError(Exception):
+    """Экспорт не удался по понятной причине. Текст ошибки можно показывать пользователю."""
+
+class ExportResult(NamedTuple):
+    table: str
+    incremental: bool
+    from_id: int
+    last_id: int
+    rows: int
+    size: int
+
+    @property
+    def filename(self) -> str:
+        suffix = f"_after{self.from_id}" if self.incremental else ''
+        return f"{self.table}_{datetime.now():%Y%m%d}{suffix}.csv.gz"
+
+class _GzipSpool:
+    """Приемник COPY: сжимает поток в файл и следит за размером."""
+
+    def __init__(self, path: str, reserve):
+        self.file = open(path, 'wb')
+        self.gzip = gzip.GzipFile(fileobj=self.file, mode='wb', compresslevel=EXPORT_GZIP_LEVEL)
+        self.reserve = reserve
+
+    async def write(self, chunk: bytes) -> None:
+        self.gzip.write(chunk)
+        size = self.file.tell()
+        if size > EXPORT_MAX_SIZE:
+            raise ExportError(f"Файл больше {EXPORT_MAX_SIZE // (1024 * 1024)} МБ — выгрузите только новые строки.")
+        self.reserve(size)
+
+    def close(self) -> int:
+        self.gzip.close()
+        size = self.file.tell()
+        self.file.close()
+        return size
+
+async def last_exported_id(conn: asyncpg.Connection, table: str) -> int:
+    return await conn.fetchval("SELECT last_id FROM export_runs WHERE table_name = $1 ORDER BY id DESC LIMIT 1", table) or 0
+
+async def export_table(pool: asyncpg.Pool, table: str, path: str, incremental: bool = False, reserve=None) -> ExportResult:
+    """Выгружает таблицу в path (CSV с заголовком, gzip). reserve(size) вызывается по мере роста файла."""
+    reserve = reserve or (lambda size: None)
+    spool = _GzipSpool(path, reserve)
+    try:
+        async with pool.acquire() as conn:
+            # Граница и выгрузка из одного снимка: строки, добавленные во время экспорта, попадут в следующий
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                from_id = await last_exported_id(conn, table) if incremental else 0
+                last_id = await conn.fetchval(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+                status = await conn.copy_from_query(EXPORT_TABLES[table], from_id, last_id, output=spool.write,
+                                                    format='csv', header=True)
+    finally:
+        size = spool.close()
+    reserve(size)
+    return ExportResult(table, incremental, from_id, max(last_id, from_id), int(status.split()[-1]), size)
+
+async def record_export(pool: asyncpg.Pool, result: ExportResult) -> None:
+    """Запоминает границу экспорта. Вызывать после того, как файл доставлен."""
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "INSERT INTO export_runs (table_name, incremental, from_id, last_id, row_count, size_bytes) "
+            "VALUES ($1, $2, $3, $4, $5, $6)",
+            result.table, result.incremental, result.from_id, result.last_id, result.rows, result.size)
@@ -0,0 +1,124 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import asyncssh
+
+from utils.metrics import SSH_SECONDS
+from utils.ssh import ssh_pool
+
+# Одна команда сразу на нескольких серверах. Серверы обрабатываются параллельно
+# (не больше FANOUT_CONCURRENCY одновременно), у каждого свой таймаут, а результаты
+# отдаются по мере завершения, чтобы медленный сервер не задерживал остальные.
+FANOUT_CONCURRENCY = int(os.getenv('FANOUT_CONCURRENCY', 10))       # серверов одновременно в одном запуске
+FANOUT_TIMEOUT = float(os.getenv('FANOUT_TIMEOUT', 60))             # сек. на команду на одном сервере
+FANOUT_MAX_OUTPUT = int(os.getenv('FANOUT_MAX_OUTPUT', 64 * 1024))  # символов вывода, сохраняемых с одного сервера
+_READ_SIZE = 16 * 1024
+
+@dataclass
+class HostResult:
+    server_id: int
+    name: str
+    exit_status: Optional[int] = None  # None — команда не выполнилась или не завершилась (см. error)
+    output: str = ''
+    duration: float = 0.0
+    error: Optional[str] = None
+    truncated: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.exit_status == 0
+
+    def describe(self) -> str:
+        """Короткая строка результата: код выхода (или ошибка) и время."""
+        code = '?' if self.exit_status is None else self.exit_status  # сервер может не сообщить код выхода
+        status = f"ошибка: {self.error}" if self.error else f"код {code}"
+        return f"{status} · {self.duration:.1f} с"
+
+async def _read_output(process) -> tuple:
+    """Читает вывод процесса до конца, сохраняя не больше FANOUT_MAX_OUTPUT символов."""
+    chunks, kept, truncated = [], 0, False
+    while True:
+        chunk = await process.stdout.read(_READ_SIZE)
+        if not chunk:
+            return ''.join(chunks), truncated
+        if kept < FANOUT_MAX_OUTPUT:
+            chunk = chunk[:FANOUT_MAX_OUTPUT - kept]
+            chunks.append(chunk)
+            kept += len(chunk)
+        else:
+            truncated = True  # остаток дочитываем, но не храним
+
+async def run_on_host(server: dict, command: str, timeout: float = FANOUT_TIMEOUT) -> HostResult:
+    """Выполняет команду на одном сервере. server — строка с id, name, ip, port, login_user и расшифрованным 'password'."""
+    result = HostResult(server['id'], server['name'])
+    started = time.monotonic()
+    try:
+        if server.get('password') is None:
+            raise ValueError("не удалось расшифровать пароль")
+        async with ssh_pool.connection(server['ip'], server['port'], server['login_user'], server['password'],
+                                       server['id']) as conn:
+            async with conn.create_process(command, stderr=asyncssh.STDOUT, errors='replace') as process:
+                result.output, result.truncated = await asyncio.wait_for(_read_output(process), timeout)
+                await asyncio.wait_for(process.wait_closed(), max(timeout - (time.monotonic() - started), 1))
+                result.exit_status = process.exit_status
+                if process.exit_signal:
+                    result.error = f"прервано сигналом {process.exit_signal[0]}"
+    except asyncio.TimeoutError:
+        result.error = f"таймаут ({timeout:g} с)"
+    except (OSError, asyncssh.Error, ValueError) as e:
+        result.error = str(e) or type(e).__name__
+    result.output = result.output.strip()
+    result.duration = time.monotonic() - started
+    SSH_SECONDS.observe(result.duration, 'exec', 'run_on_host', 'ok' if result.error is None else 'error')
+    return result
+
+async def fan_out(servers: list, command: str, concurrency: int = FANOUT_CONCURRENCY, timeout: float = FANOUT_TIMEOUT):
+    """Асинхронный генератор HostResult в порядке завершения.
+
+    При закрытии генератора (например, пользователь прервал запуск) незавершенные команды отменяются.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(server):
+        async with semaphore:
+            return await run_on_host(server, command, timeout)
+
+    tasks = [asyncio.create_task(run(server)) for server in servers]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def group_results(results: list) -> list:
+    """Группирует серверы с одинаковым выводом (или одинаковой ошибкой). Самые большие группы — первыми.
+    Возвращает [(вывод или текст ошибки, is_error, [HostResult])]."""
+    groups = {}
+    for r in results:
+        key = (r.error is not None, r.error or r.output)
+        groups.setdefault(key, []).append(r)
+    ordered = sorted(groups.items(), key=lambda item: (item[0][0], -len(item[1])))
+    return [(text, is_error, sorted(hosts, key=lambda r: r.name)) for (is_error, text), hosts in ordered]
+
+def summarize(results: list, total: int) -> str:
+    ok = sum(1 for r in results if r.ok)
+    failed = sum(1 for r in results if r.error)
+    return (f"Серверов: {total} · код 0: {ok} · другой код: {len(results) - ok - failed} · "
+            f"ошибок: {failed} · не выполнено: {total - len(results)}")
+
+def format_report(command: str, results: list, total: int) -> str:
+    """Текстовый отчет: сводка и группы одинаковых выводов со списком серверов, кодов выхода и времени."""
+    lines = [f"$ {command}", summarize(results, total), ""]
+    for number, (text, is_error, hosts) in enumerate(group_results(results), 1):
+        title = "Ошибка" if is_error else "Вывод"
+        lines.append(f"=== {title} #{number} · серверов: {len(hosts)} ===")
+        lines.extend(f"  {r.name}: {r.describe()}" + (" (вывод обрезан)" if r.truncated else "") for r in hosts)
+        if not is_error:
+            lines += ["---", text or "(нет вывода)"]
+        lines.append("")
+    return "\n".join(lines)
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, Optional
+
+import asyncpg
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+# Где хранить состояния FSM: postgres (по умолчанию), redis или memory (только один процесс бота).
+# Состояния в БД/Redis переживают перезапуск и общие для нескольких воркеров за балансировщиком.
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'postgres').lower()
+FSM_REDIS_URL = os.getenv('FSM_REDIS_URL', 'redis://localhost:6379/0')
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', 24 * 3600))  # сек. без изменений, после которых состояние забывается
+FSM_PURGE_INTERVAL = 600                                     # сек. между удалениями просроченных строк
+
+def _dumps(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+def _state_name(state: StateType) -> Optional[str]:
+    return state.state if isinstance(state, State) else state
+
+class PostgresStorage(BaseStorage):
+    """FSM-хранилище в таблице `fsm_states` на общем пуле asyncpg.
+
+    Одна строка на ключ (бот, чат, пользователь, тред, destiny): состояние и данные в jsonb.
+    Строка без состояния и данных удаляется; строки, не менявшиеся дольше `ttl`, считаются
+    пустыми и периодически вычищаются фоновой задачей.
+    """
+
+    def __init__(self, pool: asyncpg.Pool = None, ttl: int = FSM_STATE_TTL):
+        self.pool, self.ttl = pool, ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._purge_task = None
+
+    def bind(self, pool: asyncpg.Pool) -> None:
+        """Пул создается в main(), а Dispatcher — при импорте, поэтому пул передается позже."""
+        self.pool = pool
+
+    def _fresh(self) -> str:
+        """SQL-условие "строка не просрочена" для ON CONFLICT: просроченные поля считаются пустыми."""
+        return f"fsm_states.updated_at > NOW() - INTERVAL '{self.ttl} seconds'"
+
+    async def _get_row(self, key: StorageKey) -> Optional[asyncpg.Record]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow(
+                f"SELECT state, data FROM fsm_states WHERE key = $1 AND updated_at > NOW() - INTERVAL '{self.ttl} seconds'",
+                self.key_builder.build(key))
+
+    async def _drop_if_empty(self, conn: asyncpg.Connection, key: str) -> None:
+        # Пустую запись не храним: clear() = set_state(None) + set_data({}) удаляет строку
+        await conn.execute("DELETE FROM fsm_states WHERE key = $1 AND state IS NULL AND data = '{}'::jsonb", key)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        key = self.key_builder.build(key)
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                f"""INSERT INTO fsm_states (key, state) VALUES ($1, $2)
+                    ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state, updated_at = NOW(),
+                        data = CASE WHEN {self._fresh()} THEN fsm_states.data ELSE '{{}}'::jsonb END""",
+                key, _state_name(state))
+            if state is None:
+                await self._drop_if_empty(conn, key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._get_row(key)
+        return row['state'] if row else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        key = self.key_builder.build(key)
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                f"""INSERT INTO fsm_states (key, data) VALUES ($1, $2::jsonb)
+                    ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data, updated_at = NOW(),
+                        state = CASE WHEN {self._fresh()} THEN fsm_states.state END""",
+                key, _dumps(data))
+            if not data:
+                await self._drop_if_empty(conn, key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._get_row(key)
+        return json.loads(row['data']) if row else {}
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        # Слияние на стороне БД (jsonb ||) — одним запросом и без гонки между воркерами
+        async with self.pool.acquire() as conn:
+            merged = await conn.fetchval(
+                f"""INSERT INTO fsm_states (key, data) VALUES ($1, $2::jsonb)
+                    ON CONFLICT (key) DO UPDATE SET updated_at = NOW(),
+                        data = CASE WHEN {self._fresh()} THEN fsm_states.data ELSE '{{}}'::jsonb END || EXCLUDED.data,
+                        state = CASE WHEN {self._fresh()} THEN fsm_states.state END
+                    RETURNING data""",
+                self.key_builder.build(key), _dumps(data))
+        return json.loads(merged)
+
+    async def purge_expired(self) -> int:
+        async with self.pool.acquire() as conn:
+            result = await conn.execute(
+                f"DELETE FROM fsm_states WHERE updated_at < NOW() - INTERVAL '{self.ttl} seconds'")
+        return int(result.split()[-1])
+
+    async def _purge_loop(self) -> None:
+        while True:
+            await asyncio.sleep(FSM_PURGE_INTERVAL)
+            try:
+                removed = await self.purge_expired()
+                if removed:
+                    logging.info(f"FSM: удалено просроченных состояний: {removed}")
+            except Exception as e:
+                logging.warning(f"FSM: не удалось удалить просроченные состояния: {e}")
+
+    def start(self) -> None:
+        if self._purge_task is None:
+            self._purge_task = asyncio.create_task(self._purge_loop())
+
+    async def close(self) -> None:
+        # Пул принадлежит приложению и закрывается в main()
+        if self._purge_task:
+            self._purge_task.cancel()
+            await asyncio.gather(self._purge_task, return_exceptions=True)
+            self._purge_task = None
+
+def create_fsm_storage(kind: str = FSM_STORAGE) -> BaseStorage:
+    """Создает хранилище по FSM_STORAGE. Redis-бэкенд требует пакет `redis` и импортируется только при выборе."""
+    if kind == 'redis':
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(FSM_REDIS_URL, key_builder=DefaultKeyBuilder(with_destiny=True),
+                                     state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL, json_dumps=_dumps)
+    if kind == 'memory':
+        return MemoryStorage()
+    if kind != 'postgres':
+        raise ValueError(f"Неизвестное FSM_STORAGE: {kind}")
+    return PostgresStorage()
@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+import asyncpg
+
+from utils.cache import TTLCache
+
+# Постраничные списки админ-панели без OFFSET. Страница выбирается по ключу сортировки
+# последней (или первой) строки предыдущей страницы: WHERE (k1, k2) > ($1, $2) ORDER BY k1, k2 LIMIT n.
+# Такой запрос идет по индексу сразу к нужному месту, сколько бы страниц ни было перед ним,
+# и строки, добавленные или удаленные во время листания, не сдвигают соседние страницы.
+# Ключ должен быть уникальным (последняя колонка — id). Курсор кодируется в callback_data,
+# поэтому значения — только числа и даты. Общее число строк кешируется на COUNT_TTL секунд.
+COUNT_TTL = 60
+_EPOCH = datetime(1970, 1, 1)
+
+_counts = TTLCache(maxsize=64, ttl=COUNT_TTL)
+
+def encode_cursor(values) -> str:
+    """Ключ строки -> короткая строка для callback_data (без ':')."""
+    parts = []
+    for value in values:
+        if isinstance(value, datetime):
+            parts.append(f"t{(value - _EPOCH) // timedelta(microseconds=1)}")
+        else:
+            parts.append(str(int(value)))
+    return ','.join(parts)
+
+def decode_cursor(text: str) -> tuple:
+    return tuple(_EPOCH + timedelta(microseconds=int(part[1:])) if part.startswith('t') else int(part)
+                 for part in text.split(','))
+
+def page_callback(prefix: str, page: int, cursor: str, backwards: bool = False) -> str:
+    return f"{prefix}:{page}:{'b' if backwards else 'a'}:{cursor}"
+
+def parse_page_callback(data: str) -> tuple:
+    """"<префикс>:<страница>[:a|b:<курсор>]" -> (страница, курсор, назад ли)."""
+    parts = data.split(':')
+    if len(parts) < 4:
+        return int(parts[1]), None, False
+    return int(parts[1]), parts[3], parts[2] == 'b'
+
+class KeysetPage(NamedTuple):
+    rows: list
+    page: int          # номер страницы с нуля (передается вместе с курсором, из запроса его не узнать)
+    pages: int         # по кешированному числу строк — может немного отставать
+    total: int
+    prev_cursor: str   # None на первой странице
+    next_cursor: str   # None на последней
+
+class KeysetListing:
+    """Постраничный список. query — SELECT ... FROM ... WHERE <условие> без ORDER BY и LIMIT;
+    key — выражения ключа сортировки (имя колонки в результате — часть после точки);
+    count_query — COUNT(*) с тем же условием."""
+
+    def __init__(self, name: str, query: str, key: tuple, count_query: str, descending: bool = False, per_page: int = 10):
+        self.name, self.query, self.key, self.count_query = name, query, tuple(key), count_query
+        self.descending, self.per_page = descending, per_page
+        self.fields = tuple(expr.rsplit('.', 1)[-1] for expr in self.key)
+
+    def _sql(self, backwards: bool, with_cursor: bool) -> str:
+        # Назад — тот же запрос в обратном порядке; строки потом разворачиваются
+        ascending = self.descending == backwards
+        order = ', '.join(f"{expr} {'ASC' if ascending else 'DESC'}" for expr in self.key)
+        sql = self.query
+        if with_cursor:
+            placeholders = ', '.join(f"${i + 1}" for i in range(len(self.key)))
+            sql += f" AND ({', '.join(self.key)}) {'>' if ascending else '<'} ({placeholders})"
+        return f"{sql} ORDER BY {order} LIMIT {self.per_page + 1}"
+
+    async def count(self, conn: asyncpg.Connection) -> int:
+        total = _counts.get(self.name)
+        if total is None:
+            total = await conn.fetchval(self.count_query)
+            _counts.set(self.name, total)
+        return total
+
+    async def fetch(self, pool: asyncpg.Pool, cursor: str = None, backwards: bool = False, page: int = 0) -> KeysetPage:
+        """Страница после cursor (или перед ним, если backwards). Без курсора — первая страница."""
+        values = decode_cursor(cursor) if cursor else ()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(self._sql(backwards and bool(values), bool(values)), *values)
+            total = await self.count(conn)
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards and values:
+            rows.reverse()
+            has_prev, has_next = more, True
+        else:
+            has_prev, has_next = bool(values), more
+        if not rows:
+            # Строки, на которые указывал курсор, удалили — начинаем сначала
+            return await self.fetch(pool) if values else KeysetPage([], 0, 1, 0, None, None)
+        first, last = (encode_cursor(rows[i][f] for f in self.fields) for i in (0, -1))
+        page = max(page, 0) if has_prev else 0
+        pages = max(-(-total // self.per_page), page + 1 + has_next)
+        return KeysetPage(rows, page, pages, total, first if has_prev else None, last if has_next else None)
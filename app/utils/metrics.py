@@ -0,0 +1,223 @@
+import asyncio
+import bisect
+import functools
+import os
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from aiogram.types import CallbackQuery
+from aiohttp import web
+
+# Метрики в текстовом формате Prometheus на GET /metrics того же aiohttp-приложения.
+# Без внешних зависимостей: счетчики и гистограммы — словари в памяти процесса, запись
+# метрики — поиск корзины и пара сложений, поэтому инструментирование можно не выключать.
+# Каждый процесс бота отдает свои метрики; если задан METRICS_TOKEN, нужен заголовок
+# Authorization: Bearer <токен>.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+LOOP_LAG_INTERVAL = 0.5  # сек. между замерами задержки event loop
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+REGISTRY = []
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _samples(self) -> list:
+        raise NotImplementedError
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self._samples()]
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labelvalues, amount: float = 1) -> None:
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def _samples(self) -> list:
+        return [f"{self.name}{_labels(self.labelnames, key)} {value}" for key, value in self._values.items()]
+
+class Gauge(_Metric):
+    """Значение задается set() или считается при каждом чтении: collect() -> {кортеж меток: значение}."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def set(self, value: float, *labelvalues) -> None:
+        self._values[labelvalues] = value
+
+    def _samples(self) -> list:
+        values = self.collect() if self.collect else self._values
+        return [f"{self.name}{_labels(self.labelnames, key)} {value}" for key, value in values.items()]
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labelvalues) -> None:
+        series = self._values.get(labelvalues)
+        if series is None:
+            # [счетчики по корзинам (последняя — +Inf), сумма, количество]
+            series = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def _samples(self) -> list:
+        lines = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+def render() -> str:
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', "Время обработки апдейта хендлером aiogram.",
+                            ('event', 'handler', 'prefix'))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', "Исключения, вышедшие из хендлеров.", ('event', 'handler'))
+SSH_SECONDS = Histogram('ssh_operation_seconds', "Длительность SSH-операций: connect, exec, sftp.",
+                        ('kind', 'operation', 'status'))
+TELEGRAM_SECONDS = Histogram('telegram_api_seconds', "Время запросов к Bot API.", ('method',))
+TELEGRAM_ERRORS = Counter('telegram_api_errors_total', "Ошибки Bot API по типу (TelegramRetryAfter — это 429).",
+                          ('method', 'error'))
+TELEGRAM_RETRY_AFTER = Counter('telegram_api_retry_after_seconds_total', "Сумма retry_after из ответов 429.", ('method',))
+HTTP_SECONDS = Histogram('http_request_seconds', "Время обработки HTTP-запросов веб-сервера (вебхуки).",
+                         ('method', 'route', 'status'))
+LOOP_LAG = Histogram('event_loop_lag_seconds', "Опоздание пробуждения event loop относительно таймера.",
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+DB_POOL = Gauge('db_pool_connections', "Соединения пула asyncpg.", ('state',))
+SSH_POOL = Gauge('ssh_pool_connections', "SSH-пул: открытые и устанавливаемые соединения, занятые каналы.", ('state',))
+
+def track_db_pool(pool) -> None:
+    DB_POOL.collect = lambda: {('in_use',): pool.get_size() - pool.get_idle_size(), ('idle',): pool.get_idle_size(),
+                               ('max',): pool.get_max_size()}
+
+def track_ssh_pool(pool) -> None:
+    SSH_POOL.collect = lambda: {(state,): value for state, value in pool.stats().items()}
+
+def ssh_operation(kind: str, operation: str = None):
+    """Декоратор SSH-функций: время и исход. Для функций, возвращающих (bool, ...), исход берется из флага."""
+    def decorator(func):
+        name = operation or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started, status = time.perf_counter(), 'error'
+            try:
+                result = await func(*args, **kwargs)
+                if not (isinstance(result, tuple) and result and result[0] is False):
+                    status = 'ok'
+                return result
+            finally:
+                SSH_SECONDS.observe(time.perf_counter() - started, kind, name, status)
+        return wrapper
+    return decorator
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware (dp.message.middleware / dp.callback_query.middleware): время каждого хендлера."""
+
+    def __init__(self, event: str):
+        self.event = event
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else 'unknown'
+        prefix = event.data.split(':', 1)[0][:32] if isinstance(event, CallbackQuery) and event.data else ''
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(self.event, name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, self.event, name, prefix)
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота (bot.session.middleware): время запросов к Bot API и ошибки, включая 429."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            TELEGRAM_ERRORS.inc(name, 'TelegramRetryAfter')
+            TELEGRAM_RETRY_AFTER.inc(name, amount=e.retry_after)
+            raise
+        except TelegramAPIError as e:
+            TELEGRAM_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, name)
+
+@web.middleware
+async def http_metrics_middleware(request: web.Request, handler):
+    started, status = time.perf_counter(), 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        # Маршрут, а не путь: неизвестные адреса не плодят новые ряды метрик
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource else 'unmatched'
+        HTTP_SECONDS.observe(time.perf_counter() - started, request.method, route, str(status))
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=401)
+    return web.Response(body=render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+class LoopLagMonitor:
+    """Раз в LOOP_LAG_INTERVAL засыпает на таймере и замеряет, насколько позже проснулся.
+    Большое опоздание значит, что event loop заблокирован синхронным кодом."""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG.observe(max(time.perf_counter() - started - self.interval, 0.0))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
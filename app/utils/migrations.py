@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import os
+import re
+
+import asyncpg
+
+# Схема из db/create_tables.sql применяется docker-entrypoint только на пустом томе.
+# Все последующие изменения схемы — это файлы db/migrations/NNNN_описание.sql:
+# при старте бота непримененные миграции выполняются по порядку, каждая в своей
+# транзакции, а номер примененной миграции записывается в schema_migrations.
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'db', 'migrations')
+_MIGRATION_RE = re.compile(r'^(\d{4})_(\w+)\.sql$')
+_LOCK_ID = 7_204_118  # ключ pg_advisory_lock: миграции не выполняются двумя процессами одновременно
+
+# Горячие запросы и индексы, которые они должны использовать (проверка через EXPLAIN)
+HOT_QUERY_PLANS = {
+    'get_user_servers': ("SELECT id, name, ip, port FROM servers WHERE user_id = 1 ORDER BY name", 'idx_servers_user_id_name'),
+    'confirm_payment': ("SELECT * FROM subscriptions WHERE provider = 'x' AND payment_id = 'x' AND status = 'pending'",
+                        'idx_subscriptions_payment_id'),
+    'payment_events_pending': ("SELECT id FROM payment_events WHERE processed_at IS NULL AND next_attempt_at <= NOW() "
+                               "ORDER BY next_attempt_at LIMIT 1", 'idx_payment_events_pending'),
+    'notifications_pending': ("SELECT id FROM notifications WHERE status = 'pending' AND next_attempt_at <= NOW() "
+                              "ORDER BY next_attempt_at LIMIT 50", 'idx_notifications_pending'),
+    'admin_vips_page': ("SELECT telegram_id FROM users WHERE is_vip AND vip_expires > NOW() "
+                        "AND (vip_expires, id) > (NOW(), 1) ORDER BY vip_expires, id LIMIT 6", 'idx_users_vip_expires_id'),
+    'vip_sweeper_expire': ("SELECT id FROM users WHERE is_vip AND vip_expires <= NOW()", 'idx_users_vip_expires_id'),
+    'metrics_due': ("SELECT id FROM servers WHERE metrics_due_at <= NOW() ORDER BY metrics_due_at LIMIT 1000",
+                    'idx_servers_metrics_due'),
+    'activity_logs_by_user': ("SELECT * FROM activity_logs WHERE user_id = 1 ORDER BY timestamp DESC LIMIT 20",
+                              'idx_activity_logs_user_time'),
+}
+
+def discover_migrations(directory: str = MIGRATIONS_DIR) -> list:
+    """Возвращает [(version, name, path)] в порядке версий."""
+    found = []
+    for filename in os.listdir(directory):
+        match = _MIGRATION_RE.match(filename)
+        if match:
+            found.append((int(match.group(1)), match.group(2), os.path.join(directory, filename)))
+    found.sort()
+    versions = [v for v, _, _ in found]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError("Две миграции с одинаковым номером в db/migrations.")
+    return found
+
+async def apply_migrations(pool: asyncpg.Pool, directory: str = MIGRATIONS_DIR) -> list:
+    """Применяет непримененные миграции. Возвращает список примененных имен."""
+    applied_now = []
+    async with pool.acquire() as conn:
+        await conn.execute("SELECT pg_advisory_lock($1)", _LOCK_ID)
+        try:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )""")
+            applied = {r['version'] for r in await conn.fetch("SELECT version FROM schema_migrations")}
+            for version, name, path in discover_migrations(directory):
+                if version in applied:
+                    continue
+                with open(path, encoding='utf-8') as f:
+                    sql = f.read()
+                async with conn.transaction():
+                    await conn.execute(sql)
+                    await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+                logging.info(f"Применена миграция {version:04d}_{name}")
+                applied_now.append(f"{version:04d}_{name}")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", _LOCK_ID)
+    return applied_now
+
+async def check_query_plans(pool: asyncpg.Pool) -> dict:
+    """Проверяет через EXPLAIN, что горячие запросы могут использовать свои индексы.
+
+    Последовательное сканирование запрещается на время проверки: на маленьких таблицах
+    планировщик честно выбрал бы seq scan, а нас интересует, подходит ли индекс запросу.
+    Возвращает {запрос: (bool, план)}.
+    """
+    results = {}
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SET LOCAL enable_seqscan = off")
+            for name, (query, index) in HOT_QUERY_PLANS.items():
+                plan = '\n'.join(r[0] for r in await conn.fetch(f"EXPLAIN {query}"))
+                results[name] = (index in plan, plan)
+    return results
+
+async def _main() -> None:
+    """`python -m utils.migrations` (из каталога app/): применить миграции и проверить планы запросов."""
+    from dotenv import load_dotenv
+    load_dotenv('../.env')
+    pool = await asyncpg.create_pool(user=os.getenv('POSTGRES_USER'), password=os.getenv('POSTGRES_PASSWORD'),
+                                     database=os.getenv('POSTGRES_DB'), host=os.getenv('DB_HOST'), port=os.getenv('DB_PORT'))
+    try:
+        for name in await apply_migrations(pool):
+            print(f"Применена миграция {name}")
+        failed = False
+        for name, (ok, plan) in (await check_query_plans(pool)).items():
+            print(f"{'OK  ' if ok else 'FAIL'} {name}")
+            if not ok:
+                failed = True
+                print(plan)
+        raise SystemExit(1 if failed else 0)
+    finally:
+        await pool.close()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
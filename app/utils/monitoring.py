@@ -0,0 +1,214 @@
+import asyncio
+import io
+import logging
+import os
+import random
+import time
+from datetime import datetime
+
+import asyncpg
+
+from utils.crypto import decrypt_password
+from utils.ssh import format_load, get_system_load
+
+# Фоновый сбор нагрузки всех серверов. Каждые METRICS_TICK секунд процесс забирает серверы,
+# у которых подошел срок замера (servers.metrics_due_at), и сдвигает срок на интервал вперед
+# в том же запросе (FOR UPDATE SKIP LOCKED) — с несколькими процессами бота сервер замеряется
+# один раз. Сроки разнесены по интервалу, а замеры внутри такта — случайной паузой, чтобы не
+# открывать сотни SSH-каналов в одну секунду. Замеры идут через свободные соединения пула или
+# отдельные соединения и не вытесняют соединения пользователей. Результаты сохраняются одной
+# пачкой; раз в час сырые замеры сворачиваются в почасовые агрегаты, старые данные удаляются.
+METRICS_INTERVAL = int(os.getenv('METRICS_INTERVAL', 60))           # сек. между замерами сервера; 0 — сбор выключен
+METRICS_CONCURRENCY = int(os.getenv('METRICS_CONCURRENCY', 10))     # одновременных замеров
+METRICS_TIMEOUT = float(os.getenv('METRICS_TIMEOUT', 30))           # сек. на замер одного сервера
+METRICS_RAW_RETENTION_HOURS = int(os.getenv('METRICS_RAW_RETENTION_HOURS', 48))
+METRICS_HOURLY_RETENTION_DAYS = int(os.getenv('METRICS_HOURLY_RETENTION_DAYS', 30))
+METRICS_TICK = max(METRICS_INTERVAL / 6, 5)  # сек. между выборками серверов, у которых подошел срок
+METRICS_CLAIM_LIMIT = 1000   # серверов за одну выборку; остальные — в следующий такт
+METRICS_ROLLUP_INTERVAL = 3600
+
+METRIC_COLUMNS = ('server_id', 'ts', 'online', 'cpu_pct', 'mem_used', 'mem_total', 'disk_used', 'disk_total',
+                  'load1', 'net_rx', 'net_tx')
+
+# Периоды графиков: (заголовок, SQL выборки точек). Точки: ts, cpu, mem_pct, disk_pct.
+# Корзины — date_bin по timestamp без часового пояса (PostgreSQL 14+): не зависят от TimeZone сессии.
+HISTORY_PERIODS = {
+    '1h': ("за час", """
+        SELECT ts, cpu_pct AS cpu, mem_used * 100.0 / NULLIF(mem_total, 0) AS mem_pct,
+               disk_used * 100.0 / NULLIF(disk_total, 0) AS disk_pct
+        FROM server_metrics WHERE server_id = $1 AND ts > NOW() - INTERVAL '1 hour' AND online ORDER BY ts"""),
+    '24h': ("за сутки", """
+        SELECT date_bin('5 minutes', ts, TIMESTAMP '2000-01-01') AS ts, AVG(cpu_pct) AS cpu,
+               AVG(mem_used * 100.0 / NULLIF(mem_total, 0)) AS mem_pct,
+               MAX(disk_used * 100.0 / NULLIF(disk_total, 0)) AS disk_pct
+        FROM server_metrics WHERE server_id = $1 AND ts > NOW() - INTERVAL '24 hours' AND online
+        GROUP BY 1 ORDER BY 1"""),
+    '7d': ("за неделю", """
+        SELECT hour AS ts, cpu_avg AS cpu, mem_pct_avg AS mem_pct, disk_pct_max AS disk_pct
+        FROM server_metrics_hourly WHERE server_id = $1 AND hour > NOW() - INTERVAL '7 days' ORDER BY hour"""),
+}
+
+# Срок сдвигается от прежнего, а не от текущего времени, — фаза сервера в интервале сохраняется.
+# Если срок давно прошел (бот не работал), новый выбирается случайно внутри интервала.
+_CLAIM_SQL = """
+    UPDATE servers SET metrics_due_at = CASE
+        WHEN metrics_due_at < $1 - make_interval(secs => $3) THEN $1 + make_interval(secs => $3 * random())
+        ELSE metrics_due_at + make_interval(secs => $3) END
+    WHERE id IN (SELECT id FROM servers WHERE metrics_due_at <= $1
+                 ORDER BY metrics_due_at LIMIT $2 FOR UPDATE SKIP LOCKED)
+    RETURNING id, ip, port, login_user, password_encrypted"""
+
+_INSERT_SQL = f"""
+    INSERT INTO server_metrics ({', '.join(METRIC_COLUMNS)})
+    SELECT {', '.join(f'${i}' for i in range(1, len(METRIC_COLUMNS) + 1))} WHERE EXISTS (SELECT 1 FROM servers WHERE id = $1)
+    ON CONFLICT DO NOTHING"""
+
+_ROLLUP_SQL = """
+    INSERT INTO server_metrics_hourly
+        (server_id, hour, samples, online_samples, cpu_avg, cpu_max, mem_pct_avg, mem_pct_max, disk_pct_max)
+    SELECT server_id, date_trunc('hour', ts), COUNT(*), COUNT(*) FILTER (WHERE online),
+           AVG(cpu_pct), MAX(cpu_pct),
+           AVG(mem_used * 100.0 / NULLIF(mem_total, 0)), MAX(mem_used * 100.0 / NULLIF(mem_total, 0)),
+           MAX(disk_used * 100.0 / NULLIF(disk_total, 0))
+    FROM server_metrics
+    WHERE ts >= COALESCE((SELECT MAX(hour) FROM server_metrics_hourly), '-infinity') AND ts < date_trunc('hour', NOW())
+    GROUP BY 1, 2
+    ON CONFLICT (server_id, hour) DO UPDATE SET
+        samples = EXCLUDED.samples, online_samples = EXCLUDED.online_samples,
+        cpu_avg = EXCLUDED.cpu_avg, cpu_max = EXCLUDED.cpu_max,
+        mem_pct_avg = EXCLUDED.mem_pct_avg, mem_pct_max = EXCLUDED.mem_pct_max, disk_pct_max = EXCLUDED.disk_pct_max"""
+
+def sample_record(server_id: int, success: bool, info) -> tuple:
+    """Строка для server_metrics из результата get_system_load."""
+    if not success:
+        return (server_id, datetime.now(), False) + (None,) * (len(METRIC_COLUMNS) - 3)
+    return (server_id, datetime.now(), True) + tuple(info[column] for column in METRIC_COLUMNS[3:])
+
+async def store_samples(pool: asyncpg.Pool, records: list) -> None:
+    """Сохраняет замеры одной пачкой (COPY). Если сервер успели удалить, повторяет по одной строке."""
+    if not records:
+        return
+    async with pool.acquire() as conn:
+        try:
+            await conn.copy_records_to_table('server_metrics', records=records, columns=METRIC_COLUMNS)
+        except (asyncpg.ForeignKeyViolationError, asyncpg.UniqueViolationError):
+            await conn.executemany(_INSERT_SQL, records)
+
+async def get_latest_sample(pool: asyncpg.Pool, server_id: int, max_age: float) -> dict or None:
+    """Последний замер не старше max_age секунд в формате get_system_load (+ 'ts', 'online')."""
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT * FROM server_metrics WHERE server_id = $1 AND ts > NOW() - $2::float * INTERVAL '1 second' "
+            "ORDER BY ts DESC LIMIT 1", server_id, max_age)
+    if not row:
+        return None
+    info = {'cpu': 'н/д', 'ram': 'н/д', 'disk': 'н/д', **dict(row)}
+    return format_load(info)
+
+async def get_history(pool: asyncpg.Pool, server_id: int, period: str) -> list:
+    async with pool.acquire() as conn:
+        return await conn.fetch(HISTORY_PERIODS[period][1], server_id)
+
+def _render_chart(points: list, title: str) -> bytes:
+    # Figure без pyplot: pyplot хранит глобальное состояние и не рассчитан на отрисовку из нескольких потоков
+    from matplotlib.dates import AutoDateFormatter, AutoDateLocator
+    from matplotlib.figure import Figure
+
+    times = [p['ts'] for p in points]
+    fig = Figure(figsize=(8, 4), dpi=100)
+    ax = fig.subplots()
+    for key, label in (('cpu', 'CPU'), ('mem_pct', 'RAM'), ('disk_pct', 'Диск /')):
+        values = [float('nan') if p[key] is None else float(p[key]) for p in points]
+        ax.plot(times, values, label=label, linewidth=1.4)
+    ax.set_ylim(0, 100)
+    ax.set_ylabel('%')
+    ax.set_title(title)
+    ax.grid(alpha=0.3)
+    ax.legend(loc='upper left')
+    locator = AutoDateLocator()
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(AutoDateFormatter(locator))
+    fig.autofmt_xdate()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', bbox_inches='tight')
+    return buf.getvalue()
+
+async def render_history_chart(points: list, title: str):
+    """PNG-график нагрузки. matplotlib необязателен и импортируется при первом графике.
+    Отрисовка идет в отдельном потоке, чтобы не блокировать event loop. Возвращает (bool, png или ошибка)."""
+    try:
+        return True, await asyncio.to_thread(_render_chart, points, title)
+    except ImportError:
+        return False, "Графики недоступны: не установлен matplotlib."
+    except Exception as e:
+        logging.error(f"Ошибка построения графика: {e}")
+        return False, "Не удалось построить график."
+
+class MetricsCollector:
+    """Периодически снимает нагрузку с серверов, у которых подошел срок, и хранит историю в server_metrics."""
+
+    def __init__(self, pool: asyncpg.Pool, interval: int = METRICS_INTERVAL, concurrency: int = METRICS_CONCURRENCY,
+                 sampler=get_system_load, tick: float = METRICS_TICK):
+        self.pool, self.interval, self.sampler, self.tick = pool, interval, sampler, tick
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self._tasks = []
+
+    async def _sample(self, server) -> tuple or None:
+        await asyncio.sleep(random.uniform(0, self.tick))
+        try:
+            password = decrypt_password(server['password_encrypted'])
+        except Exception:
+            return None
+        async with self.semaphore:
+            try:
+                success, info = await asyncio.wait_for(
+                    self.sampler(server['ip'], server['port'], server['login_user'], password, server_id=server['id'],
+                                 background=True),
+                    timeout=METRICS_TIMEOUT)
+            except asyncio.TimeoutError:
+                success, info = False, None
+        return sample_record(server['id'], success, info)
+
+    async def collect_once(self) -> int:
+        """Замеряет серверы, у которых подошел срок. Возвращает число сохраненных замеров."""
+        async with self.pool.acquire() as conn:
+            servers = await conn.fetch(_CLAIM_SQL, datetime.now(), METRICS_CLAIM_LIMIT, self.interval)
+        results = await asyncio.gather(*[self._sample(s) for s in servers], return_exceptions=True)
+        records = [r for r in results if isinstance(r, tuple)]
+        await store_samples(self.pool, records)
+        return len(records)
+
+    async def rollup(self) -> None:
+        """Сворачивает завершенные часы в server_metrics_hourly и удаляет данные старше срока хранения."""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(_ROLLUP_SQL)
+                await conn.execute(f"DELETE FROM server_metrics WHERE ts < NOW() - INTERVAL '{METRICS_RAW_RETENTION_HOURS} hours'")
+                await conn.execute(f"DELETE FROM server_metrics_hourly WHERE hour < NOW() - INTERVAL '{METRICS_HOURLY_RETENTION_DAYS} days'")
+
+    async def _collect_loop(self) -> None:
+        while True:
+            started = time.monotonic()
+            try:
+                await self.collect_once()
+            except Exception as e:
+                logging.error(f"Сбор метрик: цикл завершился ошибкой: {e}")
+            await asyncio.sleep(max(self.tick - (time.monotonic() - started), 1))
+
+    async def _rollup_loop(self) -> None:
+        while True:
+            try:
+                await self.rollup()
+            except Exception as e:
+                logging.error(f"Сбор метрик: не удалось свернуть историю: {e}")
+            await asyncio.sleep(METRICS_ROLLUP_INTERVAL)
+
+    def start(self) -> None:
+        if not self._tasks and self.interval > 0:
+            self._tasks = [asyncio.create_task(self._collect_loop()), asyncio.create_task(self._rollup_loop())]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+import asyncpg
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from utils.broadcast import TokenBucket
+
+# Исходящие уведомления через таблицу notifications (outbox). Код, который меняет данные,
+# добавляет сообщение в той же транзакции (enqueue_notification), поэтому сообщение не теряется
+# при падении процесса и не отправляется, если транзакция откатилась. Отправка идет в фоне:
+# пачка строк забирается с арендой locked_until (FOR UPDATE SKIP LOCKED — несколько процессов
+# не возьмут одну строку), отправляется с ограничением скорости, а результат пишется одним запросом.
+NOTIFY_POLL_INTERVAL = float(os.getenv('NOTIFY_POLL_INTERVAL', 5))  # сек. между проверками очереди
+NOTIFY_BATCH_SIZE = int(os.getenv('NOTIFY_BATCH_SIZE', 50))         # сообщений за одну выборку
+NOTIFY_RATE = float(os.getenv('NOTIFY_RATE', 20))                   # сообщений в секунду
+NOTIFY_CONCURRENCY = 5         # одновременных запросов к API
+NOTIFY_MAX_ATTEMPTS = 8        # после этого сообщение помечается failed
+NOTIFY_LEASE = 120             # сек. аренды пачки
+NOTIFY_BACKOFF_LIMIT = 3600    # сек. — наибольшая пауза между попытками
+
+_CLAIM_SQL = """
+    UPDATE notifications SET locked_until = $1 + make_interval(secs => $3)
+    WHERE id IN (SELECT id FROM notifications
+                 WHERE status = 'pending' AND next_attempt_at <= $1 AND (locked_until IS NULL OR locked_until <= $1)
+                 ORDER BY next_attempt_at LIMIT $2 FOR UPDATE SKIP LOCKED)
+    RETURNING id, telegram_id, text, attempts"""
+
+async def enqueue_notification(conn: asyncpg.Connection, telegram_id: int, text: str) -> None:
+    """Ставит сообщение в очередь. Вызывать внутри транзакции изменения, о котором оно сообщает."""
+    await conn.execute("INSERT INTO notifications (telegram_id, text, next_attempt_at) VALUES ($1, $2, $3)",
+                       telegram_id, text, datetime.now())
+
+class NotificationSender:
+    """Фоновая отправка очереди notifications. wake() — отправить сейчас, не дожидаясь NOTIFY_POLL_INTERVAL."""
+
+    def __init__(self, bot: Bot, pool: asyncpg.Pool, rate: float = NOTIFY_RATE, batch_size: int = NOTIFY_BATCH_SIZE):
+        self.bot, self.pool, self.batch_size = bot, pool, batch_size
+        self.bucket = TokenBucket(rate)
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    async def _send(self, row, semaphore: asyncio.Semaphore):
+        """Возвращает (id, статус, ошибка, повтор через сек., считать ли попытку)."""
+        async with semaphore:
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(row['telegram_id'], row['text'])
+                return row['id'], 'sent', None, 0, True
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+                return row['id'], 'pending', str(e), e.retry_after, False  # ограничение API, а не ошибка отправки
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                return row['id'], 'failed', str(e), 0, True  # бот заблокирован или чат не существует — повтор не поможет
+            except Exception as e:
+                attempts = row['attempts'] + 1
+                if attempts >= NOTIFY_MAX_ATTEMPTS:
+                    return row['id'], 'failed', str(e), 0, True
+                return row['id'], 'pending', str(e), min(10 * 2 ** attempts, NOTIFY_BACKOFF_LIMIT), True
+
+    async def send_batch(self) -> int:
+        """Отправляет одну пачку. Возвращает число забранных из очереди сообщений."""
+        now = datetime.now()
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(_CLAIM_SQL, now, self.batch_size, NOTIFY_LEASE)
+        if not rows:
+            return 0
+        semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+        results = await asyncio.gather(*(self._send(row, semaphore) for row in rows))
+        now = datetime.now()
+        sent = [result[0] for result in results if result[1] == 'sent']
+        other = [(row_id, status, error, now + timedelta(seconds=delay), counted)
+                 for row_id, status, error, delay, counted in results if status != 'sent']
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if sent:
+                    await conn.execute("UPDATE notifications SET status = 'sent', sent_at = $2, attempts = attempts + 1, "
+                                       "locked_until = NULL, error = NULL WHERE id = ANY($1::bigint[])", sent, now)
+                if other:
+                    await conn.executemany(
+                        "UPDATE notifications SET status = $2, error = $3, next_attempt_at = $4, locked_until = NULL, "
+                        "attempts = attempts + CASE WHEN $5 THEN 1 ELSE 0 END WHERE id = $1", other)
+        return len(rows)
+
+    async def _loop(self) -> None:
+        while True:
+            self._wakeup.clear()  # до выборки: wake() во время отправки не должен потеряться
+            try:
+                while await self.send_batch() == self.batch_size:
+                    pass
+            except Exception as e:
+                logging.error(f"Уведомления: не удалось отправить очередь: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), NOTIFY_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        # Аренда недоотправленной пачки истечет сама; сообщения уйдут после перезапуска
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
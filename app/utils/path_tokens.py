@@ -0,0 +1,48 @@
+import base64
+import hashlib
+import time
+
+from aiogram.fsm.context import FSMContext
+
+# callback_data в Telegram ограничена 64 байтами, а пути на сервере — нет. Поэтому в кнопки
+# файл-менеджера кладется короткий токен, а (server_id, путь) хранится в данных FSM
+# пользователя: реестр автоматически свой у каждого пользователя и живет там же, где FSM
+# (в БД или Redis), то есть виден всем процессам бота.
+PATH_TOKEN_TTL = 6 * 3600    # сек. жизни токена
+PATH_TOKEN_LIMIT = 500       # токенов на пользователя; при превышении удаляются самые старые
+_DATA_KEY = 'fm_paths'
+
+def path_token(server_id: int, path: str) -> str:
+    """Детерминированный токен: один и тот же путь получает тот же токен при повторном показе."""
+    digest = hashlib.sha256(f"{server_id}\0{path}".encode()).digest()[:6]
+    return base64.urlsafe_b64encode(digest).decode()
+
+class PathRegistry:
+    def __init__(self, state: FSMContext):
+        self.state = state
+
+    async def issue_many(self, server_id: int, paths: list) -> list:
+        """Выдает токены для путей одного сервера (одна запись в хранилище FSM на весь список)."""
+        data = await self.state.get_data()
+        now = time.time()
+        registry = {t: entry for t, entry in data.get(_DATA_KEY, {}).items() if entry[2] > now}
+        tokens = []
+        for path in paths:
+            token = path_token(server_id, path)
+            registry[token] = [server_id, path, now + PATH_TOKEN_TTL]
+            tokens.append(token)
+        if len(registry) > PATH_TOKEN_LIMIT:
+            keep = sorted(registry.items(), key=lambda item: item[1][2])[-PATH_TOKEN_LIMIT:]
+            registry = dict(keep)
+        await self.state.update_data({_DATA_KEY: registry})
+        return tokens
+
+    async def issue(self, server_id: int, path: str) -> str:
+        return (await self.issue_many(server_id, [path]))[0]
+
+    async def resolve(self, token: str):
+        """Возвращает (server_id, path) или None, если токен неизвестен или устарел."""
+        entry = (await self.state.get_data()).get(_DATA_KEY, {}).get(token)
+        if not entry or entry[2] < time.time():
+            return None
+        return entry[0], entry[1]
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+import asyncpg
+
+from utils.notifications import enqueue_notification
+
+# Обработка вебхуков платежных систем. Вебхук только сохраняет событие в payment_events
+# (повторная доставка того же события игнорируется по UNIQUE) и сразу отвечает 200 — провайдер
+# не ждет ни активации, ни Telegram. Фоновая очередь применяет события: подтверждение платежа
+# и продление VIP — один запрос UPDATE ... WHERE status = 'pending' RETURNING, поэтому платеж
+# засчитывается ровно один раз, даже если вебхук и ручная проверка пришли одновременно.
+# Уведомление пользователю добавляется в notifications в той же транзакции.
+PAYMENT_EVENTS_POLL_INTERVAL = float(os.getenv('PAYMENT_EVENTS_POLL_INTERVAL', 10))  # сек. между проверками очереди
+PAYMENT_EVENTS_MAX_ATTEMPTS = 6  # попыток найти подписку (счет мог еще не попасть в БД), затем событие закрывается
+PAYMENT_EVENTS_RETRY_DELAY = 30  # сек. до повтора, удваивается с каждой попыткой
+
+PROVIDER_TITLES = {'yookassa': 'ЮKassa', 'cryptopay': 'CryptoPay'}
+
+# Подписка переходит pending -> paid и продлевает VIP в одном запросе: от текущего срока, если он
+# еще не истек, иначе от $3. Если подписка уже оплачена, запрос ничего не меняет и не возвращает строк.
+_CONFIRM_SQL = """
+    WITH paid AS (
+        UPDATE subscriptions SET status = 'paid'
+        WHERE provider = $1 AND payment_id = $2 AND status = 'pending'
+        RETURNING user_id, duration_days
+    )
+    UPDATE users u SET is_vip = TRUE,
+        vip_expires = GREATEST(CASE WHEN u.is_vip THEN u.vip_expires END, $3::timestamp)
+                      + make_interval(days => paid.duration_days)
+    FROM paid WHERE u.id = paid.user_id
+    RETURNING u.id, u.telegram_id, u.vip_expires"""
+
+_CLAIM_SQL = """
+    SELECT id, provider, payment_id, attempts FROM payment_events
+    WHERE processed_at IS NULL AND next_attempt_at <= $1
+    ORDER BY next_attempt_at LIMIT 1
+    FOR UPDATE SKIP LOCKED"""
+
+async def record_payment_event(pool: asyncpg.Pool, provider: str, payment_id: str, event_type: str, payload: dict) -> bool:
+    """Сохраняет событие вебхука. Возвращает False, если такое событие уже было получено."""
+    async with pool.acquire() as conn:
+        event_id = await conn.fetchval(
+            "INSERT INTO payment_events (provider, payment_id, event_type, payload, received_at, next_attempt_at) "
+            "VALUES ($1, $2, $3, $4::jsonb, $5, $5) ON CONFLICT (provider, payment_id, event_type) DO NOTHING RETURNING id",
+            provider, payment_id, event_type, json.dumps(payload, ensure_ascii=False), datetime.now())
+    return event_id is not None
+
+async def confirm_payment(conn: asyncpg.Connection, provider: str, payment_id: str, notify: bool = True) -> asyncpg.Record or None:
+    """Засчитывает оплаченный счет. Возвращает пользователя (id, telegram_id, vip_expires),
+    если VIP продлен этим вызовом, и None, если подписки нет или она уже оплачена.
+    Вызывать внутри транзакции: уведомление (notify) ставится в очередь вместе с изменением."""
+    user = await conn.fetchrow(_CONFIRM_SQL, provider, payment_id, datetime.now())
+    if user and notify:
+        await enqueue_notification(
+            conn, user['telegram_id'],
+            f"✅ Оплата через {PROVIDER_TITLES.get(provider, provider)} прошла успешно! "
+            f"VIP активирован до {user['vip_expires']:%d.%m.%Y}.")
+    return user
+
+class PaymentEventProcessor:
+    """Применяет сохраненные события оплаты. on_paid(user) вызывается после фиксации транзакции
+    для каждого продленного VIP (сброс кеша пользователя, отправка уведомлений)."""
+
+    def __init__(self, pool: asyncpg.Pool, on_paid):
+        self.pool, self.on_paid = pool, on_paid
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    async def process_one(self) -> bool:
+        """Обрабатывает одно событие в своей транзакции. Возвращает False, если очередь пуста."""
+        now = datetime.now()
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                event = await conn.fetchrow(_CLAIM_SQL, now)
+                if not event:
+                    return False
+                user = await confirm_payment(conn, event['provider'], event['payment_id'])
+                if user:
+                    result = 'activated'
+                else:
+                    status = await conn.fetchval("SELECT status FROM subscriptions WHERE provider = $1 AND payment_id = $2",
+                                                 event['provider'], event['payment_id'])
+                    result = 'duplicate' if status == 'paid' else 'unknown'
+                attempts = event['attempts'] + 1
+                if result == 'unknown' and attempts < PAYMENT_EVENTS_MAX_ATTEMPTS:
+                    # Вебхук мог прийти раньше, чем счет записан в БД: повторим позже
+                    delay = timedelta(seconds=PAYMENT_EVENTS_RETRY_DELAY * 2 ** (attempts - 1))
+                    await conn.execute("UPDATE payment_events SET attempts = $2, next_attempt_at = $3 WHERE id = $1",
+                                       event['id'], attempts, now + delay)
+                    return True
+                await conn.execute("UPDATE payment_events SET attempts = $2, processed_at = $3, result = $4 WHERE id = $1",
+                                   event['id'], attempts, now, result)
+        if result == 'unknown':
+            logging.warning(f"Оплата {event['provider']} {event['payment_id']}: подписка не найдена, событие закрыто.")
+        if user:
+            await self.on_paid(user)
+        return True
+
+    async def _loop(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                while await self.process_one():
+                    pass
+            except Exception as e:
+                logging.error(f"Очередь платежей: ошибка обработки, повтор позже: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), PAYMENT_EVENTS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
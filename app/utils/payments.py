@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import uuid
+from abc import ABC, abstractmethod
+from typing import NamedTuple
+
+import aiohttp
+from aiocryptopay import AioCryptoPay
+
+# Нормализованные статусы платежа, общие для всех провайдеров
+PAYMENT_PAID, PAYMENT_PENDING, PAYMENT_CANCELED = 'paid', 'pending', 'canceled'
+
+class PaymentError(Exception):
+    pass
+
+class Invoice(NamedTuple):
+    invoice_id: str
+    pay_url: str
+
+class PaymentProvider(ABC):
+    """Единый асинхронный интерфейс платежной системы. Ни один метод не блокирует event loop.
+    Провайдер без create_invoice или get_status не создастся (TypeError при инициализации)."""
+    name = None
+
+    @abstractmethod
+    async def create_invoice(self, amount: float, description: str, metadata: dict = None, return_url: str = None) -> Invoice:
+        ...
+
+    @abstractmethod
+    async def get_status(self, invoice_id: str) -> str:
+        """Возвращает один из PAYMENT_PAID / PAYMENT_PENDING / PAYMENT_CANCELED."""
+
+    async def close(self) -> None:
+        pass
+
+class YooKassaProvider(PaymentProvider):
+    """Нативный aiohttp-клиент REST API ЮKassa (вместо синхронного SDK `yookassa`).
+
+    Все запросы ограничены таймаутом; сетевые ошибки, 429 и 5xx повторяются с
+    экспоненциальной задержкой. Создание платежа повторяется с тем же
+    Idempotence-Key, поэтому повтор не создаст второй платеж.
+    """
+    name = 'yookassa'
+    API_URL = "https://api.yookassa.ru/v3"
+
+    def __init__(self, shop_id: str, secret_key: str, timeout: float = 10.0, retries: int = 3):
+        self.auth = aiohttp.BasicAuth(str(shop_id), secret_key)
+        self.timeout, self.retries = aiohttp.ClientTimeout(total=timeout), retries
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(auth=self.auth, timeout=self.timeout)
+        return self._session
+
+    async def _request(self, method: str, path: str, payload: dict = None, idempotence_key: str = None) -> dict:
+        headers = {'Idempotence-Key': idempotence_key} if idempotence_key else {}
+        last_error = None
+        for attempt in range(self.retries):
+            if attempt:
+                await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+            try:
+                async with self._get_session().request(method, f"{self.API_URL}{path}", json=payload, headers=headers) as resp:
+                    if resp.status == 429 or resp.status >= 500:
+                        # Тело не разбираем: у 502/503 от прокси это HTML или пустота
+                        last_error = PaymentError(f"ЮKassa вернула {resp.status}")
+                        continue
+                    try:
+                        data = await resp.json(content_type=None)
+                    except ValueError:
+                        data = None
+                    if not isinstance(data, dict):
+                        raise PaymentError(f"ЮKassa: некорректный ответ ({resp.status})")
+                    if resp.status >= 400:
+                        raise PaymentError(f"ЮKassa: {data.get('description') or resp.status}")
+                    return data
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error = e
+                logging.warning(f"ЮKassa {method} {path}: попытка {attempt + 1}/{self.retries} не удалась: {e!r}")
+        raise PaymentError(f"ЮKassa недоступна: {last_error}")
+
+    async def create_invoice(self, amount: float, description: str, metadata: dict = None, return_url: str = None) -> Invoice:
+        payload = {
+            "amount": {"value": f"{amount:.2f}", "currency": "RUB"},
+            "confirmation": {"type": "redirect", "return_url": return_url},
+            "capture": True,
+            "description": description,
+            "metadata": metadata or {},
+        }
+        data = await self._request('POST', '/payments', payload, idempotence_key=str(uuid.uuid4()))
+        return Invoice(data['id'], data['confirmation']['confirmation_url'])
+
+    async def get_status(self, invoice_id: str) -> str:
+        # invoice_id приходит из callback_data: в путь API попадает только канонический UUID
+        try:
+            payment_id = str(uuid.UUID(invoice_id))
+        except ValueError:
+            raise PaymentError("Неверный формат ID счета.")
+        data = await self._request('GET', f'/payments/{payment_id}')
+        return {'succeeded': PAYMENT_PAID, 'canceled': PAYMENT_CANCELED}.get(data.get('status'), PAYMENT_PENDING)
+
+    async def close(self) -> None:
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+class CryptoPayProvider(PaymentProvider):
+    """Обертка над AioCryptoPay с тем же интерфейсом и таймаутом на каждый вызов."""
+    name = 'cryptopay'
+
+    def __init__(self, client: AioCryptoPay, asset: str = 'USDT', timeout: float = 10.0):
+        self.client, self.asset, self.timeout = client, asset, timeout
+
+    async def create_invoice(self, amount: float, description: str, metadata: dict = None, return_url: str = None) -> Invoice:
+        invoice = await asyncio.wait_for(
+            self.client.create_invoice(asset=self.asset, amount=amount, description=description, expires_in=900),
+            timeout=self.timeout)
+        return Invoice(str(invoice.invoice_id), invoice.bot_invoice_url)
+
+    async def get_status(self, invoice_id: str) -> str:
+        try:
+            invoice_ids = [int(invoice_id)]
+        except ValueError:
+            raise PaymentError("Неверный формат ID счета.")
+        invoices = await asyncio.wait_for(self.client.get_invoices(invoice_ids=invoice_ids), timeout=self.timeout)
+        if not invoices:
+            return PAYMENT_PENDING
+        return {'paid': PAYMENT_PAID, 'expired': PAYMENT_CANCELED}.get(invoices[0].status, PAYMENT_PENDING)
+
+    async def close(self) -> None:
+        await self.client.close()
@@ -0,0 +1,70 @@
+import asyncio
+import os
+import socket
+import time
+
+from utils.cache import TTLCache
+
+# Быстрая проверка доступности для списка серверов: TCP-подключение и чтение SSH-баннера,
+# без обмена ключами и авторизации. Результаты недолго кешируются по host:port.
+PROBE_TIMEOUT = float(os.getenv('PROBE_TIMEOUT', 3.0))        # сек. на один сервер
+PROBE_CONCURRENCY = int(os.getenv('PROBE_CONCURRENCY', 20))  # одновременных проверок на процесс
+PROBE_CACHE_TTL = float(os.getenv('PROBE_CACHE_TTL', 30))    # сек. жизни результата
+
+_probe_cache = TTLCache(maxsize=5000, ttl=PROBE_CACHE_TTL)
+_probe_semaphore = None
+
+async def probe_ssh(host: str, port: int, timeout: float = PROBE_TIMEOUT):
+    """Проверяет, что на host:port отвечает SSH. Возвращает (bool, задержка в мс или текст ошибки)."""
+    started = time.monotonic()
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        banner = await asyncio.wait_for(reader.readline(), max(timeout - (time.monotonic() - started), 0.1))
+        if not banner.startswith(b'SSH-'):
+            return False, "не SSH"
+        return True, round((time.monotonic() - started) * 1000)
+    except asyncio.TimeoutError:
+        return False, "таймаут"
+    except ConnectionRefusedError:
+        return False, "порт закрыт"
+    except socket.gaierror:
+        return False, "адрес не найден"
+    except OSError:
+        return False, "недоступен"
+    finally:
+        if writer:
+            writer.close()
+
+def cached_statuses(servers: list) -> dict:
+    """Статусы из кеша без сетевых запросов: {server_id: (bool, результат)} только для известных."""
+    statuses = {}
+    for s in servers:
+        status = _probe_cache.get((s['ip'], s['port']))
+        if status is not None:
+            statuses[s['id']] = status
+    return statuses
+
+async def probe_servers(servers: list) -> dict:
+    """Проверяет все серверы параллельно (не больше PROBE_CONCURRENCY одновременно).
+
+    servers — строки с полями id, ip, port. Возвращает {server_id: (bool, задержка в мс или ошибка)}.
+    """
+    global _probe_semaphore
+    if _probe_semaphore is None:
+        _probe_semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+    statuses = cached_statuses(servers)
+    # Один запрос на host:port, даже если адрес добавлен несколько раз
+    missing = {(s['ip'], s['port']) for s in servers if s['id'] not in statuses}
+
+    async def probe_one(address):
+        async with _probe_semaphore:
+            status = await probe_ssh(*address)
+        _probe_cache.set(address, status)
+        return address, status
+
+    results = dict(await asyncio.gather(*[probe_one(address) for address in missing]))
+    for s in servers:
+        if s['id'] not in statuses:
+            statuses[s['id']] = results[(s['ip'], s['port'])]
+    return statuses
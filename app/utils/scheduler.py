@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import os
+import zlib
+from datetime import datetime, timedelta
+
+import asyncpg
+
+from utils.crypto import decrypt_password
+from utils.cron import CronError, CronSchedule
+from utils.fanout import HostResult, run_on_host
+
+# Команды по расписанию. Задачи хранятся в scheduled_jobs, поэтому переживают перезапуск.
+# Каждые JOBS_POLL_INTERVAL секунд процесс забирает задачи, которым пора выполняться
+# (FOR UPDATE SKIP LOCKED + аренда locked_until — несколько процессов не возьмут одну задачу),
+# с ограничениями на число задач в процессе и на одном сервере. Следующий запуск считается
+# от момента завершения, поэтому пропущенные срабатывания не копятся, а схлопываются в один запуск;
+# если задача опоздала больше чем на JOBS_MISFIRE_GRACE, запуск пропускается.
+JOBS_POLL_INTERVAL = float(os.getenv('JOBS_POLL_INTERVAL', 15))      # сек. между проверками расписания
+JOBS_CONCURRENCY = int(os.getenv('JOBS_CONCURRENCY', 10))            # задач одновременно на процесс бота
+JOBS_PER_SERVER = int(os.getenv('JOBS_PER_SERVER', 1))               # задач одновременно на одном сервере
+JOBS_TIMEOUT = float(os.getenv('JOBS_TIMEOUT', 300))                 # сек. на выполнение команды
+JOBS_MISFIRE_GRACE = float(os.getenv('JOBS_MISFIRE_GRACE', 300))     # сек. опоздания, после которых запуск пропускается
+JOBS_MIN_INTERVAL = int(os.getenv('JOBS_MIN_INTERVAL', 300))         # сек. — не чаще одного запуска задачи
+JOBS_MAX_PER_USER = int(os.getenv('JOBS_MAX_PER_USER', 10))
+JOBS_OUTPUT_LIMIT = 16 * 1024  # символов вывода, сохраняемых в историю
+JOBS_RUNS_KEEP = 20            # запусков в истории на задачу
+_LEASE_MARGIN = 120            # сек. аренды сверх таймаута: подключение, запись результата
+
+_CLAIM_SQL = """
+    SELECT j.id, j.user_id, j.server_id, j.command, j.schedule, j.enabled, j.next_run_at, j.failures, u.telegram_id,
+           s.name, s.ip, s.port, s.login_user, s.password_encrypted,
+           (SELECT COUNT(*) FROM scheduled_jobs r WHERE r.server_id = j.server_id AND r.locked_until > $1) AS running
+    FROM scheduled_jobs j JOIN servers s ON s.id = j.server_id JOIN users u ON u.id = j.user_id
+    WHERE j.enabled AND j.next_run_at <= $1 AND (j.locked_until IS NULL OR j.locked_until <= $1)
+    ORDER BY j.next_run_at LIMIT $2
+    FOR UPDATE OF j SKIP LOCKED"""
+
+def parse_schedule(expression: str, now: datetime = None) -> CronSchedule:
+    """Проверяет выражение для новой задачи; бросает CronError с понятным пользователю текстом."""
+    schedule = CronSchedule(expression)
+    if schedule.min_interval(now or datetime.now()) < JOBS_MIN_INTERVAL:
+        raise CronError(f"Слишком часто: задача может запускаться не чаще раза в {JOBS_MIN_INTERVAL // 60} мин.")
+    return schedule
+
+def run_output(run) -> str:
+    return zlib.decompress(run['output_z']).decode() if run['output_z'] else ''
+
+async def create_job(pool: asyncpg.Pool, user_id: int, server_id: int, schedule: CronSchedule, command: str):
+    """Возвращает (bool, id задачи или текст ошибки)."""
+    async with pool.acquire() as conn:
+        count = await conn.fetchval("SELECT COUNT(*) FROM scheduled_jobs WHERE user_id = $1", user_id)
+        if count >= JOBS_MAX_PER_USER:
+            return False, f"Можно создать не больше {JOBS_MAX_PER_USER} задач."
+        job_id = await conn.fetchval(
+            "INSERT INTO scheduled_jobs (user_id, server_id, command, schedule, next_run_at) "
+            "SELECT $1, $2, $3, $4, $5 WHERE EXISTS (SELECT 1 FROM servers WHERE id = $2 AND user_id = $1) RETURNING id",
+            user_id, server_id, command, str(schedule), schedule.next_after(datetime.now()))
+    return (True, job_id) if job_id else (False, "Сервер не найден.")
+
+async def get_server_jobs(pool: asyncpg.Pool, server_id: int, user_id: int) -> list:
+    async with pool.acquire() as conn:
+        return await conn.fetch("SELECT * FROM scheduled_jobs WHERE server_id = $1 AND user_id = $2 ORDER BY id",
+                                server_id, user_id)
+
+async def get_job(pool: asyncpg.Pool, job_id: int, user_id: int) -> asyncpg.Record or None:
+    async with pool.acquire() as conn:
+        return await conn.fetchrow("SELECT * FROM scheduled_jobs WHERE id = $1 AND user_id = $2", job_id, user_id)
+
+async def get_job_runs(pool: asyncpg.Pool, job_id: int, limit: int = 5) -> list:
+    async with pool.acquire() as conn:
+        return await conn.fetch("SELECT * FROM job_runs WHERE job_id = $1 ORDER BY id DESC LIMIT $2", job_id, limit)
+
+async def set_job_enabled(pool: asyncpg.Pool, job: asyncpg.Record, enabled: bool) -> None:
+    # После включения считаем расписание от текущего момента, чтобы не получить "опоздавший" запуск
+    next_run = CronSchedule(job['schedule']).next_after(datetime.now())
+    async with pool.acquire() as conn:
+        await conn.execute("UPDATE scheduled_jobs SET enabled = $2, next_run_at = $3 WHERE id = $1",
+                           job['id'], enabled, next_run)
+
+async def run_job_now(pool: asyncpg.Pool, job_id: int) -> None:
+    async with pool.acquire() as conn:
+        await conn.execute("UPDATE scheduled_jobs SET next_run_at = $2 WHERE id = $1", job_id, datetime.now())
+
+async def delete_job(pool: asyncpg.Pool, job_id: int, user_id: int) -> None:
+    async with pool.acquire() as conn:
+        await conn.execute("DELETE FROM scheduled_jobs WHERE id = $1 AND user_id = $2", job_id, user_id)
+
+class JobScheduler:
+    """Выполняет задачи из scheduled_jobs. notify(job, text, output) сообщает владельцу (job['telegram_id']) о сбоях."""
+
+    def __init__(self, pool: asyncpg.Pool, notify, concurrency: int = JOBS_CONCURRENCY):
+        self.pool, self.notify, self.concurrency = pool, notify, concurrency
+        self._running = {}  # id задачи -> задача asyncio
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def wake(self) -> None:
+        """Проверить расписание сейчас, не дожидаясь JOBS_POLL_INTERVAL (например, после "Запустить сейчас")."""
+        self._wakeup.set()
+
+    async def claim(self, limit: int) -> list:
+        """Забирает до limit задач, которым пора выполняться, с учетом JOBS_PER_SERVER."""
+        now = datetime.now()
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                rows = await conn.fetch(_CLAIM_SQL, now, limit * 4)
+                picked, per_server = [], {}
+                for row in rows:
+                    busy = row['running'] + per_server.get(row['server_id'], 0)
+                    if len(picked) < limit and busy < JOBS_PER_SERVER:
+                        per_server[row['server_id']] = per_server.get(row['server_id'], 0) + 1
+                        picked.append(row)
+                if picked:
+                    await conn.execute("UPDATE scheduled_jobs SET locked_until = $2 WHERE id = ANY($1::int[])",
+                                       [row['id'] for row in picked], now + timedelta(seconds=JOBS_TIMEOUT + _LEASE_MARGIN))
+        return picked
+
+    async def _run(self, job) -> HostResult:
+        try:
+            password = decrypt_password(job['password_encrypted'])
+        except Exception:
+            password = None
+        server = {'id': job['server_id'], 'name': job['name'], 'ip': job['ip'], 'port': job['port'],
+                  'login_user': job['login_user'], 'password': password}
+        try:
+            # run_on_host ограничивает само выполнение, а здесь еще и ожидание соединения из пула
+            return await asyncio.wait_for(run_on_host(server, job['command'], JOBS_TIMEOUT), JOBS_TIMEOUT + _LEASE_MARGIN / 2)
+        except asyncio.TimeoutError:
+            return HostResult(job['server_id'], job['name'], error="не удалось дождаться подключения")
+
+    async def _execute(self, job) -> None:
+        started = datetime.now()
+        lateness = (started - job['next_run_at']).total_seconds()
+        missed = lateness > JOBS_MISFIRE_GRACE
+        if missed:
+            result = HostResult(job['server_id'], job['name'], error=f"запуск пропущен: опоздание {int(lateness)} с")
+        else:
+            result = await self._run(job)
+        ok = result.ok
+        output = result.output[:JOBS_OUTPUT_LIMIT]
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                failures = await conn.fetchval(
+                    """UPDATE scheduled_jobs SET locked_until = NULL, next_run_at = $2,
+                           last_run_at = CASE WHEN $3 THEN last_run_at ELSE $4 END,
+                           last_ok = CASE WHEN $3 THEN last_ok ELSE $5 END,
+                           failures = CASE WHEN $3 THEN failures WHEN $5 THEN 0 ELSE failures + 1 END
+                       WHERE id = $1 RETURNING failures""",
+                    job['id'], CronSchedule(job['schedule']).next_after(datetime.now()), missed, started, ok)
+                if failures is None:
+                    return  # задачу удалили, пока она выполнялась
+                await conn.execute(
+                    "INSERT INTO job_runs (job_id, started_at, duration_ms, exit_status, error, output_z, output_truncated) "
+                    "VALUES ($1, $2, $3, $4, $5, $6, $7)",
+                    job['id'], started, int(result.duration * 1000), result.exit_status, result.error,
+                    zlib.compress(output.encode()) if output else None, result.truncated or len(result.output) > len(output))
+                await conn.execute(
+                    "DELETE FROM job_runs WHERE job_id = $1 AND id < "
+                    "(SELECT id FROM job_runs WHERE job_id = $1 ORDER BY id DESC OFFSET $2 LIMIT 1)",
+                    job['id'], JOBS_RUNS_KEEP - 1)
+        if missed:
+            return
+        # Сообщаем о первом сбое серии и о восстановлении, а не о каждом неудачном запуске
+        if not ok and failures == 1:
+            await self._notify(job, f"⚠️ Задача по расписанию завершилась с ошибкой: {result.describe()}", output)
+        elif ok and job['failures']:
+            await self._notify(job, "✅ Задача по расписанию снова выполняется успешно.", '')
+
+    async def _notify(self, job, text: str, output: str) -> None:
+        try:
+            await self.notify(job, text, output)
+        except Exception as e:
+            logging.warning(f"Планировщик: не удалось уведомить о задаче {job['id']}: {e}")
+
+    async def _execute_safely(self, job) -> None:
+        try:
+            await self._execute(job)
+        except Exception as e:
+            # Аренда истечет сама, и задача будет запущена снова
+            logging.error(f"Планировщик: задача {job['id']} завершилась ошибкой: {e}")
+        finally:
+            self._running.pop(job['id'], None)
+
+    async def _loop(self) -> None:
+        while True:
+            free = self.concurrency - len(self._running)
+            if free > 0:
+                try:
+                    for job in await self.claim(free):
+                        self._running[job['id']] = asyncio.create_task(self._execute_safely(job))
+                except Exception as e:
+                    logging.error(f"Планировщик: не удалось получить задачи: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), JOBS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        running = list(self._running)
+        for task in list(self._running.values()):
+            task.cancel()
+        await asyncio.gather(*self._running.values(), return_exceptions=True)
+        if running:
+            # Прерванные задачи сразу освобождаем: после перезапуска они выполнятся по расписанию
+            async with self.pool.acquire() as conn:
+                await conn.execute("UPDATE scheduled_jobs SET locked_until = NULL WHERE id = ANY($1::int[])", running)
@@ -1,101 +1,853 @@
 import asyncssh
 import asyncio
+import hashlib
+import logging
+import os
+import posixpath
 import re
+import shlex
+import stat
+import time
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+from utils.metrics import ssh_operation
+
+# --- Пул SSH-подключений ---
+# Каждое подключение — это TCP + обмен ключами + аутентификация (300 мс – 1 с).
+# Пул держит уже авторизованные соединения открытыми и раздает их хелперам ниже.
+# Одно SSH-соединение мультиплексирует несколько каналов, поэтому соединение
+# может одновременно "арендоваться" несколькими вызовами (до SSH_POOL_MAX_LEASES).
+SSH_POOL_IDLE_TTL = float(os.getenv('SSH_POOL_IDLE_TTL', 300))          # сек. простоя до закрытия
+SSH_POOL_MAX_PER_HOST = int(os.getenv('SSH_POOL_MAX_PER_HOST', 2))      # соединений на host:port
+SSH_POOL_MAX_TOTAL = int(os.getenv('SSH_POOL_MAX_TOTAL', 100))          # соединений всего
+SSH_POOL_MAX_LEASES = int(os.getenv('SSH_POOL_MAX_LEASES', 8))          # каналов на соединение (OpenSSH MaxSessions = 10)
+SSH_POOL_HEALTH_CHECK_AFTER = float(os.getenv('SSH_POOL_HEALTH_CHECK_AFTER', 60))  # проверка, если простаивало дольше
+
+def credential_fingerprint(username: str, password: str) -> str:
+    """Короткий отпечаток учетных данных для ключа пула (сам пароль в ключ не попадает)."""
+    return hashlib.sha256(f"{username}\0{password}".encode()).hexdigest()[:16]
+
+class _PooledConnection:
+    __slots__ = ('conn', 'key', 'leases', 'last_used', 'closed', 'retired', 'sftp', 'sftp_lock')
+
+    def __init__(self, conn, key):
+        self.conn, self.key = conn, key
+        self.leases, self.last_used = 0, time.monotonic()
+        self.closed = False   # соединение разорвано
+        self.retired = False  # данные сервера изменились: закрыть после последнего возврата
+        self.sftp = None      # общий SFTP-клиент соединения (открывается при первом обращении)
+        self.sftp_lock = asyncio.Lock()
+
+    @property
+    def usable(self) -> bool:
+        return not self.closed and not self.retired
+
+class _PoolClient(asyncssh.SSHClient):
+    """Отмечает запись пула как закрытую, как только соединение разорвано."""
+    def __init__(self):
+        self.entry = None
+
+    def connection_lost(self, exc):
+        if self.entry:
+            self.entry.closed = True
+
+class SSHConnectionPool:
+    """Пул авторизованных SSH-соединений.
+
+    Ключ пула: (server_id, host, port, username, отпечаток пароля). Пул ограничивает
+    число соединений на host:port и общее число соединений, закрывает простаивающие
+    соединения по TTL и проверяет "долго молчавшие" соединения перед выдачей.
+    """
+
+    def __init__(self, idle_ttl: float = SSH_POOL_IDLE_TTL, max_per_host: int = SSH_POOL_MAX_PER_HOST,
+                 max_total: int = SSH_POOL_MAX_TOTAL, max_leases: int = SSH_POOL_MAX_LEASES,
+                 health_check_after: float = SSH_POOL_HEALTH_CHECK_AFTER):
+        self.idle_ttl, self.max_per_host, self.max_total = idle_ttl, max_per_host, max_total
+        self.max_leases, self.health_check_after = max_leases, health_check_after
+        self._entries = {}   # ключ -> [_PooledConnection]
+        self._pending = {}   # (host, port) -> число устанавливаемых соединений
+        self._cond = asyncio.Condition()
+        self._reaper_task = None
+
+    @staticmethod
+    def make_key(host: str, port: int, username: str, password: str, server_id: int = None) -> tuple:
+        return (server_id, host, int(port), username, credential_fingerprint(username, password))
+
+    def _all_entries(self):
+        for entries in self._entries.values():
+            yield from entries
+
+    def _host_count(self, host: str, port: int) -> int:
+        opened = sum(1 for e in self._all_entries() if e.key[1] == host and e.key[2] == port)
+        return opened + self._pending.get((host, port), 0)
+
+    def _total_count(self) -> int:
+        return sum(len(v) for v in self._entries.values()) + sum(self._pending.values())
+
+    def _discard(self, entry: _PooledConnection) -> None:
+        entries = self._entries.get(entry.key)
+        if entries and entry in entries:
+            entries.remove(entry)
+            if not entries:
+                del self._entries[entry.key]
+        if not entry.closed:
+            entry.closed = True
+            entry.conn.close()
+
+    def _prune(self) -> None:
+        """Убирает разорванные, выведенные из оборота и простаивающие дольше TTL соединения."""
+        now = time.monotonic()
+        for entry in list(self._all_entries()):
+            if entry.leases:
+                continue
+            if not entry.usable or now - entry.last_used > self.idle_ttl:
+                self._discard(entry)
+
+    def _evict_idle(self, host: str = None, port: int = None) -> bool:
+        """Закрывает самое давно не использовавшееся свободное соединение (всего пула или одного host:port)."""
+        idle = [e for e in self._all_entries() if not e.leases and (host is None or e.key[1:3] == (host, port))]
+        if not idle:
+            return False
+        self._discard(min(idle, key=lambda e: e.last_used))
+        return True
+
+    @ssh_operation('connect', 'connect')
+    async def _open(self, host: str, port: int, username: str, password: str):
+        client = _PoolClient()
+        conn = await asyncssh.connect(host=host, port=port, username=username, password=password,
+                                      known_hosts=None, connect_timeout=10, keepalive_interval=30,
+                                      keepalive_count_max=3, client_factory=lambda: client)
+        return conn, client
+
+    async def _is_alive(self, entry: _PooledConnection) -> bool:
+        if entry.closed:
+            return False
+        try:
+            await asyncio.wait_for(entry.conn.run('true', check=False), timeout=5.0)
+            return True
+        except Exception:
+            return False
+
+    async def acquire(self, host: str, port: int, username: str, password: str, server_id: int = None) -> _PooledConnection:
+        """Выдает соединение из пула (или открывает новое). Обязательно вернуть через release()."""
+        port = int(port)
+        key = self.make_key(host, port, username, password, server_id)
+        while True:
+            entry = None
+            async with self._cond:
+                while True:
+                    self._prune()
+                    candidates = [e for e in self._entries.get(key, []) if e.usable and e.leases < self.max_leases]
+                    if candidates:
+                        entry = min(candidates, key=lambda e: e.leases)
+                        entry.leases += 1
+                        break
+                    if self._host_count(host, port) < self.max_per_host or self._evict_idle(host, port):
+                        if self._total_count() < self.max_total or self._evict_idle():
+                            self._pending[(host, port)] = self._pending.get((host, port), 0) + 1
+                            break
+                    await self._cond.wait()
+
+            if entry is not None:
+                # Соединение давно простаивало — проверяем, живо ли оно, прежде чем отдавать
+                if entry.leases == 1 and time.monotonic() - entry.last_used > self.health_check_after:
+                    if not await self._is_alive(entry):
+                        logging.info(f"SSH-соединение {host}:{port} из пула не отвечает, переподключаюсь")
+                        await self.release(entry, broken=True)
+                        continue
+                return entry
+
+            try:
+                conn, client = await self._open(host, port, username, password)
+            except BaseException:
+                async with self._cond:
+                    self._release_pending(host, port)
+                    self._cond.notify_all()
+                raise
+            async with self._cond:
+                self._release_pending(host, port)
+                entry = _PooledConnection(conn, key)
+                client.entry = entry
+                entry.leases = 1
+                self._entries.setdefault(key, []).append(entry)
+                self._cond.notify_all()
+            return entry
+
+    def _release_pending(self, host: str, port: int) -> None:
+        left = self._pending.get((host, port), 0) - 1
+        if left > 0:
+            self._pending[(host, port)] = left
+        else:
+            self._pending.pop((host, port), None)
+
+    async def release(self, entry: _PooledConnection, broken: bool = False) -> None:
+        async with self._cond:
+            entry.leases -= 1
+            entry.last_used = time.monotonic()
+            if broken:
+                entry.closed = True
+                entry.conn.close()
+            if entry.leases <= 0 and not entry.usable:
+                self._discard(entry)
+            self._cond.notify_all()
+
+    async def _acquire_warm(self, key: tuple) -> _PooledConnection or None:
+        """Свободный канал в уже открытом и недавно использованном соединении — без ожидания и без новых соединений."""
+        async with self._cond:
+            candidates = [e for e in self._entries.get(key, []) if e.usable and e.leases < self.max_leases
+                          and time.monotonic() - e.last_used <= self.health_check_after]
+            if not candidates:
+                return None
+            entry = min(candidates, key=lambda e: e.leases)
+            entry.leases += 1
+            return entry
+
+    @asynccontextmanager
+    async def connection(self, host: str, port: int, username: str, password: str, server_id: int = None,
+                         background: bool = False):
+        """Контекстный менеджер: `async with ssh_pool.connection(...) as conn:`.
+
+        background=True — для фоновых задач (сбор метрик): берется открытое соединение из пула, если оно
+        есть, иначе открывается отдельное, которое закрывается после использования. Такие соединения
+        не занимают места в пуле, не ждут его лимитов и не вытесняют соединения пользователей.
+        """
+        entry = await self._acquire_warm(self.make_key(host, int(port), username, password, server_id)) if background else None
+        if background and entry is None:
+            conn, _ = await self._open(host, int(port), username, password)
+            try:
+                yield conn
+            finally:
+                conn.close()
+            return
+        if entry is None:
+            entry = await self.acquire(host, port, username, password, server_id)
+        broken = False
+        try:
+            yield entry.conn
+        except (asyncssh.DisconnectError, asyncssh.ConnectionLost, ConnectionError):
+            broken = True
+            raise
+        finally:
+            await self.release(entry, broken=broken)
+
+    async def sftp_client(self, conn) -> asyncssh.SFTPClient:
+        """Общий SFTP-клиент соединения из пула.
+
+        Канал SFTP открывается один раз на соединение и переиспользуется всеми вызовами:
+        запросы в нем мультиплексируются, а повторное открытие подсистемы стоит целого RTT.
+        Клиент не нужно закрывать — он закрывается вместе с соединением.
+        """
+        entry = next((e for e in self._all_entries() if e.conn is conn), None)
+        if entry is None:
+            return await conn.start_sftp_client()  # соединение не из пула
+        async with entry.sftp_lock:
+            if entry.sftp is None:
+                sftp = await conn.start_sftp_client()
+                entry.sftp = sftp
+
+                def forget(_):
+                    if entry.sftp is sftp:
+                        entry.sftp = None
+                asyncio.ensure_future(sftp.wait_closed()).add_done_callback(forget)
+            return entry.sftp
+
+    def stats(self) -> dict:
+        """Состояние пула для метрик."""
+        entries = list(self._all_entries())
+        return {'open': len(entries), 'pending': sum(self._pending.values()),
+                'busy': sum(1 for e in entries if e.leases), 'channels': sum(e.leases for e in entries)}
+
+    def invalidate_server(self, server_id: int) -> None:
+        """Выводит из оборота все соединения сервера (смена пароля, удаление).
+
+        Свободные соединения закрываются сразу, занятые — после возврата в пул.
+        """
+        for entry in list(self._all_entries()):
+            if entry.key[0] != server_id:
+                continue
+            entry.retired = True
+            if not entry.leases:
+                self._discard(entry)
+
+    async def _reaper(self) -> None:
+        while True:
+            await asyncio.sleep(max(self.idle_ttl / 4, 5))
+            async with self._cond:
+                self._prune()
+                self._cond.notify_all()
+
+    def start(self) -> None:
+        """Запускает фоновую очистку простаивающих соединений."""
+        if self._reaper_task is None:
+            self._reaper_task = asyncio.create_task(self._reaper())
+
+    async def close(self) -> None:
+        if self._reaper_task:
+            self._reaper_task.cancel()
+            self._reaper_task = None
+        for entry in list(self._all_entries()):
+            self._discard(entry)
+
+ssh_pool = SSHConnectionPool()
+
+# --- Интерактивные shell-сессии терминала ---
+# Вместо отдельного `conn.run()` на каждую команду держим на пользователя и сервер
+# один долгоживущий shell с PTY: `cd`, переменные окружения и прогретый shell
+# сохраняются между командами. Команда пишется в stdin, а конец ее вывода
+# отмечается уникальным маркером с кодом выхода.
+SHELL_IDLE_TTL = float(os.getenv('SHELL_IDLE_TTL', 600))        # сек. простоя до закрытия сессии
+SHELL_MAX_SESSIONS = int(os.getenv('SHELL_MAX_SESSIONS', 50))   # одновременно открытых сессий
+
+_SENTINEL_PREFIX = '__KDS_END_'
+_STALE_SENTINEL_RE = re.compile(r'\n?__KDS_END_[0-9a-f]{12}_\d+__\n?')
+_ANSI_RE = re.compile(r'\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[@-Z\\-_])')
+
+def _could_be_sentinel(tail: str, token: str) -> bool:
+    """True, если `tail` (начинается с перевода строки) может быть началом маркера конца команды."""
+    marker = f"\n{_SENTINEL_PREFIX}{token}_"
+    if marker.startswith(tail):
+        return True
+    return tail.startswith(marker) and re.fullmatch(r'\d*_?_?', tail[len(marker):]) is not None
+
+class ShellSessionError(Exception):
+    pass
+
+class ShellSession:
+    """Долгоживущий PTY-shell на соединении из пула."""
+
+    def __init__(self, pool: SSHConnectionPool, entry: _PooledConnection, process):
+        self.pool, self.entry, self.process = pool, entry, process
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+        self.last_exit_status = None
+        self.closed = False
+        self._released = False
+
+    @classmethod
+    async def open(cls, pool: SSHConnectionPool, host: str, port: int, username: str, password: str, server_id: int = None):
+        entry = await pool.acquire(host, port, username, password, server_id)
+        try:
+            process = await entry.conn.create_process(term_type='dumb', term_size=(200, 50), encoding='utf-8', errors='replace')
+        except BaseException:
+            await pool.release(entry)
+            raise
+        session = cls(pool, entry, process)
+        try:
+            # Отключаем эхо, приглашения и bracketed paste, затем "проглатываем" MOTD
+            process.stdin.write("stty -echo 2>/dev/null; PS1=''; PS2=''; PROMPT_COMMAND=''; "
+                                "bind 'set enable-bracketed-paste off' 2>/dev/null\n")
+            async for _ in session._read_until(session._write_sentinel(), timeout=15.0):
+                pass
+        except BaseException:
+            await session.close()
+            raise
+        return session
+
+    @property
+    def alive(self) -> bool:
+        return not self.closed and self.entry.usable and not self.process.stdout.at_eof()
+
+    @property
+    def busy(self) -> bool:
+        return self.lock.locked()
+
+    def _write_sentinel(self) -> str:
+        token = os.urandom(6).hex()
+        self.process.stdin.write(f"printf '\\n{_SENTINEL_PREFIX}{token}_%s__\\n' \"$?\"\n")
+        return token
+
+    async def _read_until(self, token: str, timeout: float):
+        """Читает вывод кусками до маркера `token`, отдавая очищенный текст по мере поступления."""
+        end_re = re.compile(r'\n?' + re.escape(f"{_SENTINEL_PREFIX}{token}_") + r'(\d+)__\n')
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        buf = ''
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            chunk = await asyncio.wait_for(self.process.stdout.read(4096), timeout=remaining)
+            if not chunk:
+                self.closed = True
+                tail = _STALE_SENTINEL_RE.sub('', _ANSI_RE.sub('', buf))
+                if tail:
+                    yield tail
+                raise ShellSessionError("Shell-сессия завершилась.")
+            buf = _ANSI_RE.sub('', (buf + chunk).replace('\r\n', '\n'))
+            match = end_re.search(buf)
+            if match:
+                self.last_exit_status = int(match.group(1))
+                out = _STALE_SENTINEL_RE.sub('', buf[:match.start()])
+                if out:
+                    yield out
+                return
+            # Придерживаем только "хвост", который может оказаться началом маркера
+            # или незавершенной escape-последовательностью; остальное отдаем сразу
+            cut = len(buf)
+            nl = buf.rfind('\n')
+            if nl != -1 and _could_be_sentinel(buf[nl:], token):
+                cut = nl
+            esc = buf.rfind('\x1b', max(cut - 16, 0), cut)
+            if esc != -1:
+                cut = esc
+            if cut and buf[cut - 1] == '\r':
+                cut -= 1
+            out, buf = _STALE_SENTINEL_RE.sub('', buf[:cut]), buf[cut:]
+            if out:
+                yield out
+
+    async def stream(self, command: str, timeout: float):
+        """Выполняет команду в shell и отдает ее вывод кусками. Код выхода — в `last_exit_status`."""
+        async with self.lock:
+            self.last_used = time.monotonic()
+            self.last_exit_status = None
+            done = False
+            try:
+                self.process.stdin.write(command.rstrip('\n') + '\n')
+                async for out in self._read_until(self._write_sentinel(), timeout=timeout):
+                    yield out
+                done = True
+            finally:
+                # Таймаут, отмена задачи или брошенный генератор: команда еще идет, прерываем ее
+                if not done and not self.closed:
+                    await self._interrupt()
+                self.last_used = time.monotonic()
+
+    async def _interrupt(self) -> None:
+        """Прерывает текущую команду (Ctrl+C) и синхронизируется с shell; при неудаче закрывает сессию."""
+        if self.closed:
+            return
+        try:
+            self.process.stdin.write('\x03')
+            async for _ in self._read_until(self._write_sentinel(), timeout=5.0):
+                pass
+        except BaseException:
+            await self.close()
+
+    async def run(self, command: str, timeout: float = 30.0):
+        """Выполняет команду и возвращает весь вывод целиком: (bool, output)."""
+        parts = []
+        try:
+            async for out in self.stream(command, timeout):
+                parts.append(out)
+        except asyncio.TimeoutError:
+            return False, f"Ошибка: Таймаут выполнения ({int(timeout)} секунд)."
+        except Exception as e:
+            return False, f"Ошибка выполнения: {e}"
+        output = ''.join(parts).strip('\n')
+        return True, output if output else "Команда выполнена. Нет вывода."
+
+    async def close(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        self.closed = True
+        try:
+            self.process.close()
+        except Exception:
+            pass
+        await self.pool.release(self.entry)
+
+class ShellSessionManager:
+    """Хранит shell-сессии по ключу (telegram_id, server_id) с TTL простоя и общим лимитом."""
+
+    def __init__(self, pool: SSHConnectionPool, max_sessions: int = SHELL_MAX_SESSIONS, idle_ttl: float = SHELL_IDLE_TTL):
+        self.pool, self.max_sessions, self.idle_ttl = pool, max_sessions, idle_ttl
+        self._sessions = {}    # (telegram_id, server_id) -> ShellSession
+        self._fingerprints = {}
+        self._key_locks = {}
+        self._opening = 0
+        self._reaper_task = None
+        self._prewarm_tasks = {}  # (telegram_id, server_id) -> задача prewarm
+
+    async def _close_key(self, key: tuple) -> None:
+        session = self._sessions.pop(key, None)
+        self._fingerprints.pop(key, None)
+        if session:
+            await session.close()
+
+    async def _evict_lru(self) -> bool:
+        idle = [(s.last_used, k) for k, s in self._sessions.items() if not s.busy]
+        if not idle:
+            return False
+        await self._close_key(min(idle)[1])
+        return True
+
+    async def _reap(self) -> None:
+        now = time.monotonic()
+        for key, session in list(self._sessions.items()):
+            if not session.busy and (not session.alive or now - session.last_used > self.idle_ttl):
+                await self._close_key(key)
+
+    async def get(self, telegram_id: int, host: str, port: int, username: str, password: str, server_id: int) -> ShellSession:
+        """Возвращает открытую сессию или открывает новую. Бросает ShellSessionError при превышении лимита."""
+        key = (telegram_id, server_id)
+        fingerprint = credential_fingerprint(username, password) + f"@{host}:{port}"
+        async with self._key_locks.setdefault(key, asyncio.Lock()):
+            session = self._sessions.get(key)
+            if session and session.alive and self._fingerprints.get(key) == fingerprint:
+                return session
+            await self._close_key(key)
+            await self._reap()
+            if len(self._sessions) + self._opening >= self.max_sessions and not await self._evict_lru():
+                raise ShellSessionError("Достигнут лимит одновременных терминальных сессий. Попробуйте позже.")
+            self._opening += 1
+            try:
+                session = await ShellSession.open(self.pool, host, port, username, password, server_id)
+            finally:
+                self._opening -= 1
+            self._sessions[key], self._fingerprints[key] = session, fingerprint
+            return session
+
+    def prewarm(self, telegram_id: int, host: str, port: int, username: str, password: str, server_id: int) -> None:
+        """Заранее открывает сессию в фоне (например, при входе в терминал), ошибки только логируются.
+        Задачи хранит менеджер: одна на ключ, close_all их отменяет."""
+        key = (telegram_id, server_id)
+        if key not in self._prewarm_tasks:
+            task = asyncio.create_task(self._prewarm(telegram_id, host, port, username, password, server_id))
+            self._prewarm_tasks[key] = task
+            task.add_done_callback(lambda _: self._prewarm_tasks.pop(key, None))
+
+    async def _prewarm(self, telegram_id: int, host: str, port: int, username: str, password: str, server_id: int) -> None:
+        try:
+            await self.get(telegram_id, host, port, username, password, server_id)
+        except Exception as e:
+            logging.info(f"Не удалось заранее открыть shell-сессию для сервера {server_id}: {e}")
+
+    async def run(self, telegram_id: int, host: str, port: int, username: str, password: str, command: str,
+                  server_id: int, timeout: float = 30.0):
+        """Выполняет команду в сессии пользователя: (bool, output)."""
+        try:
+            session = await self.get(telegram_id, host, port, username, password, server_id)
+        except ShellSessionError as e:
+            return False, f"Ошибка: {e}"
+        except Exception as e:
+            return False, f"Ошибка подключения: {e}"
+        return await session.run(command, timeout)
+
+    async def close(self, telegram_id: int, server_id: int) -> None:
+        await self._close_key((telegram_id, server_id))
+        self._key_locks.pop((telegram_id, server_id), None)
+
+    async def close_server(self, server_id: int) -> None:
+        """Закрывает все сессии сервера (смена пароля, удаление)."""
+        for key in [k for k in self._sessions if k[1] == server_id]:
+            await self._close_key(key)
+
+    async def _reaper(self) -> None:
+        while True:
+            await asyncio.sleep(60)
+            try:
+                await self._reap()
+            except Exception as e:
+                logging.error(f"Ошибка очистки shell-сессий: {e}")
+
+    def start(self) -> None:
+        if self._reaper_task is None:
+            self._reaper_task = asyncio.create_task(self._reaper())
+
+    async def close_all(self) -> None:
+        if self._reaper_task:
+            self._reaper_task.cancel()
+            self._reaper_task = None
+        for task in list(self._prewarm_tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._prewarm_tasks.values(), return_exceptions=True)
+        for key in list(self._sessions):
+            await self._close_key(key)
+
+shell_sessions = ShellSessionManager(ssh_pool)
 
 async def check_ssh_connection(host, port, username, password):
+    # Проверка новых учетных данных всегда идет "мимо" пула
     try:
         async with asyncssh.connect(host=host, port=port, username=username, password=password, known_hosts=None, connect_timeout=10) as conn: return True, "Успешное подключение."
     except Exception as e: return False, f"Ошибка: {e}"
 
-async def reboot_server(host, port, username, password):
+@ssh_operation('exec')
+async def reboot_server(host, port, username, password, server_id: int = None):
     try:
-        async with asyncssh.connect(host=host, port=port, username=username, password=password, known_hosts=None, connect_timeout=10) as conn: await conn.run('sudo -S reboot', input=password + '\n'); return True, "Команда на перезагрузку отправлена."
+        async with ssh_pool.connection(host, port, username, password, server_id) as conn: await conn.run('sudo -S reboot', input=password + '\n'); return True, "Команда на перезагрузку отправлена."
     except Exception as e: return False, f"Ошибка: {e}"
 
-async def shutdown_server(host, port, username, password):
+@ssh_operation('exec')
+async def shutdown_server(host, port, username, password, server_id: int = None):
     try:
-        async with asyncssh.connect(host=host, port=port, username=username, password=password, known_hosts=None, connect_timeout=10) as conn: await conn.run('sudo -S shutdown -h now', input=password + '\n'); return True, "Команда на выключение отправлена."
+        async with ssh_pool.connection(host, port, username, password, server_id) as conn: await conn.run('sudo -S shutdown -h now', input=password + '\n'); return True, "Команда на выключение отправлена."
     except Exception as e: return False, f"Ошибка: {e}"
 
-async def execute_command(host, port, username, password, command):
+@ssh_operation('exec')
+async def execute_command(host, port, username, password, command, server_id: int = None):
     try:
-        async with asyncssh.connect(host=host, port=port, username=username, password=password, known_hosts=None, connect_timeout=10) as conn:
+        async with ssh_pool.connection(host, port, username, password, server_id) as conn:
             result = await asyncio.wait_for(conn.run(command, check=False), timeout=30.0); output = (result.stdout or "") + (result.stderr or ""); return True, output.strip() if output else "Команда выполнена. Нет вывода."
     except asyncio.TimeoutError: return False, "Ошибка: Таймаут выполнения (30 секунд)."
     except Exception as e: return False, f"Ошибка выполнения: {e}"
 
-async def list_directory(host, port, username, password, path):
-    command = f"ls -la --full-time '{path}'"
+@dataclass
+class FileEntry:
+    """Запись каталога из SFTP readdir (атрибуты как у lstat: ссылка описывает саму себя)."""
+    name: str
+    type: str                          # 'dir', 'file', 'link' или 'other'
+    size: int = 0
+    mtime: int = 0
+    mode: int = 0
+    link_target: Optional[str] = None  # для ссылок — куда указывает
+    target_is_dir: bool = False        # ссылка на каталог: по ней можно перейти
+
+    @property
+    def is_dir(self) -> bool:
+        return self.type == 'dir' or self.target_is_dir
+
+    @property
+    def permissions(self) -> str:
+        return stat.filemode(self.mode)
+
+def _entry_type(mode: int) -> str:
+    if stat.S_ISDIR(mode): return 'dir'
+    if stat.S_ISLNK(mode): return 'link'
+    if stat.S_ISREG(mode): return 'file'
+    return 'other'
+
+async def _resolve_link(sftp, path: str, entry: FileEntry) -> None:
+    try:
+        entry.link_target = await sftp.readlink(path)
+        target = await sftp.stat(path)
+        entry.target_is_dir = stat.S_ISDIR(target.permissions or 0)
+        entry.size = target.size or 0
+    except (asyncssh.SFTPError, OSError):
+        pass  # битая ссылка или нет прав — показываем как есть
+
+@ssh_operation('sftp')
+async def list_directory(host, port, username, password, path, server_id: int = None):
+    """Листинг каталога через SFTP readdir: без shell и разбора `ls`, корректно для любых имен.
+    Возвращает (bool, [FileEntry] или текст ошибки)."""
     try:
-        async with asyncssh.connect(host=host, port=port, username=username, password=password, known_hosts=None, connect_timeout=10) as conn:
-            result = await asyncio.wait_for(conn.run(command, check=True), timeout=15.0); files = []
-            lines = result.stdout.strip().split('\n')
-            for line in lines[1:]:
-                parts = re.split(r'\s+', line, 8);
-                if len(parts) < 9: continue
-                perms, _, owner, group, size, _, _, _, name = parts
-                if name in ('.', '..', './', '../'): continue
-                is_dir = perms.startswith('d')
-                files.append({"name": name.strip('/'), "type": "dir" if is_dir else "file", "size": int(size), "permissions": perms})
-            files.sort(key=lambda x: (x['type'] != 'dir', x['name'])); return True, files
+        async with ssh_pool.connection(host, port, username, password, server_id) as conn:
+            sftp = await ssh_pool.sftp_client(conn)
+            names = await asyncio.wait_for(sftp.readdir(path), timeout=15.0)
+            files, links = [], []
+            for name in names:
+                if name.filename in ('.', '..'): continue
+                attrs = name.attrs
+                mode = attrs.permissions or 0
+                entry = FileEntry(name=name.filename, type=_entry_type(mode), size=attrs.size or 0,
+                                  mtime=int(attrs.mtime or 0), mode=mode)
+                files.append(entry)
+                if entry.type == 'link':
+                    links.append(_resolve_link(sftp, posixpath.join(path, name.filename), entry))
+            if links:
+                await asyncio.wait_for(asyncio.gather(*links), timeout=15.0)
+            files.sort(key=lambda x: (not x.is_dir, x.name)); return True, files
     except asyncio.TimeoutError: return False, "Тайм-аут получения списка файлов (15 секунд)."
+    except asyncssh.SFTPNoSuchFile: return False, "Каталог не найден."
+    except asyncssh.SFTPPermissionDenied: return False, "Нет доступа к каталогу."
     except Exception as e: return False, f"Общая ошибка: {e}"
 
-async def download_file(host, port, username, password, remote_path):
+SFTP_BLOCK_SIZE = 64 * 1024  # байт в одном SFTP-запросе чтения/записи
+SFTP_MAX_REQUESTS = 32       # запросов "в полете" одновременно: скачивание идет параллельными кусками
+
+@ssh_operation('sftp')
+async def download_file(host, port, username, password, remote_path, local_path, max_size: int = 50 * 1024 * 1024,
+                        reserve=None, server_id: int = None):
+    """Скачивает файл в local_path параллельными кусками, не держа его в памяти.
+
+    reserve(size) вызывается после stat, до начала передачи (например, чтобы занять место на диске)
+    и может бросить исключение, отменяющее скачивание. Возвращает (bool, размер или текст ошибки).
+    """
     try:
-        async with asyncssh.connect(host=host, port=port, username=username, password=password, known_hosts=None, connect_timeout=10) as conn:
-            async with conn.start_sftp_client() as sftp:
-                stats = await sftp.stat(remote_path)
-                if stats.size > 50 * 1024 * 1024: return False, "Файл слишком большой (> 50 МБ)."
-                async with sftp.open(remote_path, 'rb') as f: content = await f.read(); return True, content
+        async with ssh_pool.connection(host, port, username, password, server_id) as conn:
+            sftp = await ssh_pool.sftp_client(conn)
+            stats = await sftp.stat(remote_path)
+            if stats.size > max_size: return False, f"Файл слишком большой (> {max_size // (1024 * 1024)} МБ)."
+            if reserve: reserve(stats.size)
+            await sftp.get(remote_path, local_path, block_size=SFTP_BLOCK_SIZE, max_requests=SFTP_MAX_REQUESTS)
+        size = os.path.getsize(local_path)
+        if size > max_size: return False, f"Файл слишком большой (> {max_size // (1024 * 1024)} МБ)."
+        return True, size
     except Exception as e: return False, f"Ошибка при скачивании: {e}"
 
-async def upload_file(host, port, username, password, file_content: bytes, remote_path: str):
+@ssh_operation('sftp')
+async def upload_file(host, port, username, password, chunks, remote_path: str, size: int = None,
+                      progress=None, server_id: int = None):
+    """Загружает файл из асинхронного итератора кусков (bytes) без буферизации целиком.
+
+    Куски пишутся по смещениям, до SFTP_MAX_REQUESTS записей одновременно, во временный файл
+    рядом с remote_path. После проверки размера и sha256 (если на сервере есть sha256sum)
+    временный файл атомарно переименовывается в remote_path. `await progress(загружено)`
+    вызывается после каждого куска. Возвращает (bool, сообщение).
+    """
+    directory, name = os.path.split(remote_path)
+    tmp_path = os.path.join(directory, f".{name}.kds-{os.urandom(4).hex()}.part")
     try:
-        async with asyncssh.connect(host=host, port=port, username=username, password=password, known_hosts=None, connect_timeout=10) as conn:
-            async with conn.start_sftp_client() as sftp:
-                async with sftp.open(remote_path, 'wb') as f: await f.write(file_content); return True, "Файл успешно загружен."
+        async with ssh_pool.connection(host, port, username, password, server_id) as conn:
+            sftp = await ssh_pool.sftp_client(conn)
+            digest, offset, pending = hashlib.sha256(), 0, set()
+            try:
+                async with sftp.open(tmp_path, 'wb') as f:
+                    try:
+                        async for chunk in chunks:
+                            if len(pending) >= SFTP_MAX_REQUESTS:
+                                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                                for task in done: task.result()
+                            pending.add(asyncio.create_task(f.write(chunk, offset)))
+                            digest.update(chunk)
+                            offset += len(chunk)
+                            if progress: await progress(offset)
+                        await asyncio.gather(*pending)
+                    finally:
+                        # Незавершенные записи отменяем до закрытия файла
+                        for task in pending: task.cancel()
+                        await asyncio.gather(*pending, return_exceptions=True)
+                if size is not None and offset != size:
+                    return False, f"Получено {offset} байт вместо {size}."
+                remote_size = (await sftp.stat(tmp_path)).size
+                if remote_size != offset:
+                    return False, f"На сервере записано {remote_size} байт вместо {offset}."
+                res = await conn.run(f"sha256sum -- {shlex.quote(tmp_path)}", check=False)
+                if res.exit_status == 0 and res.stdout.split()[0] != digest.hexdigest():
+                    return False, "Контрольная сумма файла на сервере не совпала."
+                try:
+                    await sftp.posix_rename(tmp_path, remote_path)
+                except asyncssh.SFTPOpUnsupported:
+                    if await sftp.exists(remote_path): await sftp.remove(remote_path)
+                    await sftp.rename(tmp_path, remote_path)
+                tmp_path = None
+                return True, "Файл успешно загружен."
+            finally:
+                if tmp_path:
+                    try: await sftp.remove(tmp_path)
+                    except (asyncssh.Error, OSError): pass
     except Exception as e: return False, f"Общая ошибка при загрузке: {e}"
 
-async def get_system_info(host, port, username, password):
+@ssh_operation('exec')
+async def get_system_info(host, port, username, password, server_id: int = None):
     info = {'hostname': 'н/д', 'os': 'н/д', 'kernel': 'н/д', 'uptime': 'н/д', 'status': '🔴 Офлайн'}
     try:
-        async with asyncssh.connect(host=host, port=port, username=username, password=password, known_hosts=None, connect_timeout=10) as conn:
+        async with ssh_pool.connection(host, port, username, password, server_id) as conn:
             info['status'] = '🟢 Онлайн'
-            cmds = {'hostname': 'hostname', 'os': 'lsb_release -ds', 'kernel': 'uname -r', 'uptime': 'uptime -p'}
-            results = await asyncio.gather(*[conn.run(cmd, check=True) for cmd in cmds.values()], return_exceptions=True)
-            for k, res in zip(cmds.keys(), results):
-                if not isinstance(res, Exception): info[k] = res.stdout.strip().replace('up ', '') if res.stdout else 'н/д'
+            # Все поля одной командой (один канал) в виде key=value
+            res = await conn.run(
+                'echo "hostname=$(hostname)"; '
+                'echo "os=$(lsb_release -ds 2>/dev/null || (. /etc/os-release 2>/dev/null && echo "$PRETTY_NAME"))"; '
+                'echo "kernel=$(uname -r)"; echo "uptime=$(uptime -p 2>/dev/null)"', check=False)
+            for line in (res.stdout or '').splitlines():
+                key, _, value = line.partition('=')
+                if key in info and value.strip():
+                    info[key] = value.strip().strip('"').replace('up ', '') if key == 'uptime' else value.strip().strip('"')
             return True, info
     except Exception: return False, info
 
-# НОВАЯ ФУНКЦИЯ
-async def get_system_load(host, port, username, password):
-    """Собирает информацию о нагрузке на систему."""
-    load_info = {'cpu': 'н/д', 'ram': 'н/д', 'disk': 'н/д'}
-    try:
-        async with asyncssh.connect(
-            host=host, port=port, username=username, password=password,
-            known_hosts=None, connect_timeout=10
-        ) as conn:
-            # CPU
-            try:
-                cpu_result = await conn.run("top -bn1 | grep 'Cpu(s)' | awk '{print $2 + $4}'", check=True)
-                load_info['cpu'] = f"{float(cpu_result.stdout.strip()):.1f}%"
-            except Exception: pass
+@dataclass
+class LoadSample:
+    """Разобранный вывод _LOAD_SCRIPT. Байты — в байтах, CPU — в процентах за время с прошлого замера."""
+    cpu_total: int = 0           # сумма тиков CPU из /proc/stat
+    cpu_idle: int = 0            # idle + iowait
+    cpu_pct: Optional[float] = None
+    load1: Optional[float] = None
+    load5: Optional[float] = None
+    load15: Optional[float] = None
+    mem_used: Optional[int] = None
+    mem_total: Optional[int] = None
+    disk_used: Optional[int] = None
+    disk_total: Optional[int] = None
+    net_rx: Optional[int] = None  # байт принято/отправлено всеми интерфейсами, кроме lo, с загрузки
+    net_tx: Optional[int] = None
+    uptime: Optional[float] = None
 
-            # RAM
-            try:
-                ram_result = await conn.run("free -m | grep Mem | awk '{print $3\"/\"$2}'", check=True)
-                load_info['ram'] = f"{ram_result.stdout.strip()} MB"
-            except Exception: pass
+# Все источники за один exec: /proc читается почти мгновенно, в отличие от `top -bn1` (~1 с).
+# Секции помечены строками @имя и разбираются локально в parse_load_output.
+_LOAD_SCRIPT = ("echo @stat; head -1 /proc/stat; echo @meminfo; cat /proc/meminfo; echo @loadavg; cat /proc/loadavg; "
+                "echo @netdev; cat /proc/net/dev; echo @statvfs; stat -f -c '%S %b %f %a' /; echo @uptime; cat /proc/uptime")
+# Без подходящего предыдущего замера CPU% считаем по двум чтениям /proc/stat с короткой паузой
+_LOAD_SCRIPT_FIRST = "echo @stat0; head -1 /proc/stat; sleep 0.5; " + _LOAD_SCRIPT
+_cpu_counters = {}  # server_id или (host, port) -> (cpu_total, cpu_idle, time.monotonic())
+_CPU_WINDOW_MIN, _CPU_WINDOW_MAX = 1.0, 3600  # сек.: короче — слишком мало тиков, дольше — уже не "текущая" нагрузка
 
-            # Disk
-            try:
-                disk_result = await conn.run("df -h / | tail -1 | awk '{print $3\"/\"$2\" (\"$5\")'}", check=True)
-                load_info['disk'] = disk_result.stdout.strip()
-            except Exception: pass
+def _parse_cpu(line: str) -> tuple:
+    # cpu user nice system idle iowait irq softirq steal [guest guest_nice] — guest уже входит в user
+    values = [int(v) for v in line.split()[1:9]]
+    return sum(values), values[3] + values[4]
 
-            return True, load_info
+def parse_load_output(output: str, previous: tuple = None) -> LoadSample:
+    sections, current = {}, None
+    for line in output.splitlines():
+        if line.startswith('@'):
+            current = sections.setdefault(line[1:].strip(), [])
+        elif current is not None:
+            current.append(line)
+    sample = LoadSample()
+    for name, lines in sections.items():
+        try:
+            if name == 'stat':
+                sample.cpu_total, sample.cpu_idle = _parse_cpu(lines[0])
+            elif name == 'stat0':
+                previous = _parse_cpu(lines[0])
+            elif name == 'meminfo':
+                mem = {k: int(v.split()[0]) * 1024 for k, _, v in (l.partition(':') for l in lines) if v.strip()}
+                available = mem.get('MemAvailable', mem.get('MemFree', 0) + mem.get('Buffers', 0) + mem.get('Cached', 0))
+                sample.mem_total, sample.mem_used = mem['MemTotal'], mem['MemTotal'] - available
+            elif name == 'loadavg':
+                sample.load1, sample.load5, sample.load15 = (float(v) for v in lines[0].split()[:3])
+            elif name == 'netdev':
+                rx = tx = 0
+                for l in lines[2:]:
+                    iface, _, counters = l.partition(':')
+                    if iface.strip() != 'lo' and counters:
+                        fields = counters.split()
+                        rx, tx = rx + int(fields[0]), tx + int(fields[8])
+                sample.net_rx, sample.net_tx = rx, tx
+            elif name == 'statvfs':
+                bsize, blocks, free, avail = (int(v) for v in lines[0].split())
+                sample.disk_total, sample.disk_used = blocks * bsize, (blocks - free) * bsize
+            elif name == 'uptime':
+                sample.uptime = float(lines[0].split()[0])
+        except (IndexError, KeyError, ValueError):
+            pass  # секция недоступна на этой системе — поле остается None
+    if previous and sample.cpu_total:
+        d_total, d_idle = sample.cpu_total - previous[0], sample.cpu_idle - previous[1]
+        if d_total > 0:
+            sample.cpu_pct = round(max(0.0, min(100.0, 100.0 * (1 - d_idle / d_total))), 1)
+    return sample
+
+def format_load(load_info: dict) -> dict:
+    """Заполняет строки для показа ('cpu', 'ram', 'disk') по числовым полям замера."""
+    if load_info.get('cpu_pct') is not None:
+        load_info['cpu'] = f"{load_info['cpu_pct']:.1f}%"
+        if load_info.get('load1') is not None:
+            load_info['cpu'] += f" (LA {load_info['load1']:.2f})"
+    if load_info.get('mem_total'):
+        load_info['ram'] = f"{load_info['mem_used'] // 1048576}/{load_info['mem_total'] // 1048576} MB"
+    if load_info.get('disk_total'):
+        load_info['disk'] = (f"{load_info['disk_used'] / 1024 ** 3:.1f}G/{load_info['disk_total'] / 1024 ** 3:.1f}G "
+                             f"({load_info['disk_used'] * 100 // load_info['disk_total']}%)")
+    return load_info
+
+@ssh_operation('exec')
+async def sample_load(host, port, username, password, server_id: int = None, background: bool = False):
+    """Один замер нагрузки одним exec. Возвращает (bool, LoadSample или текст ошибки).
+    background — соединение для фоновой задачи (см. SSHConnectionPool.connection)."""
+    key = server_id if server_id is not None else (host, port)
+    cached = _cpu_counters.get(key)
+    previous = cached[:2] if cached and _CPU_WINDOW_MIN <= time.monotonic() - cached[2] <= _CPU_WINDOW_MAX else None
+    try:
+        async with ssh_pool.connection(host, port, username, password, server_id, background=background) as conn:
+            res = await conn.run(_LOAD_SCRIPT if previous else _LOAD_SCRIPT_FIRST, check=False)
     except Exception as e:
         return False, f"Ошибка подключения: {e}"
+    sample = parse_load_output(res.stdout or '', previous)
+    if sample.cpu_total:
+        _cpu_counters[key] = (sample.cpu_total, sample.cpu_idle, time.monotonic())
+    return True, sample
+
+async def get_system_load(host, port, username, password, server_id: int = None, background: bool = False):
+    """Собирает информацию о нагрузке на систему.
+
+    Кроме строк для показа ('cpu', 'ram', 'disk') возвращает числовые поля LoadSample для истории метрик.
+    """
+    success, sample = await sample_load(host, port, username, password, server_id, background)
+    if not success:
+        return False, sample
+    return True, format_load({'cpu': 'н/д', 'ram': 'н/д', 'disk': 'н/д', **asdict(sample)})
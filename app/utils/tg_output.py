@@ -0,0 +1,133 @@
+import asyncio
+import html
+import os
+import tempfile
+import time
+
+from aiogram import Bot, types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import BufferedInputFile
+
+# Telegram позволяет редактировать одно сообщение примерно раз в секунду,
+# поэтому обновления копятся и отправляются не чаще OUTPUT_EDIT_INTERVAL.
+OUTPUT_EDIT_INTERVAL = float(os.getenv('OUTPUT_EDIT_INTERVAL', 2.0))  # сек. между правками сообщения
+OUTPUT_PAGE_LIMIT = 3500          # символов вывода (после html.escape) в одном сообщении (лимит Telegram — 4096)
+OUTPUT_MAX_MESSAGES = int(os.getenv('OUTPUT_MAX_MESSAGES', 5))        # сообщений на один вывод, дальше — только файл
+OUTPUT_MAX_BYTES = int(os.getenv('OUTPUT_MAX_BYTES', 20 * 1024 * 1024))  # сколько вывода сохраняем для файла
+
+class LiveOutput:
+    """Показывает растущий вывод команды в Telegram.
+
+    Текст дописывается в текущее сообщение с троттлингом правок; заполненное сообщение
+    "замораживается" и вывод продолжается в новом. После OUTPUT_MAX_MESSAGES сообщений
+    новые страницы не отправляются, а полный вывод прикладывается файлом в конце.
+    """
+
+    def __init__(self, bot: Bot, message: types.Message, title: str, reply_markup=None,
+                 filename: str = "output.txt"):
+        self.bot, self.message, self.title = bot, message, title
+        self.reply_markup, self.filename = reply_markup, filename
+        self.page = ''  # вывод текущего сообщения, уже экранированный для HTML
+        self.pages_sent = 1
+        self.overflowed = False
+        self.dirty = False
+        self.next_edit_at = 0.0
+        self.lock = asyncio.Lock()
+        self.spool = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        self.spooled = 0
+        self.truncated = False
+
+    def _render(self, footer: str = '', final: bool = False) -> str:
+        body = self.page if self.page else ('Нет вывода.' if final else '…')
+        if self.overflowed and not final:
+            footer += "\n\n📎 Вывод продолжается, полный текст будет отправлен файлом."
+        return f"{self.title}\n<pre>{body}</pre>{footer}"
+
+    async def _edit(self, text: str, reply_markup=None, force: bool = False) -> None:
+        try:
+            await self.message.edit_text(text, reply_markup=reply_markup)
+        except TelegramRetryAfter as e:
+            if not force:
+                # Не ждем: правка просто откладывается до следующего куска или tick()
+                self.next_edit_at = time.monotonic() + e.retry_after
+                return
+            await asyncio.sleep(e.retry_after)
+            await self.message.edit_text(text, reply_markup=reply_markup)
+        except TelegramBadRequest as e:
+            if 'message is not modified' not in str(e):
+                raise
+        self.next_edit_at = time.monotonic() + OUTPUT_EDIT_INTERVAL
+        self.dirty = False
+
+    def _store(self, text: str) -> None:
+        data = text.encode('utf-8', errors='replace')
+        room = OUTPUT_MAX_BYTES - self.spooled
+        if len(data) > room:
+            data, self.truncated = data[:max(room, 0)], True
+        if data:
+            self.spool.write(data)
+            self.spooled += len(data)
+
+    @staticmethod
+    def _fit(text: str, room: int) -> int:
+        """Длина самого длинного начала text, которое после html.escape занимает не больше room символов."""
+        lo, hi = 0, len(text)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if len(html.escape(text[:mid])) <= room:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    async def feed(self, text: str) -> None:
+        """Добавляет кусок вывода; сообщение обновляется, только если истек интервал троттлинга."""
+        self._store(text)
+        async with self.lock:
+            if self.overflowed:
+                return
+            self.dirty = True
+            while text:
+                # Страница меряется после экранирования: "<" и "&" занимают в сообщении по 4-6 символов
+                escaped = html.escape(text)
+                room = OUTPUT_PAGE_LIMIT - len(self.page)
+                if len(escaped) <= room:
+                    self.page += escaped
+                    break
+                cut = self._fit(text, room)
+                self.page += html.escape(text[:cut])
+                text = text[cut:]
+                if self.pages_sent >= OUTPUT_MAX_MESSAGES:
+                    # Сообщения кончились: оставляем последнюю страницу (с кнопкой отмены), остальное — в файл
+                    self.overflowed = True
+                    await self._edit(self._render(), reply_markup=self.reply_markup, force=True)
+                    return
+                # "Замораживаем" заполненную страницу и продолжаем в новом, пока пустом сообщении
+                await self._edit(self._render(), force=True)
+                self.page = ''
+                self.message = await self.bot.send_message(self.message.chat.id, self._render(),
+                                                           reply_markup=self.reply_markup)
+                self.pages_sent += 1
+                self.next_edit_at = time.monotonic() + OUTPUT_EDIT_INTERVAL
+            if time.monotonic() >= self.next_edit_at:
+                await self._edit(self._render(), reply_markup=self.reply_markup)
+
+    async def tick(self) -> None:
+        """Досылает отложенную правку, если вывод давно не менялся, а последний кусок еще не показан."""
+        async with self.lock:
+            if self.dirty and not self.overflowed and time.monotonic() >= self.next_edit_at:
+                await self._edit(self._render(), reply_markup=self.reply_markup)
+
+    async def finish(self, footer: str = '', reply_markup=None) -> None:
+        """Финальная правка сообщения и, если вывод не поместился, отправка полного вывода файлом."""
+        async with self.lock:
+            if self.overflowed:
+                footer += "\n\n📎 Вывод не поместился в сообщения, полный текст — в файле."
+            await self._edit(self._render(footer, final=True), reply_markup=reply_markup, force=True)
+            if self.overflowed:
+                self.spool.seek(0)
+                content = self.spool.read()
+                if self.truncated:
+                    content += f"\n... [вывод обрезан после {OUTPUT_MAX_BYTES // (1024 * 1024)} МБ]\n".encode()
+                await self.bot.send_document(self.message.chat.id, BufferedInputFile(content, filename=self.filename))
+            self.spool.close()
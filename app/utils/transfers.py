@@ -0,0 +1,70 @@
+import asyncio
+import os
+import tempfile
+from contextlib import asynccontextmanager
+
+# Передачи файлов идут через временные файлы на диске, а не через память бота.
+# Ограничения: число одновременных передач (всего и на пользователя) и место на диске под них.
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024    # Bot API не принимает документы больше 50 МБ
+TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024  # и не отдает боту файлы больше 20 МБ
+TRANSFER_DIR = os.getenv('TRANSFER_DIR') or tempfile.gettempdir()
+TRANSFER_MAX_GLOBAL = int(os.getenv('TRANSFER_MAX_GLOBAL', 8))      # одновременных передач на процесс бота
+TRANSFER_MAX_PER_USER = int(os.getenv('TRANSFER_MAX_PER_USER', 2))  # одновременных передач одного пользователя
+TRANSFER_DISK_QUOTA = int(os.getenv('TRANSFER_DISK_QUOTA', 512 * 1024 * 1024))  # байт временных файлов на всех
+
+class TransferError(Exception):
+    """Передачу нельзя начать: превышен лимит. Текст ошибки можно показывать пользователю."""
+
+class Transfer:
+    """Одна передача: временный файл и зарезервированное под него место."""
+
+    def __init__(self, manager: 'TransferManager', path: str):
+        self.manager, self.path = manager, path
+        self.reserved = 0
+
+    def reserve(self, size: int) -> None:
+        """Резервирует место под файл размером size (вызывается, когда размер стал известен)."""
+        extra = size - self.reserved
+        if extra > 0 and self.manager.disk_used + extra > self.manager.disk_quota:
+            raise TransferError("Сервер бота сейчас занят другими передачами, попробуйте через пару минут.")
+        self.manager.disk_used += extra
+        self.reserved = size
+
+class TransferManager:
+    def __init__(self, max_global: int = TRANSFER_MAX_GLOBAL, max_per_user: int = TRANSFER_MAX_PER_USER,
+                 disk_quota: int = TRANSFER_DISK_QUOTA, directory: str = TRANSFER_DIR):
+        self.semaphore = asyncio.Semaphore(max_global)
+        self.max_per_user, self.disk_quota, self.directory = max_per_user, disk_quota, directory
+        self.disk_used = 0
+        self._per_user = {}
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, suffix: str = '', spool: bool = True):
+        """Слот передачи для пользователя. Сверх лимита пользователя — TransferError сразу,
+        сверх общего лимита — ожидание в очереди. Временный файл (spool=True) удаляется на выходе."""
+        if self._per_user.get(user_id, 0) >= self.max_per_user:
+            raise TransferError(f"Одновременно можно передавать не больше {self.max_per_user} файлов. "
+                                "Дождитесь окончания текущих передач.")
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        try:
+            async with self.semaphore:
+                path = None
+                if spool:
+                    fd, path = tempfile.mkstemp(prefix='kds_', suffix=suffix, dir=self.directory)
+                    os.close(fd)
+                transfer = Transfer(self, path)
+                try:
+                    yield transfer
+                finally:
+                    self.disk_used -= transfer.reserved
+                    if path:
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+        finally:
+            self._per_user[user_id] -= 1
+            if not self._per_user[user_id]:
+                del self._per_user[user_id]
+
+transfers = TransferManager()
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+import asyncpg
+
+# Фоновое снятие истекших VIP и напоминания о скором окончании. Раз в VIP_SWEEP_INTERVAL
+# один запрос снимает is_vip у всех, чей срок прошел (по индексу idx_users_vip_expires), и еще
+# один ставит напоминания в очередь notifications. Что уже отправлено, записывается в vip_reminders
+# в том же запросе, поэтому после перезапуска или при нескольких процессах напоминание не повторится.
+VIP_SWEEP_INTERVAL = float(os.getenv('VIP_SWEEP_INTERVAL', 300))  # сек. между проверками
+VIP_REMINDER_DAYS = int(os.getenv('VIP_REMINDER_DAYS', 3))        # за сколько дней напоминать об окончании
+VIP_REMINDERS_KEEP_DAYS = 30  # дней хранения записей об отправленных напоминаниях после окончания срока
+
+REMINDER_TEXT = ("⏳ Ваш VIP-статус закончится <b>%s</b>.\n"
+                 "Продлить его можно в разделе «👑 VIP-подписка».")
+EXPIRED_TEXT = ("ℹ️ Срок вашего VIP-статуса истек.\n"
+                "Продлить его можно в разделе «👑 VIP-подписка».")
+
+# Истекшие VIP снимаются, а заблокировавшим бота не пишем. Возвращает id пользователей со снятым VIP.
+_EXPIRE_SQL = """
+    WITH expired AS (
+        UPDATE users SET is_vip = FALSE WHERE is_vip AND vip_expires <= $1
+        RETURNING id, telegram_id, vip_expires, is_blocked
+    ), marked AS (
+        INSERT INTO vip_reminders (user_id, vip_expires, kind)
+        SELECT id, vip_expires, 'expired' FROM expired WHERE NOT is_blocked
+        ON CONFLICT DO NOTHING RETURNING user_id
+    ), queued AS (
+        INSERT INTO notifications (telegram_id, text, next_attempt_at)
+        SELECT e.telegram_id, $2, $1 FROM expired e JOIN marked m ON m.user_id = e.id
+    )
+    SELECT id FROM expired"""
+
+_REMIND_SQL = """
+    WITH marked AS (
+        INSERT INTO vip_reminders (user_id, vip_expires, kind)
+        SELECT id, vip_expires, 'expires_soon' FROM users
+        WHERE is_vip AND vip_expires > $1 AND vip_expires <= $2 AND NOT is_blocked
+        ON CONFLICT DO NOTHING RETURNING user_id, vip_expires
+    )
+    INSERT INTO notifications (telegram_id, text, next_attempt_at)
+    SELECT u.telegram_id, format($3, to_char(m.vip_expires, 'DD.MM.YYYY')), $1
+    FROM marked m JOIN users u ON u.id = m.user_id"""
+
+class VipSweeper:
+    """on_sweep(expired_ids, reminders) вызывается после каждого прохода, в котором что-то изменилось
+    (сброс кеша пользователей, запуск отправки уведомлений)."""
+
+    def __init__(self, pool: asyncpg.Pool, on_sweep, interval: float = VIP_SWEEP_INTERVAL):
+        self.pool, self.on_sweep, self.interval = pool, on_sweep, interval
+        self._task = None
+
+    async def sweep(self) -> tuple:
+        """Один проход. Возвращает (id пользователей со снятым VIP, число поставленных напоминаний)."""
+        now = datetime.now()
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                expired = [r['id'] for r in await conn.fetch(_EXPIRE_SQL, now, EXPIRED_TEXT)]
+                status = await conn.execute(_REMIND_SQL, now, now + timedelta(days=VIP_REMINDER_DAYS), REMINDER_TEXT)
+                await conn.execute("DELETE FROM vip_reminders WHERE vip_expires < $1",
+                                   now - timedelta(days=VIP_REMINDERS_KEEP_DAYS))
+        reminders = int(status.split()[-1])  # "INSERT 0 <n>"
+        if expired or reminders:
+            logging.info(f"VIP: снято истекших — {len(expired)}, напоминаний в очереди — {reminders}")
+            await self.on_sweep(expired, reminders)
+        return expired, reminders
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logging.error(f"VIP: ошибка проверки сроков: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
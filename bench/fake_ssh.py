@@ -0,0 +1,212 @@
+import asyncio
+import os
+import re
+import shlex
+import time
+
+import asyncssh
+
+# Локальный SSH-сервер для бенчмарка. Принимает любой логин и пароль и ведет себя как
+# типичный Linux-сервер ровно настолько, насколько это нужно боту:
+#   * интерактивный shell (pty) — маленький интерпретатор: маркеры ShellSession, echo, seq, cat, sleep...;
+#   * exec — те же команды плюс готовые ответы на скрипты get_system_info и нагрузки (/proc);
+#   * SFTP — настоящий asyncssh.SFTPServer в chroot с подготовленным деревом файлов.
+# Задержка ответа (latency) добавляется к каждой команде, чтобы моделировать удаленный сервер.
+
+_PRINTF_RE = re.compile(r"""^printf '(.*)' "\$\?"$""")
+
+FAKE_FILES = {
+    'etc/hostname': b'bench-host\n',
+    'etc/os-release': b'PRETTY_NAME="Ubuntu 22.04.4 LTS"\nID=ubuntu\n',
+    'root/notes.txt': b'bench\n' * 100,
+    'root/logs/app.log': b''.join(b'2024-01-01 00:00:%02d INFO request served\n' % (i % 60) for i in range(5000)),
+}
+
+def build_tree(root: str, download_size: int, entries: int) -> None:
+    """Создает файлы сервера: FAKE_FILES, root/download.bin размером download_size,
+    каталог root/many с entries файлов (листинг файл-менеджера) и root/uploads для загрузок."""
+    for name, content in FAKE_FILES.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+    with open(os.path.join(root, 'root', 'download.bin'), 'wb') as f:
+        block = os.urandom(64 * 1024)
+        for offset in range(0, download_size, len(block)):
+            f.write(block[:download_size - offset])
+    os.makedirs(os.path.join(root, 'root', 'many'), exist_ok=True)
+    for i in range(entries):
+        with open(os.path.join(root, 'root', 'many', f'file_{i:04d}.txt'), 'wb') as f:
+            f.write(b'x' * (i % 4096))
+    os.makedirs(os.path.join(root, 'root', 'uploads'), exist_ok=True)
+
+class FakeCommands:
+    """Выполнение команд. run() возвращает (вывод, код выхода)."""
+
+    def __init__(self, root: str, latency: float = 0.0):
+        self.root, self.latency = root, latency
+        self.started = time.monotonic()
+
+    def _file(self, path: str) -> bytes or None:
+        full = os.path.normpath(os.path.join(self.root, path.lstrip('/')))
+        if not full.startswith(self.root) or not os.path.isfile(full):
+            return None
+        with open(full, 'rb') as f:
+            return f.read()
+
+    def system_info(self) -> str:
+        return ("hostname=bench-host\nos=Ubuntu 22.04.4 LTS\nkernel=5.15.0-105-generic\n"
+                f"uptime=up {int(time.monotonic() - self.started) // 60 + 1} minutes\n")
+
+    def load(self, command: str) -> str:
+        # Счетчики растут со временем, чтобы CPU% считался как на живом сервере
+        ticks = int((time.monotonic() - self.started) * 100)
+        stat = f"cpu  {1000 + ticks // 4} 0 {500 + ticks // 8} {90000 + ticks} 100 0 10 0 0 0"
+        sections = []
+        if '@stat0' in command:
+            sections += ['@stat0', stat]
+        sections += [
+            '@stat', stat,
+            '@meminfo', 'MemTotal:        4028856 kB', 'MemFree:          512000 kB', 'MemAvailable:    2014428 kB',
+            '@loadavg', '0.42 0.35 0.30 1/123 4567',
+            '@netdev', 'Inter-|   Receive', ' face |bytes', '    lo: 1000 0 0 0 0 0 0 0 1000 0 0 0 0 0 0 0',
+            f'  eth0: {10 ** 9 + ticks * 1000} 0 0 0 0 0 0 0 {10 ** 8 + ticks * 500} 0 0 0 0 0 0 0',
+            '@statvfs', '4096 10000000 6000000 5500000',
+            '@uptime', f'{time.monotonic() - self.started + 3600:.2f} 1000.00',
+        ]
+        return '\n'.join(sections) + '\n'
+
+    async def run(self, command: str) -> tuple:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if 'hostname=' in command:
+            return self.system_info(), 0
+        if '@stat' in command:
+            if '@stat0' in command:
+                await asyncio.sleep(0.5)
+            return self.load(command), 0
+        out, status = [], 0
+        for part in command.split(';'):
+            part = part.strip()
+            if part:
+                text, status = await self._simple(part)
+                out.append(text)
+        return ''.join(out), status
+
+    async def _simple(self, command: str) -> tuple:
+        try:
+            argv = shlex.split(command)
+        except ValueError:
+            return "bash: syntax error\n", 2
+        name, args = argv[0], argv[1:]
+        if name == 'echo':
+            return ' '.join(args) + '\n', 0
+        if name == 'seq':
+            return ''.join(f"{i}\n" for i in range(1, int(args[-1]) + 1)), 0
+        if name == 'sleep':
+            await asyncio.sleep(float(args[0]))
+            return '', 0
+        if name == 'cat':
+            content = self._file(args[0]) if args else None
+            if content is None:
+                return f"cat: {args[0] if args else ''}: No such file or directory\n", 1
+            return content.decode('utf-8', 'replace'), 0
+        if name in ('true', ':'):
+            return '', 0
+        if name == 'false':
+            return '', 1
+        if name == 'hostname':
+            return 'bench-host\n', 0
+        if name == 'uname':
+            return '5.15.0-105-generic\n' if '-r' in args else 'Linux\n', 0
+        if name == 'uptime':
+            return self.system_info().splitlines()[-1].split('=', 1)[1] + '\n', 0
+        return f"bash: {name}: command not found\n", 127
+
+class FakeShell:
+    """Интерактивный shell в pty: построчно читает stdin, Ctrl+C прерывает текущую команду."""
+
+    def __init__(self, process: asyncssh.SSHServerProcess, commands: FakeCommands):
+        self.process, self.commands = process, commands
+        self.status = 0
+        self._current = None
+
+    async def _execute(self, line: str) -> None:
+        if line.startswith('stty ') or line.startswith('bind '):
+            return
+        match = _PRINTF_RE.match(line)
+        if match:
+            # Маркер конца команды от ShellSession: printf '\n<маркер>_%s__\n' "$?"
+            self.process.stdout.write(match.group(1).replace('\\n', '\n').replace('%s', str(self.status)))
+            return
+        out, self.status = await self.commands.run(line)
+        self.process.stdout.write(out)
+
+    async def run(self) -> None:
+        self.process.stdout.write("Welcome to bench-host (fake SSH)\n$ ")
+        queue = asyncio.Queue()
+        worker = asyncio.create_task(self._worker(queue))
+        buf = ''
+        try:
+            while True:
+                data = await self.process.stdin.read(4096)
+                if not data:
+                    break
+                if '\x03' in data:
+                    # Ctrl+C: сбрасываем очередь и прерываем выполняющуюся команду
+                    data = data.rsplit('\x03', 1)[1]
+                    buf = ''
+                    while not queue.empty():
+                        queue.get_nowait()
+                    if self._current:
+                        self._current.cancel()
+                    self.status = 130
+                buf += data
+                while '\n' in buf:
+                    line, buf = buf.split('\n', 1)
+                    queue.put_nowait(line.strip('\r'))
+        except (asyncssh.BreakReceived, asyncssh.TerminalSizeChanged, asyncssh.SignalReceived):
+            pass
+        finally:
+            worker.cancel()
+            self.process.exit(0)
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            line = await queue.get()
+            self._current = asyncio.ensure_future(self._execute(line))
+            try:
+                await self._current
+            except asyncio.CancelledError:
+                if not self._current.cancelled():
+                    raise
+            finally:
+                self._current = None
+
+class _Server(asyncssh.SSHServer):
+    def begin_auth(self, username: str) -> bool:
+        return True
+
+    def password_auth_supported(self) -> bool:
+        return True
+
+    def validate_password(self, username: str, password: str) -> bool:
+        return True
+
+async def start_fake_ssh(root: str, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0):
+    """Запускает сервер на host:port (0 — свободный порт). Возвращает (сервер, порт)."""
+    commands = FakeCommands(root, latency)
+
+    async def handle(process: asyncssh.SSHServerProcess) -> None:
+        if process.command is None:
+            await FakeShell(process, commands).run()
+        else:
+            out, status = await commands.run(process.command)
+            process.stdout.write(out)
+            process.exit(status)
+
+    server = await asyncssh.create_server(
+        _Server, host, port, server_host_keys=[asyncssh.generate_private_key('ssh-ed25519')],
+        process_factory=handle, line_editor=False, encoding='utf-8',
+        sftp_factory=lambda chan: asyncssh.SFTPServer(chan, chroot=root.encode()))
+    return server, server.sockets[0].getsockname()[1]
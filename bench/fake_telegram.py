@@ -0,0 +1,130 @@
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+# Подставной Bot API для бенчмарка: бот ходит сюда через TELEGRAM_API_URL вместо api.telegram.org.
+# Любой метод отвечает успешно и правдоподобным объектом (Message, File, True...), задержка ответа
+# настраивается (latency). Сервер запоминает последние клавиатуру и текст в каждом чате — из них сценарии
+# берут callback_data следующего шага и проверяют результат — и позволяет дождаться сообщения в чат (wait_for).
+# Файлы для getFile генерируются: file_id вида "bench:<размер>" отдается по /file/bot<token>/... потоком.
+
+# Методы, которые в настоящем API возвращают True
+_TRUE_METHODS = {'answerCallbackQuery', 'setWebhook', 'deleteWebhook', 'deleteMessage', 'setMyCommands',
+                 'sendChatAction', 'answerInlineQuery'}
+_SEND_METHODS = {'sendMessage', 'sendDocument', 'sendPhoto', 'sendVideo', 'sendAudio', 'copyMessage',
+                 'editMessageText', 'editMessageReplyMarkup', 'editMessageCaption'}
+FILE_CHUNK = 64 * 1024
+
+class FakeTelegram:
+
+    def __init__(self, token: str, latency: float = 0.0, bot_id: int = 1):
+        self.token, self.latency, self.bot_id = token, latency, bot_id
+        self.calls = Counter()
+        self.received_bytes = 0                    # принято в файлах sendDocument/sendPhoto...
+        self.markups = {}                          # chat_id -> последняя reply_markup (dict)
+        self.texts = {}                            # chat_id -> текст (подпись) последнего сообщения или правки
+        self._message_ids = itertools.count(1_000_000)
+        self._waiters = defaultdict(list)          # chat_id -> [(predicate, future)]
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_post('/bot{token}/{method}', self.handle_method)
+        self.app.router.add_get('/file/bot{token}/{path:.+}', self.handle_file)
+        self._runner = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Запускает сервер и возвращает базовый адрес для TELEGRAM_API_URL."""
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    def wait_for(self, chat_id: int, predicate=None) -> asyncio.Future:
+        """Future, который завершится параметрами первого отправленного в чат сообщения,
+        для которого predicate(method, params) истинен."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id].append((predicate or (lambda method, params: True), future))
+        return future
+
+    def button(self, chat_id: int, prefix: str, text: str = None) -> str or None:
+        """callback_data первой кнопки последней клавиатуры чата, начинающейся с prefix
+        (и содержащей text в надписи, если он задан)."""
+        markup = self.markups.get(chat_id) or {}
+        for row in markup.get('inline_keyboard', []):
+            for button in row:
+                data = button.get('callback_data') or ''
+                if data.startswith(prefix) and (text is None or text in button.get('text', '')):
+                    return data
+        return None
+
+    def _message(self, chat_id, params: dict) -> dict:
+        message = {'message_id': int(params.get('message_id') or next(self._message_ids)), 'date': int(time.time()),
+                   'chat': {'id': int(chat_id), 'type': 'private'},
+                   'from': {'id': self.bot_id, 'is_bot': True, 'first_name': 'Bench'}}
+        if 'text' in params:
+            message['text'] = params['text']
+        if 'caption' in params:
+            message['caption'] = params['caption']
+        return message
+
+    def _result(self, method: str, params: dict):
+        if method in _TRUE_METHODS:
+            return True
+        if method == 'getMe':
+            return {'id': self.bot_id, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method == 'getFile':
+            file_id = params['file_id']
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': int(file_id.rsplit(':', 1)[-1]),
+                    'file_path': f"documents/{file_id.replace(':', '_')}"}
+        if method == 'copyMessage':
+            return {'message_id': next(self._message_ids)}
+        if method == 'getWebhookInfo':
+            return {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        if 'chat_id' in params:
+            return self._message(params['chat_id'], params)
+        return True
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        params = {}
+        for key, value in (await request.post()).items():
+            if hasattr(value, 'file'):
+                self.received_bytes += len(value.file.read())
+            else:
+                params[key] = value
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = params.get('chat_id')
+        if chat_id is not None and method in _SEND_METHODS:
+            chat_id = int(chat_id)
+            if 'reply_markup' in params:
+                self.markups[chat_id] = json.loads(params['reply_markup'])
+            if 'text' in params or 'caption' in params:
+                self.texts[chat_id] = params.get('text', params.get('caption'))
+            waiters = self._waiters.get(chat_id)
+            if waiters:
+                for waiter in list(waiters):
+                    predicate, future = waiter
+                    if not future.done() and predicate(method, params):
+                        future.set_result((method, params))
+                        waiters.remove(waiter)
+        return web.json_response({'ok': True, 'result': self._result(method, params)})
+
+    async def handle_file(self, request: web.Request) -> web.StreamResponse:
+        size = int(request.match_info['path'].rsplit('_', 1)[-1])
+        response = web.StreamResponse(headers={'Content-Length': str(size)})
+        await response.prepare(request)
+        chunk = b'z' * FILE_CHUNK
+        for offset in range(0, size, FILE_CHUNK):
+            await response.write(chunk[:size - offset])
+        await response.write_eof()
+        return response
@@ -0,0 +1,402 @@
+"""Сквозной бенчмарк бота: настоящий app.py (хендлеры, БД, фоновые задачи) против локального
+SSH-сервера (fake_ssh.py) и подставного Bot API (fake_telegram.py).
+
+    python bench/run.py --users 10 --iterations 20 --output bench-results.json
+
+Апдейты Telegram отправляются POST-запросами на вебхук приложения из build_app(), как их
+присылает Telegram; ответ на вебхук приходит после обработки апдейта (WEBHOOK_HANDLE_IN_BACKGROUND=0),
+поэтому время запроса — это время хендлера. Нужен PostgreSQL (переменные POSTGRES_* и DB_* как у бота):
+используйте отдельную пустую базу — рассылка уходит всем пользователям в ней, и без --force бенчмарк
+не запустится, если в базе есть пользователи не из диапазона бенчмарка. Свои строки бенчмарк удаляет.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'app')
+sys.path[:0] = [APP_DIR, BENCH_DIR]
+
+import aiohttp
+import asyncpg
+from cryptography.fernet import Fernet
+from dotenv import load_dotenv
+
+from fake_ssh import build_tree, start_fake_ssh
+from fake_telegram import FakeTelegram
+
+BENCH_BOT_TOKEN = '7000000001:BENCHBENCHBENCHBENCHBENCHBENCHBENCH'
+BENCH_ID_BASE = 9_000_000_000_000   # telegram_id пользователей бенчмарка: администратор — сама база,
+BENCH_ID_RANGE = 1_000_000          # виртуальные пользователи — база + 1..., получатели рассылки — база + 100000...
+BENCH_RECIPIENTS_OFFSET = 100_000
+BENCH_PASSWORD = 'bench'
+FLOWS = ('manage_server', 'terminal', 'fm_nav', 'download', 'upload', 'payment_webhook', 'broadcast')
+STEP_TIMEOUT = 120  # сек. на один шаг сценария
+
+class BenchError(Exception):
+    """Шаг сценария завершился не так, как ожидалось."""
+
+def percentile(values: list, pct: float) -> float:
+    """Перцентиль по ближайшему рангу; values отсортированы."""
+    if not values:
+        return None
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+class Recorder:
+    """Времена операций по именам и ошибки. Пропускная способность — операций за время фазы."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+        self.error_examples = {}
+        self.walls = {}
+        self.extra = defaultdict(dict)  # дополнительные поля операции в отчете
+
+    def fail(self, name: str, error: Exception) -> None:
+        self.errors[name] += 1
+        self.error_examples.setdefault(name, f"{type(error).__name__}: {error}")
+
+    async def timed(self, name: str, awaitable, timeout: float = STEP_TIMEOUT) -> bool:
+        """Замеряет операцию. Ошибка или таймаут учитываются в errors; возвращает, успешна ли операция."""
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(awaitable, timeout)
+        except Exception as e:
+            self.fail(name, e)
+            return False
+        self.samples[name].append(time.perf_counter() - started)
+        return True
+
+    def summary(self) -> dict:
+        result = {}
+        for name in sorted(set(self.samples) | set(self.errors)):
+            values = sorted(self.samples[name])
+            wall = self.walls.get(name)
+            result[name] = {
+                'count': len(values),
+                'errors': self.errors[name],
+                'p50_ms': _ms(percentile(values, 50)),
+                'p95_ms': _ms(percentile(values, 95)),
+                'p99_ms': _ms(percentile(values, 99)),
+                'mean_ms': _ms(sum(values) / len(values)) if values else None,
+                'max_ms': _ms(values[-1]) if values else None,
+                'throughput_per_s': round(len(values) / wall, 2) if wall else None,
+            }
+            result[name].update(self.extra.get(name, {}))
+            if name in self.error_examples:
+                result[name]['first_error'] = self.error_examples[name]
+        return result
+
+def _ms(seconds: float) -> float:
+    return None if seconds is None else round(seconds * 1000, 2)
+
+class Bench:
+    def __init__(self, args, bot_app, tg: FakeTelegram, ssh_port: int, ssh_root: str, base_url: str):
+        self.args, self.app, self.tg = args, bot_app, tg
+        self.ssh_port, self.ssh_root, self.base_url = ssh_port, ssh_root, base_url
+        self.recorder = Recorder()
+        self.http = None
+        self.users = []  # [(telegram_id, server_id)]
+        self._update_ids = iter(range(1, 10 ** 9))
+
+    # --- Данные ---
+    async def seed(self) -> None:
+        password = self.app.encrypt_password(BENCH_PASSWORD)
+        async with self.app.db_pool.acquire() as conn:
+            await conn.execute("INSERT INTO users (telegram_id, username, first_name, is_admin) VALUES ($1, 'bench_admin', 'Bench', TRUE)",
+                               BENCH_ID_BASE)
+            for i in range(self.args.users):
+                telegram_id = BENCH_ID_BASE + 1 + i
+                user_id = await conn.fetchval(
+                    "INSERT INTO users (telegram_id, username, first_name) VALUES ($1, $2, 'Bench') RETURNING id",
+                    telegram_id, f"bench_{i}")
+                server_id = await conn.fetchval(
+                    "INSERT INTO servers (user_id, name, ip, port, login_user, password_encrypted) "
+                    "VALUES ($1, $2, '127.0.0.1', $3, 'root', $4) RETURNING id",
+                    user_id, f"bench-{i}", self.ssh_port, password)
+                await conn.executemany(
+                    "INSERT INTO subscriptions (user_id, payment_id, amount, provider, status, duration_days) "
+                    "VALUES ($1, $2, 49, $3, 'pending', 30)",
+                    [(user_id, self.payment_id(i, k), self.provider(k)) for k in range(self.args.iterations)])
+                self.users.append((telegram_id, server_id))
+            await conn.copy_records_to_table(
+                'users', columns=('telegram_id', 'username', 'first_name'),
+                records=[(BENCH_ID_BASE + BENCH_RECIPIENTS_OFFSET + j, f"bench_r{j}", 'Bench')
+                         for j in range(self.args.broadcast_recipients)])
+
+    @staticmethod
+    def provider(k: int) -> str:
+        return ('yookassa', 'cryptopay')[k % 2]
+
+    @staticmethod
+    def payment_id(i: int, k: int) -> str:
+        return f"bench-{i}-{k}"
+
+    # --- Апдейты Telegram ---
+    def _user(self, telegram_id: int) -> dict:
+        return {'id': telegram_id, 'is_bot': False, 'first_name': 'Bench'}
+
+    def _message(self, telegram_id: int, **fields) -> dict:
+        return {'message_id': next(self._update_ids), 'date': int(time.time()),
+                'chat': {'id': telegram_id, 'type': 'private'}, 'from': self._user(telegram_id), **fields}
+
+    async def _post(self, path: str, payload: dict) -> None:
+        async with self.http.post(f"{self.base_url}{path}", json=payload) as response:
+            await response.read()
+            if response.status != 200:
+                raise BenchError(f"HTTP {response.status} на {path}")
+
+    async def callback(self, telegram_id: int, data: str) -> None:
+        update_id = next(self._update_ids)
+        message = self._message(telegram_id, text='bench')
+        message['from'] = {'id': self.tg.bot_id, 'is_bot': True, 'first_name': 'Bench'}
+        await self._post(self.app.WEBHOOK_TELEGRAM_PATH, {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'from': self._user(telegram_id), 'chat_instance': 'bench',
+            'message': message, 'data': data}})
+
+    async def message(self, telegram_id: int, **fields) -> None:
+        await self._post(self.app.WEBHOOK_TELEGRAM_PATH,
+                         {'update_id': next(self._update_ids), 'message': self._message(telegram_id, **fields)})
+
+    def expect(self, telegram_id: int, fragment: str) -> None:
+        text = self.tg.texts.get(telegram_id) or ''
+        if fragment not in text or '❌' in text:
+            raise BenchError(f"ожидалось «{fragment}», получено: {text[:200]!r}")
+
+    def button(self, telegram_id: int, prefix: str, label: str = None) -> str:
+        data = self.tg.button(telegram_id, prefix, label)
+        if not data:
+            raise BenchError(f"нет кнопки {prefix} {label or ''}")
+        return data
+
+    # --- Сценарии: каждый шаг — одна замеряемая операция ---
+    async def step(self, name: str, telegram_id: int, action, expect: str = None) -> bool:
+        async def run():
+            await action
+            if expect:
+                self.expect(telegram_id, expect)
+        return await self.recorder.timed(name, run())
+
+    async def flow_manage_server(self, telegram_id: int, server_id: int) -> None:
+        for _ in range(self.args.iterations):
+            await self.step('manage_server', telegram_id, self.callback(telegram_id, f"manage_server:{server_id}"), '🟢')
+
+    async def flow_terminal(self, telegram_id: int, server_id: int) -> None:
+        await self.callback(telegram_id, f"terminal:{server_id}")
+        for _ in range(self.args.iterations):
+            await self.step('terminal_command', telegram_id, self.message(telegram_id, text=self.args.terminal_command), '$')
+        await self.message(telegram_id, text='/exit')
+
+    async def flow_fm_nav(self, telegram_id: int, server_id: int) -> None:
+        await self.step('fm_enter', telegram_id, self.callback(telegram_id, f"fm_enter:{server_id}:/root"), 'Содержимое каталога')
+        for _ in range(self.args.iterations):
+            await self.step('fm_nav', telegram_id, self.callback(telegram_id, self.button(telegram_id, 'fm_nav:', 'many')),
+                            '/root/many')
+            await self.step('fm_nav', telegram_id, self.callback(telegram_id, self.button(telegram_id, 'fm_nav:', 'На уровень выше')),
+                            '<code>/root</code>')
+
+    async def flow_download(self, telegram_id: int, server_id: int) -> None:
+        await self.callback(telegram_id, f"fm_enter:{server_id}:/root")
+        for _ in range(self.args.iterations):
+            await self.step('download', telegram_id, self.callback(telegram_id, self.button(telegram_id, 'fm_info:', 'download.bin')),
+                            'успешно скачан')
+
+    async def flow_upload(self, telegram_id: int, server_id: int) -> None:
+        await self.callback(telegram_id, f"fm_enter:{server_id}:/root/uploads")
+        size = self.args.upload_size
+        for k in range(self.args.iterations):
+            await self.callback(telegram_id, self.button(telegram_id, 'fm_upload_here:'))
+            document = {'file_id': f"bench:{size}", 'file_unique_id': f"bench{size}",
+                        'file_name': f"upload_{telegram_id}_{k}.bin", 'file_size': size}
+            await self.step('upload', telegram_id, self.message(telegram_id, document=document), 'Содержимое каталога')
+
+    async def flow_payment_webhook(self, telegram_id: int, server_id: int) -> None:
+        """Время ответа вебхука и время от вебхука до уведомления пользователю (через очереди)."""
+        i = telegram_id - BENCH_ID_BASE - 1
+        for k in range(self.args.iterations):
+            delivered = self.tg.wait_for(telegram_id, lambda method, params: 'Оплата' in params.get('text', ''))
+            payment_id = self.payment_id(i, k)
+            if self.provider(k) == 'yookassa':
+                path, payload = self.app.WEBHOOK_YOOKASSA_PATH, {'event': 'payment.succeeded', 'object': {'id': payment_id}}
+            else:
+                path, payload = self.app.WEBHOOK_CRYPTO_PAY_PATH, {'update_type': 'invoice_paid', 'payload': {'invoice_id': payment_id}}
+
+            async def webhook_to_notification():
+                if not await self.recorder.timed('payment_webhook', self._post(path, payload)):
+                    raise BenchError("вебхук не принят")
+                await delivered
+
+            await self.recorder.timed('payment_to_notification', webhook_to_notification())
+            delivered.cancel()  # если уведомление не дождались
+
+    async def run_broadcast(self) -> None:
+        """Одна рассылка от администратора: время ответа на «начать» и время до status = 'done'."""
+        admin = BENCH_ID_BASE
+        await self.callback(admin, 'admin_broadcast')
+        await self.message(admin, text='Bench broadcast')
+
+        async def start_and_wait():
+            # Текст не проверяется: в сообщении о прогрессе всегда есть строка «❌ Ошибок: N»
+            if not await self.recorder.timed('broadcast_start', self.callback(admin, 'start_broadcast')):
+                raise BenchError("рассылка не запущена")
+            while True:
+                async with self.app.db_pool.acquire() as conn:
+                    job = await conn.fetchrow("SELECT status, total, sent FROM broadcasts WHERE admin_chat_id = $1 "
+                                              "ORDER BY id DESC LIMIT 1", admin)
+                if job and job['status'] == 'done':
+                    return job
+                await asyncio.sleep(0.05)
+
+        task = asyncio.ensure_future(start_and_wait())
+        # Рассылка идет со скоростью BROADCAST_RATE: таймаут — из расчета не меньше сообщения в секунду
+        if await self.recorder.timed('broadcast_complete', task, STEP_TIMEOUT + self.args.broadcast_recipients):
+            job = task.result()
+            duration = self.recorder.samples['broadcast_complete'][-1]
+            self.recorder.extra['broadcast_complete'] = {'recipients': job['total'], 'sent': job['sent'],
+                                                         'messages_per_s': round(job['sent'] / duration, 2)}
+
+    async def run_flow(self, flow: str) -> None:
+        before = set(self.recorder.samples)
+        started = time.perf_counter()
+        if flow == 'broadcast':
+            await self.run_broadcast()
+        else:
+            scenario = getattr(self, f"flow_{flow}")
+
+            async def virtual_user(telegram_id, server_id):
+                try:
+                    await scenario(telegram_id, server_id)
+                except Exception as e:
+                    self.recorder.fail(flow, e)  # шаг вне замеров (подготовка сценария) не удался
+
+            await asyncio.gather(*(virtual_user(*user) for user in self.users))
+        wall = time.perf_counter() - started
+        for name in set(self.recorder.samples) - before:
+            self.recorder.walls.setdefault(name, wall)
+        logging.warning(f"bench: {flow} — {wall:.1f} с")
+
+async def connect() -> asyncpg.Connection:
+    return await asyncpg.connect(user=os.getenv('POSTGRES_USER'), password=os.getenv('POSTGRES_PASSWORD'),
+                                 database=os.getenv('POSTGRES_DB'), host=os.getenv('DB_HOST'), port=os.getenv('DB_PORT'))
+
+async def prepare_database(args) -> None:
+    """Создает схему в пустой базе, проверяет, что база не рабочая, и удаляет остатки прошлого запуска."""
+    conn = await connect()
+    try:
+        if await conn.fetchval("SELECT to_regclass('users')") is None:
+            with open(os.path.join(APP_DIR, 'db', 'create_tables.sql'), encoding='utf-8') as f:
+                await conn.execute(f.read())
+        foreign = await conn.fetchval("SELECT COUNT(*) FROM users WHERE telegram_id NOT BETWEEN $1 AND $2",
+                                      BENCH_ID_BASE, BENCH_ID_BASE + BENCH_ID_RANGE)
+        if foreign and not args.force:
+            raise SystemExit(f"В базе {foreign} пользователей не из бенчмарка. Используйте отдельную базу или --force.")
+    finally:
+        await conn.close()
+    await cleanup_database(args)
+
+async def cleanup_database(args) -> None:
+    conn = await connect()
+    try:
+        ids = (BENCH_ID_BASE, BENCH_ID_BASE + BENCH_ID_RANGE)
+        await conn.execute("DELETE FROM users WHERE telegram_id BETWEEN $1 AND $2", *ids)  # серверы, подписки, журнал — каскадом
+        for table, sql in (
+                ('notifications', "DELETE FROM notifications WHERE telegram_id BETWEEN $1 AND $2"),
+                ('broadcasts', "DELETE FROM broadcasts WHERE admin_chat_id BETWEEN $1 AND $2")):
+            if await conn.fetchval("SELECT to_regclass($1)", table):
+                await conn.execute(sql, *ids)
+        if await conn.fetchval("SELECT to_regclass('payment_events')"):
+            await conn.execute("DELETE FROM payment_events WHERE payment_id LIKE 'bench-%'")
+        if await conn.fetchval("SELECT to_regclass('fsm_states')"):
+            await conn.execute("DELETE FROM fsm_states WHERE key LIKE $1", f"fsm:{BENCH_BOT_TOKEN.split(':')[0]}:%")
+    finally:
+        await conn.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Сквозной бенчмарк бота с локальным SSH-сервером и подставным Bot API.")
+    parser.add_argument('--users', type=int, default=10, help="одновременных виртуальных пользователей")
+    parser.add_argument('--iterations', type=int, default=20, help="повторов каждого сценария на пользователя")
+    parser.add_argument('--flows', default=','.join(FLOWS), help=f"сценарии через запятую: {', '.join(FLOWS)}")
+    parser.add_argument('--terminal-command', default='seq 200', help="команда для сценария terminal")
+    parser.add_argument('--download-size', type=int, default=2 * 1024 * 1024, help="байт в скачиваемом файле")
+    parser.add_argument('--upload-size', type=int, default=1024 * 1024, help="байт в загружаемом файле")
+    parser.add_argument('--listing-size', type=int, default=200, help="файлов в каталоге /root/many")
+    parser.add_argument('--broadcast-recipients', type=int, default=500, help="получателей рассылки")
+    parser.add_argument('--ssh-latency', type=float, default=0.0, help="сек. задержки на каждую команду SSH")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="сек. задержки на каждый запрос к Bot API")
+    parser.add_argument('--output', default='bench-results.json', help="куда записать результаты (JSON)")
+    parser.add_argument('--force', action='store_true', help="запускать на базе с чужими пользователями")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+    args.output = os.path.abspath(args.output)  # до смены каталога на app/
+    args.flows = [flow.strip() for flow in args.flows.split(',') if flow.strip()]
+    unknown = set(args.flows) - set(FLOWS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    return args
+
+async def main(argv=None) -> dict:
+    args = parse_args(argv)
+    load_dotenv(os.path.join(APP_DIR, '..', '.env'))  # настройки БД; токен и адрес API ниже заменяются
+    tg = FakeTelegram(BENCH_BOT_TOKEN, latency=args.api_latency, bot_id=int(BENCH_BOT_TOKEN.split(':')[0]))
+    api_url = await tg.start()
+    ssh_root = tempfile.mkdtemp(prefix='bench-ssh-')
+    build_tree(ssh_root, args.download_size, args.listing_size)
+    ssh_server, ssh_port = await start_fake_ssh(ssh_root, latency=args.ssh_latency)
+    os.environ.update({'BOT_TOKEN': BENCH_BOT_TOKEN, 'ADMIN_ID': str(BENCH_ID_BASE), 'TELEGRAM_API_URL': api_url,
+                       'WEBHOOK_HANDLE_IN_BACKGROUND': '0', 'WEBHOOK_BASE_DOMAIN': 'http://127.0.0.1'})
+    os.environ.setdefault('ENCRYPTION_KEY', Fernet.generate_key().decode())
+    try:
+        await prepare_database(args)
+        os.chdir(APP_DIR)
+        import app as bot_app  # после настройки окружения: конфигурация читается при импорте
+        logging.getLogger().setLevel(args.log_level)
+        web_app = await bot_app.build_app()
+        if web_app is None:
+            raise SystemExit("Приложение не запустилось: нет подключения к базе данных.")
+        runner = bot_app.web.AppRunner(web_app, access_log=None)
+        await runner.setup()
+        site = bot_app.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        bench = Bench(args, bot_app, tg, ssh_port, ssh_root, f"http://127.0.0.1:{runner.addresses[0][1]}")
+        try:
+            await bench.seed()
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=STEP_TIMEOUT)) as bench.http:
+                for flow in args.flows:
+                    await bench.run_flow(flow)
+        finally:
+            await runner.cleanup()
+            await bot_app.shutdown_app()
+    finally:
+        ssh_server.close()
+        await tg.stop()
+        shutil.rmtree(ssh_root, ignore_errors=True)
+        await cleanup_database(args)
+
+    results = {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'config': {key: value for key, value in vars(args).items() if key not in ('force', 'log_level', 'output')},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'flows': bench.recorder.summary(),
+        'telegram_api_calls': dict(tg.calls),
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"{'операция':<26}{'n':>6}{'ошибок':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'оп/с':>10}")
+    for name, stats in results['flows'].items():
+        print(f"{name:<26}{stats['count']:>6}{stats['errors']:>8}" +
+              ''.join(f"{'-' if stats[k] is None else stats[k]:>10}" for k in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_per_s')))
+    print(f"Результаты: {os.path.abspath(args.output)}")
+    return results
+
+if __name__ == '__main__':
+    asyncio.run(main())